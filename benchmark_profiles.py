@@ -0,0 +1,121 @@
+"""
+Compare Gunicorn worker profiles (sync, gthread, uvicorn) under the same
+Locust load. See LOAD_TESTING.md.
+
+    python benchmark_profiles.py --users 200 --run-time 3m
+
+Each profile is started from gunicorn_config.py on its own port, loaded with
+locustfile.py, stopped, and summarised from Locust's CSV output.
+"""
+import argparse
+import csv
+import os
+import socket
+import subprocess
+import sys
+import time
+
+PROFILES = ["sync", "gthread", "uvicorn"]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.5)
+    return False
+
+
+def run_profile(profile, port, args):
+    env = {**os.environ, "GUNICORN_WORKER_CLASS": profile, "PORT": str(port)}
+    if args.workers:
+        env["GUNICORN_WORKERS"] = str(args.workers)
+    if profile == "uvicorn":
+        # Several ASGI workers refuse the per-process broker. Publishing only
+        # needs pg_notify; the LISTEN connection opens on the first subscriber.
+        env.setdefault("PUBSUB_BACKEND", "postgres")
+
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn_config.py"],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        if not wait_for_port(port):
+            print(f"{profile}: server did not start")
+            return None
+
+        prefix = f"loadtest_{args.users}_{profile}"
+        subprocess.run(
+            [
+                sys.executable, "-m", "locust",
+                "-f", "locustfile.py",
+                "--host", f"http://127.0.0.1:{port}",
+                "--users", str(args.users),
+                "--spawn-rate", str(args.spawn_rate),
+                "--run-time", args.run_time,
+                "--headless",
+                "--only-summary",
+                "--csv", prefix,
+            ],
+            check=False,
+        )
+        return read_summary(f"{prefix}_stats.csv")
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+def read_summary(path):
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            if row["Name"] == "Aggregated":
+                requests = int(row["Request Count"])
+                failures = int(row["Failure Count"])
+                return {
+                    "rps": float(row["Requests/s"]),
+                    "avg_ms": float(row["Average Response Time"]),
+                    "p95_ms": float(row["95%"]),
+                    "p99_ms": float(row["99%"]),
+                    "failure_pct": 100.0 * failures / requests if requests else 0.0,
+                }
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profiles", nargs="+", default=PROFILES, choices=PROFILES)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--spawn-rate", type=int, default=20)
+    parser.add_argument("--run-time", default="3m")
+    parser.add_argument("--workers", type=int, help="Override GUNICORN_WORKERS for every profile")
+    parser.add_argument("--port", type=int, default=8100)
+    args = parser.parse_args()
+
+    results = {}
+    for offset, profile in enumerate(args.profiles):
+        print(f"== {profile}")
+        results[profile] = run_profile(profile, args.port + offset, args)
+
+    print()
+    print("| profile | req/s | avg ms | p95 ms | p99 ms | failures |")
+    print("|---|---|---|---|---|---|")
+    for profile, summary in results.items():
+        if summary is None:
+            print(f"| {profile} | - | - | - | - | - |")
+            continue
+        print(
+            f"| {profile} | {summary['rps']:.1f} | {summary['avg_ms']:.0f} | {summary['p95_ms']:.0f} "
+            f"| {summary['p99_ms']:.0f} | {summary['failure_pct']:.2f}% |"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,11 @@
 ASGI config for food project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Long-lived endpoints such as the order event stream
+(``/api/orders/<id>/stream/``) are async views and should be served from here,
+e.g. ``uvicorn food.asgi:application``, rather than from the WSGI workers.
+WebSocket connections are routed to the rider gateway
+(``foodbackend/rider_gateway.py``); everything else goes to Django.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
@@ -13,4 +18,16 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'food.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from foodbackend import rider_gateway  # noqa: E402  (needs the app registry)
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "websocket":
+        if scope["path"] == rider_gateway.PATH:
+            return await rider_gateway.application(scope, receive, send)
+        # Unknown WebSocket route: refuse the handshake.
+        await receive()
+        return await send({"type": "websocket.close", "code": 4404})
+    return await django_application(scope, receive, send)
@@ -61,14 +61,93 @@ MIDDLEWARE = [
     "django.contrib.messages.middleware.MessageMiddleware",
 ]
 
+# Web worker processes and their profile (sync, gthread or uvicorn);
+# gunicorn_config.py exports what it starts.
+WEB_WORKERS = config("GUNICORN_WORKERS", default=1, cast=int)
+WEB_WORKER_CLASS = config("GUNICORN_WORKER_CLASS", default="sync").lower()
+
+# Rider positions, dispatch offers, rider gateway sessions and the menu/coupon
+# cache versions live here, so every worker must share it. With more than one
+# gunicorn worker the default is the database cache, in the table that the
+# release step makes with "createcachetable dipanddash_cache"; CACHE_BACKEND
+# can point at Redis instead. foodbackend/checks.py refuses a per-process
+# cache for GUNICORN_WORKERS > 1.
 CACHES = {
     "default": {
-        "BACKEND": config("CACHE_BACKEND", default="django.core.cache.backends.locmem.LocMemCache"),
-        "LOCATION": config("CACHE_LOCATION", default="dipanddash-local-cache"),
+        "BACKEND": config(
+            "CACHE_BACKEND",
+            default="django.core.cache.backends.db.DatabaseCache"
+            if WEB_WORKERS > 1
+            else "django.core.cache.backends.locmem.LocMemCache",
+        ),
+        "LOCATION": config("CACHE_LOCATION", default="dipanddash_cache" if WEB_WORKERS > 1 else "dipanddash-local-cache"),
         "TIMEOUT": config("CACHE_TIMEOUT", default=600, cast=int),
     }
 }
 
+# Live order streams (SSE). "local" fans out inside one process; "postgres"
+# uses LISTEN/NOTIFY so every worker sees every event. LISTEN does not work
+# through a transaction-pooling PgBouncer, so point PUBSUB_LISTEN_HOST at the
+# direct (non "-pooler") database host when using it.
+PUBSUB_BACKEND = config("PUBSUB_BACKEND", default="local")
+PUBSUB_LISTEN_HOST = config("PUBSUB_LISTEN_HOST", default="")
+
+# Serve the I/O-bound endpoints (OTP SMS, geocoding, Razorpay) from async
+# views. Only useful under ASGI workers; gunicorn_config.py turns it on for
+# the "uvicorn" profile.
+ASYNC_IO_VIEWS = config("ASYNC_IO_VIEWS", default=False, cast=bool)
+
+# Keyset pagination on the app and admin API list endpoints
+# (foodbackend/pagination.py).
+API_PAGE_SIZE = config("API_PAGE_SIZE", default=20, cast=int)
+API_MAX_PAGE_SIZE = config("API_MAX_PAGE_SIZE", default=100, cast=int)
+ADMIN_API_PAGE_SIZE = config("ADMIN_API_PAGE_SIZE", default=50, cast=int)
+ADMIN_API_MAX_PAGE_SIZE = config("ADMIN_API_MAX_PAGE_SIZE", default=200, cast=int)
+# Most orders one admin bulk status change may move.
+ADMIN_BULK_STATUS_MAX_ORDERS = config("ADMIN_BULK_STATUS_MAX_ORDERS", default=200, cast=int)
+
+# Day/hour boundaries of the admin dashboard rollups (foodbackend/rollups.py).
+ROLLUP_TIME_ZONE = config("ROLLUP_TIME_ZONE", default="Asia/Kolkata")
+
+# Rows fetched per server-side cursor round trip by the streaming exports.
+EXPORT_CHUNK_SIZE = config("EXPORT_CHUNK_SIZE", default=2000, cast=int)
+
+# Bulk menu import: parallel image downloads and the size images are capped to.
+MENU_IMPORT_IMAGE_WORKERS = config("MENU_IMPORT_IMAGE_WORKERS", default=4, cast=int)
+MENU_IMPORT_IMAGE_MAX_SIDE = config("MENU_IMPORT_IMAGE_MAX_SIDE", default=1200, cast=int)
+
+# Seconds the compiled coupon rules stay cached; admin coupon edits drop them at once.
+COUPON_RULESET_TTL = config("COUPON_RULESET_TTL", default=300, cast=int)
+
+# Single-use coupon codes (foodbackend/coupon_codes.py). The secret keys the
+# code encoding; changing it invalidates every code already handed out.
+COUPON_CODE_SECRET = config("COUPON_CODE_SECRET", default="")
+COUPON_CODE_BATCH_SIZE = config("COUPON_CODE_BATCH_SIZE", default=5000, cast=int)
+ADMIN_COUPON_CODES_MAX = config("ADMIN_COUPON_CODES_MAX", default=100000, cast=int)
+
+# Item rating aggregates (foodbackend/item_ratings.py): the window of the
+# recent average, and how often new ratings may invalidate the cached menu.
+ITEM_RATING_RECENT_DAYS = config("ITEM_RATING_RECENT_DAYS", default=30, cast=int)
+ITEM_RATINGS_BUMP_SECONDS = config("ITEM_RATINGS_BUMP_SECONDS", default=60, cast=int)
+
+# Expo push delivery (foodbackend/push.py).
+EXPO_API_URL = config("EXPO_API_URL", default="https://exp.host/--/api/v2/push")
+EXPO_ACCESS_TOKEN = config("EXPO_ACCESS_TOKEN", default="")
+PUSH_CONCURRENCY = config("PUSH_CONCURRENCY", default=6, cast=int)
+PUSH_TOKEN_CHUNK_SIZE = config("PUSH_TOKEN_CHUNK_SIZE", default=1000, cast=int)
+PUSH_RECEIPT_DELAY = config("PUSH_RECEIPT_DELAY", default=900, cast=int)
+
+# Segmented push campaigns (foodbackend/campaigns.py): recipients sent per
+# paced chunk, and how long a worker's hold on a campaign outlives its last chunk.
+CAMPAIGN_CHUNK_SIZE = config("CAMPAIGN_CHUNK_SIZE", default=1000, cast=int)
+CAMPAIGN_LEASE_SECONDS = config("CAMPAIGN_LEASE_SECONDS", default=120, cast=int)
+
+# Order status push outbox (foodbackend/outbox.py): changes to one order within
+# the coalesce window become a single push.
+OUTBOX_COALESCE_SECONDS = config("OUTBOX_COALESCE_SECONDS", default=3, cast=int)
+OUTBOX_BATCH_SIZE = config("OUTBOX_BATCH_SIZE", default=500, cast=int)
+OUTBOX_MAX_ATTEMPTS = config("OUTBOX_MAX_ATTEMPTS", default=5, cast=int)
+
 # CSRF Configuration for React Frontend
 CSRF_TRUSTED_ORIGINS = config(
     'CSRF_TRUSTED_ORIGINS', 
@@ -90,6 +169,8 @@ CORS_ALLOW_HEADERS = [
     "x-csrftoken",
     "authorization",
 ]
+# Cursor headers on paginated list endpoints whose body is a bare list.
+CORS_EXPOSE_HEADERS = ["X-Next-Cursor", "X-Since-Cursor", "X-Has-More"]
 
 # Session Configuration
 SESSION_COOKIE_SECURE = config('SESSION_COOKIE_SECURE', default=False, cast=bool)  # Set to True in production with HTTPS
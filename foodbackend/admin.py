@@ -1,15 +1,17 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django import forms
-from django.core.cache import cache
+from django.db.models import Count, Prefetch
 from .models import (
     HomeBanner,
     Category, 
     Item, 
+    ComboItem,
     Cart, 
     CartItem, 
     Address, 
     Order, 
     OrderItem,
+    OrderStatusEvent,
     OrderReview,
     OrderItemReview,
     Coupon,
@@ -17,35 +19,94 @@ from .models import (
     SupportTicket,
     SupportMessage,
 )
+from . import catalog, coupons, item_ratings, order_states, rider_location
 
 
-@admin.register(HomeBanner)
-class HomeBannerAdmin(admin.ModelAdmin):
-    list_display = ("id", "title", "sort_order", "is_active", "created_at")
-    list_filter = ("is_active",)
-    list_editable = ("sort_order", "is_active")
-    search_fields = ("title",)
-    readonly_fields = ("created_at", "updated_at")
+def _combo_links_prefetch(item_path):
+    """Prefetch a combo's components where ``Item.get_effective_price`` looks for them."""
+    return Prefetch(
+        f"{item_path}__combo_links",
+        queryset=ComboItem.objects.select_related("item"),
+        to_attr="prefetched_combo_links",
+    )
+
+
+class CatalogAdminMixin:
+    """Invalidate the cached menu when catalog rows change."""
 
     def save_model(self, request, obj, form, change):
         super().save_model(request, obj, form, change)
-        cache.delete("api:home_data:v2")
+        catalog.bump_on_commit()
 
     def delete_model(self, request, obj):
         super().delete_model(request, obj)
-        cache.delete("api:home_data:v2")
+        catalog.bump_on_commit()
+
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        catalog.bump_on_commit()
+
+
+class CouponRulesAdminMixin:
+    """Recompile the cached coupon rules when coupons change."""
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        coupons.invalidate_on_commit()
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        coupons.invalidate_on_commit()
+
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        coupons.invalidate_on_commit()
+
+
+class ItemRatingsAdminMixin:
+    """Move the item rating aggregates when item reviews are edited or deleted here."""
+
+    def item_reviews(self, queryset):
+        return queryset
+
+    def _ratings(self, obj):
+        return item_ratings.ratings_of(self.item_reviews(type(obj).objects.filter(pk=obj.pk)))
+
+    def save_model(self, request, obj, form, change):
+        removed = self._ratings(obj) if change else []
+        super().save_model(request, obj, form, change)
+        item_ratings.apply_on_commit(self._ratings(obj), removed)
+
+    def delete_model(self, request, obj):
+        removed = self._ratings(obj)
+        super().delete_model(request, obj)
+        item_ratings.apply_on_commit([], removed)
+
+    def delete_queryset(self, request, queryset):
+        removed = item_ratings.ratings_of(self.item_reviews(queryset))
+        super().delete_queryset(request, queryset)
+        item_ratings.apply_on_commit([], removed)
+
+
+@admin.register(HomeBanner)
+class HomeBannerAdmin(CatalogAdminMixin, admin.ModelAdmin):
+    list_display = ("id", "title", "sort_order", "is_active", "created_at")
+    list_filter = ("is_active",)
+    list_editable = ("sort_order", "is_active")
+    search_fields = ("title",)
+    readonly_fields = ("created_at", "updated_at")
 
 
 @admin.register(Category)
-class CategoryAdmin(admin.ModelAdmin):
+class CategoryAdmin(CatalogAdminMixin, admin.ModelAdmin):
     list_display = ('id', 'name', 'gst_rate')
     list_editable = ('gst_rate',)
     search_fields = ('name',)
 
 
 @admin.register(Item)
-class ItemAdmin(admin.ModelAdmin):
-    list_display = ('id', 'name', 'category', 'price', 'gst_rate', 'is_available')
+class ItemAdmin(CatalogAdminMixin, admin.ModelAdmin):
+    list_display = ('id', 'name', 'category', 'price', 'gst_rate', 'is_available', 'rating_count', 'average_rating')
     list_filter = ('category', 'is_available')
     list_editable = ('price', 'gst_rate', 'is_available')
     search_fields = ('name', 'description')
@@ -56,10 +117,14 @@ class CartAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'created_at', 'updated_at', 'item_count')
     search_fields = ('user__username', 'user__first_name')
     readonly_fields = ('created_at', 'updated_at')
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('user').annotate(item_count=Count('items'))
     
     def item_count(self, obj):
-        return obj.items.count()
+        return obj.item_count
     item_count.short_description = 'Items'
+    item_count.admin_order_field = 'item_count'
 
 
 @admin.register(CartItem)
@@ -69,6 +134,13 @@ class CartItemAdmin(admin.ModelAdmin):
     search_fields = ('cart__user__username', 'item__name')
     readonly_fields = ('created_at', 'updated_at')
 
+    def get_queryset(self, request):
+        return (
+            super().get_queryset(request)
+            .select_related('cart__user', 'item__category')
+            .prefetch_related(_combo_links_prefetch('item'))
+        )
+
 
 @admin.register(Address)
 class AddressAdmin(admin.ModelAdmin):
@@ -85,6 +157,19 @@ class OrderItemInline(admin.TabularInline):
     fields = ('item', 'quantity', 'price_at_order', 'tax_at_order')
 
 
+class OrderStatusEventInline(admin.TabularInline):
+    """Read-only status history of an order"""
+    model = OrderStatusEvent
+    extra = 0
+    can_delete = False
+    readonly_fields = ('ts', 'from_status', 'status', 'source', 'actor')
+    fields = ('ts', 'from_status', 'status', 'source', 'actor')
+    ordering = ('ts',)
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'status', 'subtotal', 'tax', 'platform_fee', 'total_price', 'created_at')
@@ -92,7 +177,20 @@ class OrderAdmin(admin.ModelAdmin):
     search_fields = ('user__username', 'user__first_name')
     readonly_fields = ('created_at', 'updated_at')
     list_editable = ('status',)
-    inlines = [OrderItemInline]
+    inlines = [OrderItemInline, OrderStatusEventInline]
+
+    def save_model(self, request, obj, form, change):
+        previous_status = form.initial.get('status') if change else None
+        if change and obj.status != previous_status:
+            if not order_states.can_transition(previous_status, obj.status):
+                messages.error(request, f"Order #{obj.pk}: cannot move from {previous_status} to {obj.status}")
+                obj.status = previous_status
+        super().save_model(request, obj, form, change)
+        if not change:
+            order_states.record_created(obj, source='staff', actor=request.user)
+        elif obj.status != previous_status:
+            order_states.record_change(obj.pk, previous_status, obj.status, source='staff', actor=request.user)
+            rider_location.forget_order(obj.pk)
 
 
 @admin.register(OrderItem)
@@ -101,25 +199,37 @@ class OrderItemAdmin(admin.ModelAdmin):
     list_filter = ('order__status',)
     search_fields = ('order__user__username', 'item__name')
 
+    def get_queryset(self, request):
+        return (
+            super().get_queryset(request)
+            .select_related('order__user', 'item')
+            .prefetch_related(_combo_links_prefetch('item'))
+        )
+
 
 class OrderItemReviewInline(admin.TabularInline):
     model = OrderItemReview
     extra = 0
     readonly_fields = ('item_name', 'rating', 'created_at')
     fields = ('item_name', 'rating', 'created_at')
+    # Item reviews are deleted through their own admin, which keeps the item ratings in step.
+    can_delete = False
 
 
 @admin.register(OrderReview)
-class OrderReviewAdmin(admin.ModelAdmin):
+class OrderReviewAdmin(ItemRatingsAdminMixin, admin.ModelAdmin):
     list_display = ('id', 'order', 'user', 'delivery_rating', 'overall_rating', 'created_at')
     list_filter = ('delivery_rating', 'created_at')
     search_fields = ('user__username', 'user__first_name', 'order__id')
     readonly_fields = ('created_at', 'updated_at')
     inlines = [OrderItemReviewInline]
 
+    def item_reviews(self, queryset):
+        return OrderItemReview.objects.filter(review__in=queryset)
+
 
 @admin.register(OrderItemReview)
-class OrderItemReviewAdmin(admin.ModelAdmin):
+class OrderItemReviewAdmin(ItemRatingsAdminMixin, admin.ModelAdmin):
     list_display = ('id', 'review', 'item_name', 'rating', 'created_at')
     list_filter = ('rating', 'created_at')
     search_fields = ('item_name', 'review__order__id', 'review__user__username')
@@ -127,7 +237,7 @@ class OrderItemReviewAdmin(admin.ModelAdmin):
 
 
 @admin.register(Coupon)
-class CouponAdmin(admin.ModelAdmin):
+class CouponAdmin(CouponRulesAdminMixin, admin.ModelAdmin):
     list_display = (
         'code', 
         'discount_type', 
@@ -139,7 +249,7 @@ class CouponAdmin(admin.ModelAdmin):
         'is_active',
         'valid_until'
     )
-    list_filter = ('discount_type', 'is_active', 'for_first_time_users_only', 'valid_from', 'valid_until')
+    list_filter = ('discount_type', 'is_active', 'for_first_time_users_only', 'unique_codes', 'valid_from', 'valid_until')
     search_fields = ('code', 'description')
     list_editable = ('is_active',)
     readonly_fields = ('used_count', 'created_at', 'updated_at')
@@ -161,6 +271,8 @@ class CouponAdmin(admin.ModelAdmin):
                 'min_order_amount',
                 'for_first_time_users_only',
                 'max_uses',
+                'max_uses_per_user',
+                'unique_codes',
                 'used_count'
             )
         }),
@@ -200,6 +312,7 @@ class SupportTicketAdmin(admin.ModelAdmin):
     list_filter = ('category', 'status', 'created_at')
     search_fields = ('user__username', 'user__profile__name', 'user__profile__mobile', 'id')
     list_editable = ('status',)
+    list_select_related = ('user', 'order__user')
     readonly_fields = ('user', 'category', 'order', 'created_at', 'updated_at', 'get_customer_name', 'get_customer_mobile', 'admin_reply_form')
     inlines = [SupportMessageInline]
     
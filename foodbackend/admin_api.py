@@ -1,13 +1,25 @@
+import csv
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError as DjangoValidationError
 from django.db import IntegrityError, transaction
 from django.db import models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+from django.utils import timezone
 from django.utils.crypto import get_random_string
+from django.utils.dateparse import parse_date, parse_datetime
 from django.middleware.csrf import get_token
 from django.views.decorators.csrf import ensure_csrf_cookie
-from rest_framework import permissions, viewsets
+from rest_framework import filters, permissions, viewsets
 from rest_framework.authentication import SessionAuthentication
 from rest_framework.decorators import action, api_view, authentication_classes, permission_classes
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 
 from .admin_serializers import (
@@ -21,6 +33,7 @@ from .admin_serializers import (
     OrderItemSerializer,
     OrderReviewSerializer,
     OrderSerializer,
+    PushCampaignSerializer,
     PushTokenSerializer,
     UserCouponUsageSerializer,
     UserSerializer,
@@ -39,15 +52,103 @@ from .models import (
     OrderItemReview,
     OrderItem,
     OrderReview,
+    PushCampaign,
     PushToken,
     UserCouponUsage,
     SupportTicket,
     SupportMessage,
     StaffProfile,
 )
+from . import campaigns, catalog, coupon_codes, coupons, exports, menu_import, order_states, pagination, rider_location, rollups, trails
+from .views import after_status_change
+
+
+class AdminFilterBackend(filters.BaseFilterBackend):
+    """
+    Whitelisted query filters for admin list endpoints.
+
+    ``?<name>=<value>`` is applied only for names in the view's
+    ``filterset_fields``. Foreign keys filter on the id, ``none`` matches a
+    null foreign key and comma-separated values match any of them.
+    ``?date_from=`` / ``?date_to=`` (see ``date_bounds``) bound the view's
+    ``date_filter_field``.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        opts = queryset.model._meta
+        for name in getattr(view, "filterset_fields", []):
+            raw = request.query_params.get(name)
+            if not raw:
+                continue
+            field = opts.get_field(name)
+            if field.null and raw.lower() == "none":
+                queryset = queryset.filter(**{f"{field.attname}__isnull": True})
+                continue
+            values = [self._value(name, field, value) for value in raw.split(",")]
+            if len(values) == 1:
+                queryset = queryset.filter(**{field.attname: values[0]})
+            else:
+                queryset = queryset.filter(**{f"{field.attname}__in": values})
 
+        date_field = getattr(view, "date_filter_field", None)
+        if date_field:
+            queryset = queryset.filter(
+                **{f"{date_field}__{lookup}": value for lookup, value in date_bounds(request.query_params).items()}
+            )
+        return queryset
 
-class AdminBaseViewSet(viewsets.ModelViewSet):
+    def _value(self, name, field, raw):
+        target = field.target_field if field.is_relation else field
+        if isinstance(target, models.BooleanField):
+            raw = {"true": "True", "1": "True", "false": "False", "0": "False"}.get(raw.lower(), raw)
+        try:
+            value = target.to_python(raw)
+        except DjangoValidationError:
+            raise ValidationError({name: [f"Invalid value: {raw}"]})
+        if field.choices and value not in dict(field.flatchoices):
+            raise ValidationError({name: [f"Invalid value: {raw}"]})
+        return value
+
+
+def _parse_moment(name, raw):
+    """``(aware datetime, whole_day)`` for a date or datetime parameter."""
+    try:
+        day = parse_date(raw)
+        moment = datetime.combine(day, time.min) if day else parse_datetime(raw)
+    except ValueError:
+        moment = None
+    if moment is None:
+        raise ValidationError({name: ["Use YYYY-MM-DD or an ISO datetime"]})
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment, day is not None
+
+
+def date_bounds(params, prefix="date"):
+    """
+    Lookups for ``<prefix>_from`` / ``<prefix>_to`` (date or ISO datetime; a
+    ``_to`` date includes that whole day), e.g. ``{"gte": ..., "lt": ...}``.
+    """
+    bounds = {}
+    start, end = f"{prefix}_from", f"{prefix}_to"
+    if params.get(start):
+        bounds["gte"], _ = _parse_moment(start, params[start])
+    if params.get(end):
+        moment, whole_day = _parse_moment(end, params[end])
+        if whole_day:
+            bounds["lt"] = moment + timedelta(days=1)
+        else:
+            bounds["lte"] = moment
+    return bounds
+
+
+class AdminListMixin:
+    """Cursor pagination and whitelisted filters for admin list endpoints."""
+    pagination_class = pagination.KeysetPagination
+    filter_backends = [AdminFilterBackend]
+
+
+class AdminBaseViewSet(AdminListMixin, viewsets.ModelViewSet):
     authentication_classes = [SessionAuthentication]
     permission_classes = [permissions.IsAdminUser]
 
@@ -57,71 +158,272 @@ class IsSuperUser(permissions.BasePermission):
         return bool(request.user and request.user.is_authenticated and request.user.is_superuser)
 
 
-class AdminCategoryViewSet(AdminBaseViewSet):
+class CatalogWriteMixin:
+    """Invalidate the cached menu after a write."""
+
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        catalog.bump_on_commit()
+
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        catalog.bump_on_commit()
+
+    def perform_destroy(self, instance):
+        super().perform_destroy(instance)
+        catalog.bump_on_commit()
+
+
+class CouponWriteMixin:
+    """Recompile the cached coupon rules after a write."""
+
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        coupons.invalidate_on_commit()
+
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        coupons.invalidate_on_commit()
+
+    def perform_destroy(self, instance):
+        super().perform_destroy(instance)
+        coupons.invalidate_on_commit()
+
+
+class AdminCategoryViewSet(CatalogWriteMixin, AdminBaseViewSet):
     queryset = Category.objects.all().order_by("id")
     serializer_class = CategorySerializer
 
 
-class AdminItemViewSet(AdminBaseViewSet):
+class AdminItemViewSet(CatalogWriteMixin, AdminBaseViewSet):
     queryset = Item.objects.select_related("category").all().order_by("id")
     serializer_class = ItemSerializer
+    filterset_fields = ["category", "is_available", "is_combo"]
+
+
+def _items_count():
+    """Order item count as a correlated subquery, evaluated only for the rows on a page."""
+    return Coalesce(
+        Subquery(
+            OrderItem.objects.filter(order=OuterRef("pk"))
+            .order_by()
+            .values("order")
+            .annotate(count=Count("pk"))
+            .values("count"),
+            output_field=models.IntegerField(),
+        ),
+        0,
+    )
 
 
 class AdminOrderViewSet(AdminBaseViewSet):
     queryset = (
-        Order.objects.select_related("user", "address", "coupon")
-        .prefetch_related("items")
+        Order.objects.select_related("user", "address")
+        .annotate(items_count=_items_count())
         .order_by("-created_at")
     )
     serializer_class = OrderSerializer
+    filterset_fields = ["status", "user", "rider", "coupon"]
+    date_filter_field = "created_at"
+    ordering_fields = ["created_at"]
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == "retrieve":
+            queryset = queryset.prefetch_related("items__item")
+        return queryset
 
     def get_serializer_class(self):
         if self.action == "retrieve":
             return OrderDetailSerializer
         return super().get_serializer_class()
 
+    def perform_update(self, serializer):
+        previous_status = serializer.instance.status
+        status = serializer.validated_data.pop("status", previous_status)
+        if status != previous_status and not order_states.can_transition(previous_status, status):
+            raise ValidationError({"status": [f"Cannot move order from {previous_status} to {status}"]})
+
+        with transaction.atomic():
+            order = serializer.save()
+            if status != previous_status:
+                moved = order_states.transition(
+                    order.id,
+                    previous_status,
+                    status,
+                    source="staff",
+                    actor=self.request.user,
+                )
+                if not moved:
+                    raise ValidationError({"status": ["Order status changed, please refresh and retry"]})
+                order.status = status
+                after_status_change(order)
+
+    @action(detail=False, methods=["post"], url_path="bulk-status")
+    def bulk_status(self, request):
+        """
+        Move many orders to one status: ``{"order_ids": [...], "status": "preparing"}``.
+
+        Orders that cannot make the move are listed in ``skipped`` and the
+        rest are still moved. Their pushes go out together from the outbox.
+        """
+        status = request.data.get("status")
+        if status not in dict(Order.STATUS_CHOICES):
+            raise ValidationError({"status": ["Invalid status"]})
+        order_ids = request.data.get("order_ids")
+        limit = getattr(settings, "ADMIN_BULK_STATUS_MAX_ORDERS", 200)
+        try:
+            order_ids = {int(order_id) for order_id in order_ids} if isinstance(order_ids, list) else set()
+        except (TypeError, ValueError):
+            order_ids = set()
+        if not order_ids or len(order_ids) > limit:
+            raise ValidationError({"order_ids": [f"Give a list of 1 to {limit} order ids"]})
+
+        with transaction.atomic():
+            moved, skipped = order_states.transition_many(order_ids, status, source="staff", actor=request.user)
+            for order, _ in moved:
+                after_status_change(order)
+
+        return Response({
+            "status": status,
+            "updated": sorted(order.id for order, _ in moved),
+            "skipped": [{"order_id": order_id, "error": skipped[order_id]} for order_id in sorted(skipped)],
+        })
+
+    @action(detail=True, methods=["get"])
+    def trail(self, request, pk=None):
+        return Response(trails.trail_payload(self.get_object()))
 
-class AdminOrderItemViewSet(viewsets.ReadOnlyModelViewSet):
+
+class AdminOrderItemViewSet(AdminListMixin, viewsets.ReadOnlyModelViewSet):
     authentication_classes = [SessionAuthentication]
     permission_classes = [permissions.IsAdminUser]
-    queryset = OrderItem.objects.select_related("order", "item").all().order_by("-id")
+    queryset = OrderItem.objects.select_related("item").all().order_by("-id")
     serializer_class = OrderItemSerializer
+    filterset_fields = ["order", "item"]
 
 
-class AdminOrderReviewViewSet(viewsets.ReadOnlyModelViewSet):
+class AdminOrderReviewViewSet(AdminListMixin, viewsets.ReadOnlyModelViewSet):
     authentication_classes = [SessionAuthentication]
     permission_classes = [permissions.IsAdminUser]
     queryset = (
-        OrderReview.objects.select_related("order", "user")
+        OrderReview.objects.select_related("user")
         .prefetch_related("item_reviews")
         .order_by("-created_at")
     )
     serializer_class = OrderReviewSerializer
+    filterset_fields = ["user", "order"]
+    date_filter_field = "created_at"
 
 
-class AdminOrderItemReviewViewSet(viewsets.ReadOnlyModelViewSet):
+class AdminOrderItemReviewViewSet(AdminListMixin, viewsets.ReadOnlyModelViewSet):
     authentication_classes = [SessionAuthentication]
     permission_classes = [permissions.IsAdminUser]
-    queryset = OrderItemReview.objects.select_related("review", "order_item").order_by("-created_at")
+    queryset = OrderItemReview.objects.select_related("review").order_by("-created_at")
     serializer_class = OrderItemReviewSerializer
+    filterset_fields = ["review"]
 
 
-class AdminCouponViewSet(AdminBaseViewSet):
+class AdminCouponViewSet(CouponWriteMixin, AdminBaseViewSet):
     queryset = Coupon.objects.all().order_by("-created_at")
     serializer_class = CouponSerializer
+    filterset_fields = ["is_active", "for_first_time_users_only", "unique_codes"]
     permission_classes = [IsSuperUser]
 
+    @action(detail=True, methods=["get", "post"])
+    def codes(self, request, pk=None):
+        """
+        POST ``{"count": n}`` adds n single-use codes to a ``unique_codes``
+        coupon. GET streams its codes as CSV, optionally limited to
+        ``first_serial``..``last_serial`` (e.g. the range a POST returned).
+        """
+        coupon = self.get_object()
+        if not coupon.unique_codes:
+            raise ValidationError({"unique_codes": ["This coupon does not use single-use codes"]})
+
+        if request.method == "POST":
+            limit = getattr(settings, "ADMIN_COUPON_CODES_MAX", 100000)
+            try:
+                count = int(request.data.get("count"))
+            except (TypeError, ValueError):
+                count = 0
+            if not 0 < count <= limit:
+                raise ValidationError({"count": [f"Give a count from 1 to {limit}"]})
+            try:
+                serials = coupon_codes.generate(coupon, count)
+            except ValueError as e:
+                raise ValidationError({"count": [str(e)]})
+            return Response(
+                {"count": count, "first_serial": serials[0], "last_serial": serials[-1]},
+                status=201,
+            )
 
-class AdminUserCouponUsageViewSet(viewsets.ReadOnlyModelViewSet):
+        try:
+            bounds = [
+                int(request.query_params[name]) if request.query_params.get(name) else None
+                for name in ("first_serial", "last_serial")
+            ]
+        except ValueError:
+            raise ValidationError({"serial": ["first_serial and last_serial must be numbers"]})
+        content = coupon_codes.csv_lines(coupon.id, *bounds)
+        if isinstance(request._request, ASGIRequest):
+            content = exports.async_lines(content)
+        response = StreamingHttpResponse(content, content_type="text/csv")
+        response["Content-Disposition"] = f'attachment; filename="{coupon.code}-codes.csv"'
+        return response
+
+
+class AdminUserCouponUsageViewSet(AdminListMixin, viewsets.ReadOnlyModelViewSet):
     authentication_classes = [SessionAuthentication]
     permission_classes = [IsSuperUser]
-    queryset = UserCouponUsage.objects.select_related("user", "coupon", "order").all().order_by("-used_at")
+    queryset = UserCouponUsage.objects.select_related("user", "coupon").all().order_by("-used_at")
     serializer_class = UserCouponUsageSerializer
+    filterset_fields = ["user", "coupon", "order"]
+    date_filter_field = "used_at"
 
 
 class AdminPushTokenViewSet(AdminBaseViewSet):
     queryset = PushToken.objects.select_related("user").all().order_by("-created_at")
     serializer_class = PushTokenSerializer
+    filterset_fields = ["user", "is_active"]
+
+
+class AdminPushCampaignViewSet(AdminBaseViewSet):
+    queryset = PushCampaign.objects.all().order_by("-created_at")
+    serializer_class = PushCampaignSerializer
+    filterset_fields = ["status"]
+    date_filter_field = "created_at"
+
+    def _transition(self, campaign_or_error):
+        campaign, error = campaign_or_error
+        if error:
+            return Response({"error": error}, status=409)
+        return Response(self.get_serializer(campaign).data)
+
+    @action(detail=False, methods=["post"])
+    def preview(self, request):
+        """Number of active devices a ``{"segment": {...}}`` matches right now."""
+        try:
+            audience = campaigns.audience(request.data.get("segment") or {})
+        except ValueError as e:
+            raise ValidationError({"segment": [str(e)]})
+        return Response({"devices": audience.count()})
+
+    @action(detail=True, methods=["post"])
+    def start(self, request, pk=None):
+        return self._transition(campaigns.start(self.get_object()))
+
+    @action(detail=True, methods=["post"])
+    def pause(self, request, pk=None):
+        return self._transition(campaigns.set_status(self.get_object(), ["running"], "paused"))
+
+    @action(detail=True, methods=["post"])
+    def resume(self, request, pk=None):
+        return self._transition(campaigns.set_status(self.get_object(), ["paused"], "running"))
+
+    @action(detail=True, methods=["post"])
+    def cancel(self, request, pk=None):
+        return self._transition(campaigns.set_status(self.get_object(), ["draft", "running", "paused"], "cancelled"))
 
 
 class AdminAppVersionViewSet(AdminBaseViewSet):
@@ -130,21 +432,66 @@ class AdminAppVersionViewSet(AdminBaseViewSet):
 
 
 class AdminUserViewSet(AdminBaseViewSet):
+    """
+    Users with their ``CustomerStats``. Besides ``role``, the list filters on
+    ``order_count_min``/``_max``, ``lifetime_spend_min``/``_max``,
+    ``last_order_from``/``_to`` and ``favorite_category``, and sorts on the
+    stats columns (``?ordering=-customer_stats__lifetime_spend``), which leaves
+    out users without stats.
+    """
     serializer_class = UserSerializer
+    filterset_fields = ["is_active"]
+    date_filter_field = "date_joined"
+    ordering_fields = [
+        "id",
+        "customer_stats__order_count",
+        "customer_stats__lifetime_spend",
+        "customer_stats__last_order_at",
+    ]
+    stats_ranges = {"order_count": models.IntegerField(), "lifetime_spend": models.DecimalField()}
 
     def get_queryset(self):
         role = self.request.query_params.get("role", "all")
-        queryset = User.objects.all().order_by("-date_joined")
+        # Newest first by id: same order as date_joined, but on the primary key index.
+        queryset = User.objects.select_related("customer_stats").order_by("-id")
         if role == "customer":
-            return queryset.filter(is_staff=False)
-        if role == "staff":
-            return queryset.filter(is_staff=True)
+            queryset = queryset.filter(is_staff=False)
+        elif role == "staff":
+            queryset = queryset.filter(is_staff=True)
+        if self.action == "list":
+            queryset = self._filter_stats(queryset)
         return queryset
 
+    def _filter_stats(self, queryset):
+        params = self.request.query_params
+        lookups = {}
+        for name, field in self.stats_ranges.items():
+            for suffix, lookup in (("min", "gte"), ("max", "lte")):
+                raw = params.get(f"{name}_{suffix}")
+                if not raw:
+                    continue
+                try:
+                    lookups[f"customer_stats__{name}__{lookup}"] = field.to_python(raw)
+                except DjangoValidationError:
+                    raise ValidationError({f"{name}_{suffix}": [f"Invalid value: {raw}"]})
+        for lookup, value in date_bounds(params, prefix="last_order").items():
+            lookups[f"customer_stats__last_order_at__{lookup}"] = value
+        if params.get("favorite_category"):
+            try:
+                lookups["customer_stats__favorite_category_id"] = int(params["favorite_category"])
+            except ValueError:
+                raise ValidationError({"favorite_category": ["Give a category id"]})
+        ordering = params.get("ordering", "").lstrip("-")
+        if ordering.startswith("customer_stats__") and ordering in self.ordering_fields:
+            # Keyset pages need a value on every row.
+            lookups[f"{ordering}__isnull"] = False
+        return queryset.filter(**lookups)
+
 
 class AdminAddressViewSet(AdminBaseViewSet):
     queryset = Address.objects.select_related("user").all().order_by("-created_at")
     serializer_class = AddressSerializer
+    filterset_fields = ["user"]
 
 
 class AdminStaffViewSet(viewsets.ViewSet):
@@ -369,14 +716,44 @@ def admin_change_password(request):
 @authentication_classes([SessionAuthentication])
 @permission_classes([permissions.IsAdminUser])
 def admin_stats(request):
-    total_orders = Order.objects.count()
-    delivered_orders = Order.objects.filter(status="delivered").count()
-    cancelled_orders = Order.objects.filter(status="cancelled").count()
-    total_revenue = (
-        Order.objects.filter(status="delivered")
-        .aggregate(total=models.Sum("total_price"))
-        .get("total")
-        or 0
+    """
+    Dashboard totals plus a per-bucket series, read from the order rollups.
+
+    ``date_from`` / ``date_to`` (YYYY-MM-DD, inclusive, in ROLLUP_TIME_ZONE)
+    bound both. Without them the totals cover all time and the series the
+    last 30 days (2 days at ``granularity=hour``; the default is ``day``).
+    """
+    granularity = request.query_params.get("granularity", "day")
+    if granularity not in rollups.GRANULARITIES:
+        return Response({"error": "granularity must be 'hour' or 'day'"}, status=400)
+
+    days = {}
+    for name in ("date_from", "date_to"):
+        raw = request.query_params.get(name)
+        try:
+            days[name] = parse_date(raw) if raw else None
+        except ValueError:
+            days[name] = None
+        if raw and days[name] is None:
+            return Response({"error": f"{name} must be YYYY-MM-DD"}, status=400)
+    date_from, date_to = days["date_from"], days["date_to"]
+
+    series_to = date_to or timezone.now().astimezone(rollups.rollup_tz()).date()
+    series_from = date_from or series_to - timedelta(days=29 if granularity == "day" else 1)
+    if series_from > series_to:
+        return Response({"error": "date_from must not be after date_to"}, status=400)
+    if granularity == "hour" and (series_to - series_from).days >= rollups.MAX_HOURLY_DAYS:
+        return Response({"error": f"Hourly stats cover at most {rollups.MAX_HOURLY_DAYS} days"}, status=400)
+
+    one_day = timedelta(days=1)
+    totals = rollups.totals(
+        rollups.day_start(date_from) if date_from else None,
+        rollups.day_start(date_to + one_day) if date_to else None,
+    )
+    series = rollups.series(
+        rollups.day_start(series_from),
+        rollups.day_start(series_to + one_day),
+        granularity,
     )
 
     recent_orders = (
@@ -385,12 +762,13 @@ def admin_stats(request):
     )
 
     return Response({
-        "totals": {
-            "orders": total_orders,
-            "delivered": delivered_orders,
-            "cancelled": cancelled_orders,
-            "revenue": float(total_revenue),
+        "totals": totals,
+        "range": {
+            "from": series_from.isoformat(),
+            "to": series_to.isoformat(),
+            "granularity": granularity,
         },
+        "series": series,
         "recent_orders": [
             {
                 "id": order.id,
@@ -404,18 +782,79 @@ def admin_stats(request):
     })
 
 
-class AdminSupportTicketViewSet(viewsets.ModelViewSet):
+@api_view(["GET"])
+@authentication_classes([SessionAuthentication])
+@permission_classes([permissions.IsAdminUser])
+def admin_export(request, dataset, export_format):
+    """Stream a whole dataset as CSV or NDJSON, optionally bounded by date_from / date_to."""
+    spec = exports.DATASETS.get(dataset)
+    if spec is None or export_format not in exports.FORMATS:
+        return Response({"error": "Unknown export."}, status=404)
+    if spec.get("superuser_only") and not request.user.is_superuser:
+        return Response({"error": "Only superusers can export this data."}, status=403)
+
+    bounds = date_bounds(request.query_params)
+    content = exports.lines(dataset, export_format, bounds)
+    if isinstance(request._request, ASGIRequest):
+        content = exports.async_lines(content)
+
+    content_type, _ = exports.FORMATS[export_format]
+    response = StreamingHttpResponse(content, content_type=content_type)
+    response["Content-Disposition"] = f'attachment; filename="{dataset}.{export_format}"'
+    return response
+
+
+@api_view(["POST"])
+@authentication_classes([SessionAuthentication])
+@permission_classes([permissions.IsAdminUser])
+def admin_menu_import(request):
+    """
+    Bulk-import categories, items and combo compositions (see ``menu_import``).
+
+    Send JSON ``{"categories": [...], "items": [...], "combos": [...]}`` or
+    multipart CSV files under those names. ``?dry_run=1`` only reports the
+    changes. Returns 400 with the report when any row is invalid.
+    """
+    data = {}
+    try:
+        for kind in menu_import.KINDS:
+            if kind in request.FILES:
+                data[kind] = menu_import.read_csv(request.FILES[kind])
+            elif isinstance(request.data.get(kind), list):
+                data[kind] = request.data[kind]
+    except (UnicodeDecodeError, csv.Error):
+        return Response({"error": "CSV files must be UTF-8."}, status=400)
+    if not data:
+        return Response({"error": "Send categories, items and/or combos."}, status=400)
+
+    dry_run = request.query_params.get("dry_run", "").strip().lower() in {"1", "true", "yes", "on"}
+    report = menu_import.import_menu(data, dry_run=dry_run)
+    return Response(report, status=400 if report["errors"] else 200)
+
+
+@api_view(["GET", "DELETE"])
+@authentication_classes([SessionAuthentication])
+@permission_classes([permissions.IsAdminUser])
+def admin_rider_location_stats(request):
+    """Accepted vs coalesced rider GPS fixes. DELETE resets the counters."""
+    if request.method == "DELETE":
+        rider_location.reset_write_stats()
+    return Response(rider_location.get_write_stats())
+
+
+class AdminSupportTicketViewSet(AdminListMixin, viewsets.ModelViewSet):
     queryset = SupportTicket.objects.select_related("user").prefetch_related("messages")
     serializer_class = SupportTicketSerializer
     authentication_classes = [SessionAuthentication]
     permission_classes = [permissions.IsAdminUser]
-    filterset_fields = ["status", "priority", "category"]
+    filterset_fields = ["status", "priority", "category", "user"]
+    date_filter_field = "created_at"
     ordering_fields = ["created_at", "priority"]
     ordering = ["-created_at"]
 
 
-class AdminSupportMessageViewSet(viewsets.ModelViewSet):
-    queryset = SupportMessage.objects.select_related("ticket")
+class AdminSupportMessageViewSet(AdminListMixin, viewsets.ModelViewSet):
+    queryset = SupportMessage.objects.all()
     serializer_class = SupportMessageSerializer
     authentication_classes = [SessionAuthentication]
     permission_classes = [permissions.IsAdminUser]
@@ -1,16 +1,19 @@
 from django.contrib.auth.models import User
 from rest_framework import serializers
 
+from . import campaigns
 from .models import (
     Address,
     AppVersion,
     Category,
     Coupon,
+    CustomerStats,
     Item,
     Order,
     OrderItem,
     OrderItemReview,
     OrderReview,
+    PushCampaign,
     PushToken,
     UserCouponUsage,
     SupportTicket,
@@ -43,6 +46,10 @@ class ItemSerializer(serializers.ModelSerializer):
             "image_url",
             "is_available",
             "is_combo",
+            "rating_count",
+            "average_rating",
+            "recent_rating_count",
+            "recent_average_rating",
         )
 
     def get_image_url(self, obj):
@@ -97,7 +104,7 @@ class OrderItemSerializer(serializers.ModelSerializer):
 
 class OrderSerializer(serializers.ModelSerializer):
     user_name = serializers.CharField(source="user.username", read_only=True)
-    items_count = serializers.IntegerField(source="items.count", read_only=True)
+    items_count = serializers.SerializerMethodField()
     address_display = serializers.SerializerMethodField()
 
     class Meta:
@@ -140,6 +147,11 @@ class OrderSerializer(serializers.ModelSerializer):
             "items_count",
         )
 
+    def get_items_count(self, obj):
+        # Annotated by AdminOrderViewSet; counted directly for a freshly created order.
+        items_count = getattr(obj, "items_count", None)
+        return obj.items.count() if items_count is None else items_count
+
     def get_address_display(self, obj):
         if not obj.address:
             return None
@@ -200,6 +212,58 @@ class PushTokenSerializer(serializers.ModelSerializer):
         )
 
 
+class PushCampaignSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = PushCampaign
+        fields = (
+            "id",
+            "name",
+            "title",
+            "body",
+            "data",
+            "segment",
+            "status",
+            "rate_per_minute",
+            "total_recipients",
+            "sent_count",
+            "failed_count",
+            "created_at",
+            "started_at",
+            "finished_at",
+        )
+        read_only_fields = (
+            "status",
+            "total_recipients",
+            "sent_count",
+            "failed_count",
+            "created_at",
+            "started_at",
+            "finished_at",
+        )
+
+    def validate_segment(self, value):
+        try:
+            campaigns.compile_segment(value)
+        except ValueError as e:
+            raise serializers.ValidationError(str(e))
+        return value
+
+    def validate_data(self, value):
+        if not isinstance(value, dict):
+            raise serializers.ValidationError("Must be an object")
+        return value
+
+    def validate_rate_per_minute(self, value):
+        if value < 1:
+            raise serializers.ValidationError("Must be at least 1")
+        return value
+
+    def validate(self, attrs):
+        if self.instance and self.instance.status != "draft" and "segment" in attrs:
+            raise serializers.ValidationError({"segment": ["Only a draft campaign's segment can change"]})
+        return attrs
+
+
 class AppVersionSerializer(serializers.ModelSerializer):
     class Meta:
         model = AppVersion
@@ -207,13 +271,14 @@ class AppVersionSerializer(serializers.ModelSerializer):
 
 
 class OrderItemReviewSerializer(serializers.ModelSerializer):
-    order_id = serializers.IntegerField(source="review.order.id", read_only=True)
+    order_id = serializers.IntegerField(source="review.order_id", read_only=True)
 
     class Meta:
         model = OrderItemReview
         fields = (
             "id",
             "order_id",
+            "item",
             "item_name",
             "rating",
             "created_at",
@@ -222,7 +287,7 @@ class OrderItemReviewSerializer(serializers.ModelSerializer):
 
 
 class OrderReviewSerializer(serializers.ModelSerializer):
-    order_id = serializers.IntegerField(source="order.id", read_only=True)
+    order_id = serializers.IntegerField(read_only=True)
     user_name = serializers.CharField(source="user.username", read_only=True)
     user_email = serializers.CharField(source="user.email", read_only=True)
     item_reviews = OrderItemReviewSerializer(many=True, read_only=True)
@@ -245,7 +310,24 @@ class OrderReviewSerializer(serializers.ModelSerializer):
         read_only_fields = fields
 
 
+class CustomerStatsSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CustomerStats
+        fields = (
+            "order_count",
+            "delivered_count",
+            "lifetime_spend",
+            "last_order_at",
+            "favorite_category",
+            "rating_count",
+            "average_rating",
+            "updated_at",
+        )
+
+
 class UserSerializer(serializers.ModelSerializer):
+    stats = serializers.SerializerMethodField()
+
     class Meta:
         model = User
         fields = (
@@ -259,8 +341,15 @@ class UserSerializer(serializers.ModelSerializer):
             "is_superuser",
             "date_joined",
             "last_login",
+            "stats",
         )
 
+    def get_stats(self, obj):
+        try:
+            return CustomerStatsSerializer(obj.customer_stats).data
+        except CustomerStats.DoesNotExist:
+            return None
+
 
 class SupportMessageSerializer(serializers.ModelSerializer):
     class Meta:
@@ -8,6 +8,9 @@ from .admin_api import (
     admin_me,
     admin_change_password,
     admin_stats,
+    admin_export,
+    admin_menu_import,
+    admin_rider_location_stats,
     AdminAddressViewSet,
     AdminAppVersionViewSet,
     AdminCategoryViewSet,
@@ -17,6 +20,7 @@ from .admin_api import (
     AdminOrderItemViewSet,
     AdminOrderReviewViewSet,
     AdminOrderViewSet,
+    AdminPushCampaignViewSet,
     AdminPushTokenViewSet,
     AdminSupportMessageViewSet,
     AdminSupportTicketViewSet,
@@ -35,6 +39,7 @@ admin_router.register(r"item-reviews", AdminOrderItemReviewViewSet, basename="ad
 admin_router.register(r"coupons", AdminCouponViewSet, basename="admin-coupons")
 admin_router.register(r"coupon-usage", AdminUserCouponUsageViewSet, basename="admin-coupon-usage")
 admin_router.register(r"push-tokens", AdminPushTokenViewSet, basename="admin-push-tokens")
+admin_router.register(r"push-campaigns", AdminPushCampaignViewSet, basename="admin-push-campaigns")
 admin_router.register(r"app-versions", AdminAppVersionViewSet, basename="admin-app-versions")
 admin_router.register(r"users", AdminUserViewSet, basename="admin-users")
 admin_router.register(r"addresses", AdminAddressViewSet, basename="admin-addresses")
@@ -42,6 +47,7 @@ admin_router.register(r"support-tickets", AdminSupportTicketViewSet, basename="a
 admin_router.register(r"support-messages", AdminSupportMessageViewSet, basename="admin-support-messages")
 admin_router.register(r"staff", AdminStaffViewSet, basename="admin-staff")
 
+# Mounted at /admin/ by food/urls.py and at /api/admin/ by foodbackend/urls.py.
 urlpatterns = [
     path("csrf/", admin_csrf, name="admin_csrf"),
     path("login/", admin_login, name="admin_login"),
@@ -49,5 +55,8 @@ urlpatterns = [
     path("me/", admin_me, name="admin_me"),
     path("change-password/", admin_change_password, name="admin_change_password"),
     path("stats/", admin_stats, name="admin_stats"),
+    path("stats/rider-locations/", admin_rider_location_stats, name="admin_rider_location_stats"),
+    path("exports/<slug:dataset>.<slug:export_format>", admin_export, name="admin_export"),
+    path("menu/import/", admin_menu_import, name="admin_menu_import"),
     path("", include(admin_router.urls)),
 ]
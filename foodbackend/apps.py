@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class FoodbackendConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'foodbackend'
+
+    def ready(self):
+        from . import checks  # noqa: F401 (registers the deployment checks)
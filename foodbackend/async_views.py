@@ -0,0 +1,264 @@
+"""
+Async versions of the I/O-bound endpoints, for the ASGI deployment profile.
+
+With ``ASYNC_IO_VIEWS`` enabled (the ``uvicorn`` profile in
+``gunicorn_config.py`` turns it on), ``urls.py`` routes ``send_otp``,
+``get_addresses``, ``create_razorpay_order`` and ``verify_razorpay_payment``
+here. Outbound calls to Fast2SMS, Google Geocoding, Razorpay and Expo use a
+pooled ``httpx.AsyncClient``, so a worker keeps serving other requests while
+one waits on a third party. Business rules are shared with the sync views.
+
+DRF views are sync-only, so these are plain Django async views. ``_api``
+wraps each request in a DRF ``Request`` with the project's authenticators
+and parsers, checks the view's permission classes and parses the body off
+the event loop, and renders DRF's errors the way ``api_view`` would.
+"""
+import asyncio
+import hashlib
+import hmac
+import weakref
+from functools import wraps
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from rest_framework import exceptions
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from .models import OTP, Address
+from .views import (
+    FAST2SMS_URL,
+    RAZORPAY_KEY_ID,
+    RAZORPAY_KEY_SECRET,
+    _address_payload,
+    _create_paid_order,
+    _fast2sms_params,
+    _fast2sms_result,
+    _generate_login_otp,
+    _geocode_result,
+    _get_restaurant_coords,
+    _is_valid_mobile,
+)
+
+RAZORPAY_ORDERS_URL = "https://api.razorpay.com/v1/orders"
+GEOCODE_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+
+_clients = weakref.WeakKeyDictionary()
+
+
+def _http():
+    """Shared AsyncClient for the running event loop (one pool per worker)."""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=10,
+            limits=httpx.Limits(
+                max_connections=getattr(settings, "ASYNC_HTTP_MAX_CONNECTIONS", 100),
+                max_keepalive_connections=20,
+            ),
+        )
+        _clients[loop] = client
+    return client
+
+
+def _initial(request, permission_classes):
+    """Authenticate, check permissions and parse the body, as ``APIView.initial`` does."""
+    for permission in permission_classes:
+        if not permission().has_permission(request, None):
+            if request.authenticators and not request.successful_authenticator:
+                raise exceptions.NotAuthenticated()
+            raise exceptions.PermissionDenied()
+    if request.method in ("POST", "PUT", "PATCH"):
+        request.data  # noqa: B018 (parsed here, off the event loop)
+
+
+def _api(methods, permission_classes=()):
+    """The async counterpart of ``@api_view(methods)`` plus ``@permission_classes``."""
+    def decorator(view):
+        @wraps(view)
+        async def wrapped(request, *args, **kwargs):
+            if request.method not in methods:
+                return JsonResponse({"detail": f'Method "{request.method}" not allowed.'}, status=405)
+            request = Request(
+                request,
+                parsers=[parser() for parser in api_settings.DEFAULT_PARSER_CLASSES],
+                authenticators=[auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES],
+            )
+            try:
+                await sync_to_async(_initial)(request, permission_classes)
+            except exceptions.APIException as exc:
+                data = exc.detail if isinstance(exc.detail, dict) else {"detail": exc.detail}
+                response = JsonResponse(data, status=exc.status_code)
+                if isinstance(exc, (exceptions.NotAuthenticated, exceptions.AuthenticationFailed)):
+                    response["WWW-Authenticate"] = request.authenticators[0].authenticate_header(request)
+                return response
+            return await view(request, *args, **kwargs)
+
+        # JWT-authenticated, like the DRF views.
+        wrapped.csrf_exempt = True
+        return wrapped
+    return decorator
+
+
+def _error(message, status):
+    return JsonResponse({"error": message}, status=status)
+
+
+async def _send_fast2sms_otp(mobile, otp):
+    params, error = _fast2sms_params(mobile, otp)
+    if params is None:
+        return error is None, error
+
+    try:
+        response = await _http().get(FAST2SMS_URL, params=params)
+        return _fast2sms_result(
+            response.status_code,
+            response.text or "",
+            response.json() if response.content else {},
+        )
+    except Exception as e:
+        return False, f"Fast2SMS error: {str(e)}"
+
+
+async def _geocode_address(full_address):
+    google_api_key = getattr(settings, "GOOGLE_GEOCODING_API_KEY", None)
+    if not full_address or not google_api_key:
+        return None, None
+
+    try:
+        response = await _http().get(
+            GEOCODE_URL,
+            params={"address": full_address, "key": google_api_key},
+            timeout=5,
+        )
+        return _geocode_result(response.json())
+    except Exception as e:
+        print(f"Geocoding error: {e}")
+    return None, None
+
+
+@_api(["POST"])
+async def send_otp(request):
+    mobile = request.data.get("mobile")
+    if not _is_valid_mobile(mobile):
+        return _error("Valid 10-digit mobile is required", 400)
+
+    otp = _generate_login_otp()
+
+    await OTP.objects.filter(mobile=mobile).adelete()
+    await OTP.objects.acreate(mobile=mobile, otp=otp)
+
+    sent, error = await _send_fast2sms_otp(mobile, otp)
+    if not sent:
+        await OTP.objects.filter(mobile=mobile, otp=otp).adelete()
+        return _error(error, 500)
+
+    return JsonResponse({"message": "OTP sent"})
+
+
+@_api(["GET"], permission_classes=[IsAuthenticated])
+async def get_addresses(request):
+    addresses = [addr async for addr in Address.objects.filter(user=request.user)]
+
+    # Geocode every address that is missing coordinates concurrently.
+    missing = [addr for addr in addresses if not addr.latitude or not addr.longitude]
+    if missing:
+        results = await asyncio.gather(*(_geocode_address(addr.full_address) for addr in missing))
+        geocoded = []
+        for addr, (lat, lng) in zip(missing, results):
+            if lat and lng:
+                addr.latitude = lat
+                addr.longitude = lng
+                geocoded.append(addr)
+        if geocoded:
+            await Address.objects.abulk_update(geocoded, ["latitude", "longitude"])
+
+    restaurant_lat, restaurant_lng = _get_restaurant_coords()
+    return JsonResponse({
+        "addresses": [_address_payload(addr, restaurant_lat, restaurant_lng) for addr in addresses]
+    })
+
+
+@_api(["POST"], permission_classes=[IsAuthenticated])
+async def create_razorpay_order(request):
+    """Create a Razorpay order for payment"""
+    amount = request.data.get("amount")  # Amount in rupees
+    if not amount:
+        return _error("Amount is required", 400)
+
+    try:
+        response = await _http().post(
+            RAZORPAY_ORDERS_URL,
+            auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET),
+            json={
+                "amount": int(float(amount) * 100),  # paise
+                "currency": "INR",
+                "payment_capture": 1,  # Auto capture
+            },
+        )
+        razorpay_order = response.json()
+        if response.status_code != 200:
+            error = razorpay_order.get("error", {}).get("description") or f"HTTP {response.status_code}"
+            return _error(f"Failed to create Razorpay order: {error}", 500)
+
+        return JsonResponse({
+            "order_id": razorpay_order['id'],
+            "amount": razorpay_order['amount'],
+            "currency": razorpay_order['currency'],
+            "key_id": RAZORPAY_KEY_ID,
+        })
+    except Exception as e:
+        return _error(f"Failed to create Razorpay order: {str(e)}", 500)
+
+
+def _razorpay_signature_valid(razorpay_order_id, razorpay_payment_id, razorpay_signature):
+    """Same check as razorpay.Utility.verify_payment_signature, without the SDK's client."""
+    expected = hmac.new(
+        RAZORPAY_KEY_SECRET.encode(),
+        f"{razorpay_order_id}|{razorpay_payment_id}".encode(),
+        hashlib.sha256,
+    ).hexdigest()
+    return hmac.compare_digest(expected, str(razorpay_signature))
+
+
+@_api(["POST"], permission_classes=[IsAuthenticated])
+async def verify_razorpay_payment(request):
+    """Verify Razorpay payment signature and complete order"""
+    user = request.user
+    data = request.data
+    razorpay_order_id = data.get("razorpay_order_id")
+    razorpay_payment_id = data.get("razorpay_payment_id")
+    razorpay_signature = data.get("razorpay_signature")
+    address_id = data.get("address_id")
+    delivery_method = data.get("delivery_method", "delivery")
+
+    if not all([razorpay_order_id, razorpay_payment_id, razorpay_signature]):
+        return _error("Missing payment verification data", 400)
+
+    if not _razorpay_signature_valid(razorpay_order_id, razorpay_payment_id, razorpay_signature):
+        return _error("Payment verification failed. Invalid signature.", 400)
+
+    try:
+        # Geocode here so the order transaction below never waits on Google.
+        if delivery_method == "delivery":
+            address = await Address.objects.filter(id=address_id, user=user).afirst()
+            if address and (not address.latitude or not address.longitude):
+                lat, lng = await _geocode_address(address.full_address)
+                if lat and lng:
+                    address.latitude = lat
+                    address.longitude = lng
+                    await address.asave(update_fields=["latitude", "longitude"])
+
+        payload, error, status = await sync_to_async(_create_paid_order)(
+            user, address_id, delivery_method, razorpay_payment_id
+        )
+    except Exception as e:
+        return _error(f"Payment verification error: {str(e)}", 500)
+
+    if error:
+        return _error(error, status)
+    return JsonResponse(payload, status=201)
@@ -0,0 +1,311 @@
+"""
+Segmented push campaigns.
+
+A campaign's ``segment`` is a small JSON rule tree::
+
+    {"all": [
+        {"type": "lapsed", "days": 30},
+        {"any": [
+            {"type": "near_outlet", "km": 3},
+            {"type": "ordered_category", "category": 4, "days": 90},
+        ]},
+        {"not": {"type": "device_type", "device_type": "ios"}},
+    ]}
+
+``compile_segment`` turns it into one filter on ``PushToken``: every rule is an
+``EXISTS`` over the token owner's orders, addresses or stats, so the database
+picks the recipients in a single query and no user list is ever built in
+Python. An empty segment means every active device.
+
+Starting a campaign materializes its recipients with one ``INSERT ... SELECT``
+into ``CampaignRecipient``, which fixes the audience and gives the send a
+stable order. ``dispatch`` (the ``run_push_campaigns`` worker) then reads the
+recipients after ``last_recipient_id`` in keyset chunks of
+``CAMPAIGN_CHUNK_SIZE``, sends each chunk through ``push`` and paces the
+chunks to the campaign's ``rate_per_minute``. Progress and the cursor are saved
+after every chunk, so a paused campaign, or one whose worker died, resumes
+where it stopped. The worker holds the campaign through a lease renewed every
+chunk rather than a row lock, which would keep a transaction open for the
+whole send.
+"""
+import math
+import operator
+import time
+from datetime import timedelta
+from functools import reduce
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Exists, F, FloatField, OuterRef, Q
+from django.db.models.functions import ASin, Cast, Cos, Power, Radians, Sin, Sqrt
+from django.utils import timezone
+
+from . import push
+from .models import Address, CampaignRecipient, CustomerStats, Order, OrderItem, PushCampaign, PushToken
+
+EARTH_RADIUS_KM = 6371
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _positive_number(rule, name, default=None):
+    value = rule.get(name, default)
+    if value is None:
+        return None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"'{name}' must be a number")
+    if value <= 0:
+        raise ValueError(f"'{name}' must be positive")
+    return value
+
+
+def _since(days):
+    return timezone.now() - timedelta(days=days)
+
+
+def _orders():
+    return Order.objects.filter(user_id=OuterRef("user_id")).exclude(status="cancelled")
+
+
+def _lapsed(rule):
+    """Ordered before, but not in the last ``days`` days."""
+    days = _positive_number(rule, "days", 30)
+    return Q(Exists(_orders())) & ~Q(Exists(_orders().filter(created_at__gte=_since(days))))
+
+
+def _first_time(rule):
+    """Never placed an order."""
+    return ~Q(Exists(_orders()))
+
+
+def _ordered_category(rule):
+    """Ordered something from ``category``, optionally within the last ``days`` days."""
+    try:
+        category_id = int(rule["category"])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("'category' must be a category id")
+    order_items = OrderItem.objects.filter(
+        order__user_id=OuterRef("user_id"), item__category_id=category_id
+    ).exclude(order__status="cancelled")
+    days = _positive_number(rule, "days")
+    if days:
+        order_items = order_items.filter(order__created_at__gte=_since(days))
+    return Q(Exists(order_items))
+
+
+def _near_outlet(rule):
+    """Has a saved address within ``km`` of the outlet (the restaurant by default)."""
+    from .views import _get_restaurant_coords
+
+    km = _positive_number(rule, "km", 5)
+    lat, lng = _get_restaurant_coords()
+    if rule.get("lat") is not None or rule.get("lng") is not None:
+        try:
+            lat, lng = float(rule["lat"]), float(rule["lng"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("'lat' and 'lng' must both be numbers")
+
+    # The bounding box can use plain comparisons; the haversine distance only
+    # runs on the addresses inside it.
+    dlat = math.degrees(km / EARTH_RADIUS_KM)
+    dlng = dlat / max(math.cos(math.radians(lat)), 0.01)
+    address_lat = Radians(Cast("latitude", FloatField()))
+    address_lng = Radians(Cast("longitude", FloatField()))
+    haversine = Power(Sin((address_lat - math.radians(lat)) / 2), 2) + math.cos(math.radians(lat)) * Cos(
+        address_lat
+    ) * Power(Sin((address_lng - math.radians(lng)) / 2), 2)
+    addresses = (
+        Address.objects.filter(
+            user_id=OuterRef("user_id"),
+            latitude__range=(lat - dlat, lat + dlat),
+            longitude__range=(lng - dlng, lng + dlng),
+        )
+        .annotate(distance_km=2 * EARTH_RADIUS_KM * ASin(Sqrt(haversine)))
+        .filter(distance_km__lte=km)
+    )
+    return Q(Exists(addresses))
+
+
+def _lifetime_spend(rule):
+    """Delivered orders worth at least ``min`` and/or at most ``max`` in total (see customer_stats.py)."""
+    low, high = _positive_number(rule, "min"), _positive_number(rule, "max")
+    if low is None and high is None:
+        raise ValueError("'min' or 'max' is required")
+    stats = CustomerStats.objects.filter(user_id=OuterRef("user_id"))
+    if low is not None:
+        stats = stats.filter(lifetime_spend__gte=low)
+    if high is not None:
+        stats = stats.filter(lifetime_spend__lte=high)
+    return Q(Exists(stats))
+
+
+def _device_type(rule):
+    device_type = rule.get("device_type")
+    if device_type not in {"ios", "android"}:
+        raise ValueError("'device_type' must be ios or android")
+    return Q(device_type=device_type)
+
+
+RULES = {
+    "lapsed": _lapsed,
+    "first_time": _first_time,
+    "ordered_category": _ordered_category,
+    "near_outlet": _near_outlet,
+    "lifetime_spend": _lifetime_spend,
+    "device_type": _device_type,
+}
+
+
+def compile_segment(segment):
+    """``Q`` on ``PushToken`` for a segment rule tree. Raises ``ValueError`` for an invalid segment."""
+    if not segment:
+        return Q()
+    if not isinstance(segment, dict):
+        raise ValueError("A segment rule must be an object")
+    for combinator, combine in (("all", operator.and_), ("any", operator.or_)):
+        if combinator in segment:
+            rules = segment[combinator]
+            if not isinstance(rules, list) or not rules:
+                raise ValueError(f"'{combinator}' must be a non-empty list of rules")
+            return reduce(combine, (compile_segment(rule) for rule in rules))
+    if "not" in segment:
+        if not segment["not"]:
+            raise ValueError("'not' needs a rule")
+        return ~compile_segment(segment["not"])
+    rule_type = segment.get("type")
+    if rule_type not in RULES:
+        raise ValueError(f"Unknown segment rule: {rule_type!r}")
+    return RULES[rule_type](segment)
+
+
+def audience(segment):
+    """Active ``PushToken`` queryset of a segment."""
+    return PushToken.objects.filter(is_active=True).filter(compile_segment(segment))
+
+
+def materialize(campaign):
+    """Replace the campaign's recipients with the devices its segment matches now. Returns their count."""
+    tokens = audience(campaign.segment).order_by("id").values("push_token")
+    select_sql, params = tokens.query.sql_with_params()
+    table = connection.ops.quote_name(CampaignRecipient._meta.db_table)
+    with transaction.atomic():
+        CampaignRecipient.objects.filter(campaign=campaign).delete()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {table} (campaign_id, push_token) "
+                f"SELECT %s, segment.push_token FROM ({select_sql}) segment",
+                [campaign.id, *params],
+            )
+            return cursor.rowcount
+
+
+def start(campaign):
+    """Fix the audience of a draft campaign and queue it for sending. Returns ``(campaign, error)``."""
+    with transaction.atomic():
+        campaign = PushCampaign.objects.select_for_update().get(pk=campaign.pk)
+        if campaign.status != "draft":
+            return campaign, f"Only draft campaigns can be started (this one is {campaign.status})"
+        campaign.total_recipients = materialize(campaign)
+        campaign.status = "running"
+        campaign.started_at = timezone.now()
+        campaign.save(update_fields=["total_recipients", "status", "started_at"])
+    return campaign, None
+
+
+def set_status(campaign, from_statuses, to_status):
+    """Move the campaign to ``to_status`` if it is in one of ``from_statuses``. Returns ``(campaign, error)``."""
+    changes = {"status": to_status}
+    if to_status in {"completed", "cancelled"}:
+        changes["finished_at"] = timezone.now()
+    if not PushCampaign.objects.filter(pk=campaign.pk, status__in=from_statuses).update(**changes):
+        campaign.refresh_from_db()
+        return campaign, f"Campaign is {campaign.status}, expected {' or '.join(from_statuses)}"
+    campaign.refresh_from_db()
+    return campaign, None
+
+
+def _claim(campaign_id):
+    """Take the lease of a running campaign unless another worker holds it."""
+    now = timezone.now()
+    lease_until = now + timedelta(seconds=_setting("CAMPAIGN_LEASE_SECONDS", 120))
+    claimed = PushCampaign.objects.filter(
+        Q(lease_until__isnull=True) | Q(lease_until__lt=now), pk=campaign_id, status="running"
+    ).update(lease_until=lease_until)
+    return lease_until if claimed else None
+
+
+def claim_next():
+    """The oldest running campaign this worker could lease, with its lease. ``(None, None)`` if there is none."""
+    now = timezone.now()
+    candidates = (
+        PushCampaign.objects.filter(status="running")
+        .filter(Q(lease_until__isnull=True) | Q(lease_until__lt=now))
+        .order_by("created_at")
+        .values_list("id", flat=True)
+    )
+    for campaign_id in candidates[:10]:
+        lease_until = _claim(campaign_id)
+        if lease_until:
+            return PushCampaign.objects.get(pk=campaign_id), lease_until
+    return None, None
+
+
+def _campaign_messages(campaign, tokens):
+    data = {**campaign.data, "type": "campaign", "campaign_id": campaign.id}
+    return push.expo_messages(tokens, campaign.title, campaign.body, data)
+
+
+def dispatch(campaign, lease_until, max_chunks=None):
+    """
+    Send a leased running campaign from its cursor until it completes, is
+    paused or cancelled, or ``max_chunks`` chunks went out. Returns the status
+    it stopped in.
+    """
+    chunk_size = _setting("CAMPAIGN_CHUNK_SIZE", 1000)
+    lease_seconds = _setting("CAMPAIGN_LEASE_SECONDS", 120)
+    interval = 60 / max(campaign.rate_per_minute, 1)
+    next_send = time.monotonic()
+    chunks = 0
+    try:
+        while max_chunks is None or chunks < max_chunks:
+            recipients = list(
+                CampaignRecipient.objects.filter(campaign=campaign, id__gt=campaign.last_recipient_id)
+                .order_by("id")
+                .values_list("id", "push_token")[:chunk_size]
+            )
+            if not recipients:
+                PushCampaign.objects.filter(pk=campaign.pk, status="running").update(
+                    status="completed", finished_at=timezone.now()
+                )
+                print(f"✓ Campaign #{campaign.id} completed: {campaign.sent_count} sent, {campaign.failed_count} failed")
+                break
+
+            time.sleep(max(0, next_send - time.monotonic()))
+            next_send = max(next_send, time.monotonic()) + interval * len(recipients)
+            stats = push.send_messages(_campaign_messages(campaign, [token for _, token in recipients]))
+            chunks += 1
+
+            campaign.last_recipient_id = recipients[-1][0]
+            campaign.sent_count += stats["sent"]
+            campaign.failed_count += stats["failed"]
+            new_lease = timezone.now() + timedelta(seconds=lease_seconds + interval * chunk_size)
+            saved = PushCampaign.objects.filter(pk=campaign.pk, lease_until=lease_until).update(
+                last_recipient_id=campaign.last_recipient_id,
+                sent_count=F("sent_count") + stats["sent"],
+                failed_count=F("failed_count") + stats["failed"],
+                lease_until=new_lease,
+            )
+            if not saved:
+                print(f"Lost the lease on campaign #{campaign.id}, stopping")
+                break
+            lease_until = new_lease
+            if PushCampaign.objects.filter(pk=campaign.pk).values_list("status", flat=True).first() != "running":
+                break
+    finally:
+        PushCampaign.objects.filter(pk=campaign.pk, lease_until=lease_until).update(lease_until=None)
+    campaign.refresh_from_db()
+    return campaign.status
@@ -0,0 +1,45 @@
+"""
+Catalog version for the cached menu payloads.
+
+``home_data`` and ``get_combos`` cache under keys that embed the current
+catalog version, so one ``bump()`` after a menu change makes every menu
+cache miss at once, however many rows changed. Superseded entries are not
+deleted; they age out on their TTL.
+"""
+from django.core.cache import cache
+from django.db import transaction
+
+VERSION_KEY = "catalog:version"
+
+
+def version():
+    value = cache.get(VERSION_KEY)
+    if value is None:
+        cache.add(VERSION_KEY, 1, timeout=None)
+        value = cache.get(VERSION_KEY, 1)
+    return value
+
+
+def cache_key(name):
+    return f"{name}:catalog{version()}"
+
+
+def bump():
+    cache.add(VERSION_KEY, 1, timeout=None)
+    try:
+        return cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, 2, timeout=None)
+        return 2
+
+
+def bump_on_commit():
+    """
+    Bump once the current transaction commits, so readers never re-cache the
+    old menu. Repeated calls in one transaction (e.g. a ``list_editable``
+    save of many rows) still bump only once.
+    """
+    connection = transaction.get_connection()
+    if connection.in_atomic_block and any(entry[1] is bump for entry in connection.run_on_commit):
+        return
+    transaction.on_commit(bump)
@@ -0,0 +1,57 @@
+"""
+Deployment checks.
+
+Rider positions, dispatch offers, rider gateway sessions, the catalog version
+and the compiled coupon rules live in the default cache, and every web worker
+must see the same values. A per-process cache (``LocMemCache``) only works
+with a single worker, so with more than one the default cache must be shared.
+Settings default to the database cache then; Redis
+(``django.core.cache.backends.redis.RedisCache``) works too.
+
+ASGI workers also serve the order streams and the rider WebSocket, whose
+subscribers must see events published by every worker. The ``local`` pub/sub
+broker only reaches its own process, so several ASGI workers need
+``PUBSUB_BACKEND=postgres``.
+
+``gunicorn_config.py`` exports the worker count and profile as
+``GUNICORN_WORKERS`` and ``GUNICORN_WORKER_CLASS`` and calls :func:`ensure_shared_state` before forking, so a misconfigured deploy
+refuses to start. The same problems are reported by ``manage.py check``.
+"""
+from django.conf import settings
+from django.core import checks
+
+PROCESS_LOCAL_CACHES = {
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+}
+
+
+def shared_state_problems(workers=None, worker_class=None):
+    """Reasons the configured backends cannot be shared by ``workers`` processes."""
+    workers = workers if workers is not None else getattr(settings, "WEB_WORKERS", 1)
+    worker_class = worker_class or getattr(settings, "WEB_WORKER_CLASS", "sync")
+    problems = []
+    backend = settings.CACHES["default"]["BACKEND"]
+    if workers > 1 and backend in PROCESS_LOCAL_CACHES:
+        problems.append(
+            f"CACHE_BACKEND is {backend}, which each of the {workers} workers keeps separately. "
+            "Use a shared cache (Redis or django.core.cache.backends.db.DatabaseCache)."
+        )
+    pubsub_backend = getattr(settings, "PUBSUB_BACKEND", "local")
+    if workers > 1 and worker_class == "uvicorn" and pubsub_backend != "postgres":
+        problems.append(
+            f"PUBSUB_BACKEND is {pubsub_backend}, so events published by one of the {workers} ASGI workers "
+            "never reach streams and rider sockets on the others. Use PUBSUB_BACKEND=postgres."
+        )
+    return problems
+
+
+def ensure_shared_state(workers):
+    problems = shared_state_problems(workers)
+    if problems:
+        raise RuntimeError("Refusing to start: " + " ".join(problems))
+
+
+@checks.register(checks.Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    return [checks.Error(problem, id="foodbackend.E001") for problem in shared_state_problems()]
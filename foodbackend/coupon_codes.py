@@ -0,0 +1,181 @@
+"""
+Single-use coupon codes.
+
+A ``unique_codes`` coupon is redeemed with personal codes instead of its
+shared ``code``. A code is never stored: ``CouponCode`` keeps only the
+coupon and a serial number, and the code text is the pair, packed into 48
+bits (20 bits of coupon id, 28 of serial), run through a keyed 4-round
+Feistel permutation and followed by a 12-bit check. That is 60 bits, written
+as 12 Crockford base32 characters (``7KQ2-XM4P-9HRT``).
+
+Because the permutation is a bijection, every ``(coupon, serial)`` gets a
+different code and a batch of any size is collision free without checking the
+table. Because it is keyed, codes do not reveal their neighbours, and the
+check bits reject typos and guesses before the database is touched.
+Redeeming decodes the code back to ``(coupon, serial)``, finds the row through
+the ``(coupon, serial)`` unique index and claims it with one conditional
+UPDATE, so two customers racing for a code cannot both win. Shared coupon
+rows are never locked by code redemptions.
+
+The key comes from ``COUPON_CODE_SECRET`` (``SECRET_KEY`` when unset).
+Changing it invalidates every code already handed out.
+"""
+import hashlib
+import hmac
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .models import Coupon, CouponCode
+
+ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+CODE_LENGTH = 12
+COUPON_BITS = 20
+SERIAL_BITS = 28
+HALF_BITS = 24
+CHECK_BITS = 12
+ROUNDS = 4
+
+MAX_COUPON_ID = (1 << COUPON_BITS) - 1
+MAX_SERIAL = (1 << SERIAL_BITS) - 1
+_HALF_MASK = (1 << HALF_BITS) - 1
+# Crockford base32: read look-alike letters as the digits they resemble.
+_READ_AS = str.maketrans({"O": "0", "I": "1", "L": "1"})
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _key():
+    secret = _setting("COUPON_CODE_SECRET", "") or settings.SECRET_KEY
+    return hashlib.sha256(f"coupon-codes:{secret}".encode()).digest()
+
+
+def _round(key, index, half):
+    digest = hashlib.blake2b(bytes([index]) + half.to_bytes(3, "big"), key=key, digest_size=3).digest()
+    return int.from_bytes(digest, "big")
+
+
+def _permute(value, key):
+    left, right = value >> HALF_BITS, value & _HALF_MASK
+    for index in range(ROUNDS):
+        left, right = right, left ^ _round(key, index, right)
+    return (left << HALF_BITS) | right
+
+
+def _unpermute(value, key):
+    left, right = value >> HALF_BITS, value & _HALF_MASK
+    for index in reversed(range(ROUNDS)):
+        left, right = right ^ _round(key, index, left), left
+    return (left << HALF_BITS) | right
+
+
+def _check(permuted, key):
+    digest = hashlib.blake2b(b"check" + permuted.to_bytes(6, "big"), key=key, digest_size=2).digest()
+    return int.from_bytes(digest, "big") >> (16 - CHECK_BITS)
+
+
+def encode(coupon_id, serial, key=None):
+    if not 0 < coupon_id <= MAX_COUPON_ID or not 0 <= serial <= MAX_SERIAL:
+        raise ValueError("Coupon id or serial out of range for a coupon code")
+    key = key or _key()
+    permuted = _permute((coupon_id << SERIAL_BITS) | serial, key)
+    value = (permuted << CHECK_BITS) | _check(permuted, key)
+    chars = []
+    for _ in range(CODE_LENGTH):
+        chars.append(ALPHABET[value & 31])
+        value >>= 5
+    code = "".join(reversed(chars))
+    return "-".join(code[i:i + 4] for i in range(0, CODE_LENGTH, 4))
+
+
+def normalize(code):
+    return "".join(str(code or "").upper().split()).replace("-", "").translate(_READ_AS)
+
+
+def decode(code, key=None):
+    """``(coupon_id, serial)`` of a code, or ``None`` if it is not one of ours."""
+    code = normalize(code)
+    if len(code) != CODE_LENGTH or any(char not in ALPHABET for char in code):
+        return None
+    value = 0
+    for char in code:
+        value = (value << 5) | ALPHABET.index(char)
+    key = key or _key()
+    permuted, check = value >> CHECK_BITS, value & ((1 << CHECK_BITS) - 1)
+    if not hmac.compare_digest(check.to_bytes(2, "big"), _check(permuted, key).to_bytes(2, "big")):
+        return None
+    plain = _unpermute(permuted, key)
+    coupon_id, serial = plain >> SERIAL_BITS, plain & MAX_SERIAL
+    return (coupon_id, serial) if coupon_id else None
+
+
+def generate(coupon, count):
+    """
+    Add ``count`` codes to a coupon, ``COUPON_CODE_BATCH_SIZE`` rows per
+    INSERT. Returns the serial range; ``csv_lines`` writes the codes out.
+    """
+    if coupon.id > MAX_COUPON_ID:
+        raise ValueError("Coupon id too large for coupon codes")
+    batch_size = _setting("COUPON_CODE_BATCH_SIZE", 5000)
+    with transaction.atomic():
+        # Lock the coupon so concurrent batches cannot hand out the same serials.
+        Coupon.objects.select_for_update().filter(pk=coupon.pk).values_list("pk").get()
+        first = (CouponCode.objects.filter(coupon=coupon).aggregate(last=Max("serial"))["last"] or 0) + 1
+        serials = range(first, first + count)
+        if serials and serials[-1] > MAX_SERIAL:
+            raise ValueError(f"A coupon can have at most {MAX_SERIAL} codes")
+        for start in range(0, count, batch_size):
+            CouponCode.objects.bulk_create(
+                [CouponCode(coupon_id=coupon.id, serial=serial) for serial in serials[start:start + batch_size]],
+                batch_size=batch_size,
+            )
+    return serials
+
+
+def lookup(code):
+    """``(coupon_code, error)`` for a code a customer typed in."""
+    decoded = decode(code)
+    if decoded is None:
+        return None, "Invalid coupon code"
+    coupon_id, serial = decoded
+    coupon_code = CouponCode.objects.select_related("coupon").filter(coupon_id=coupon_id, serial=serial).first()
+    if coupon_code is None or not coupon_code.coupon.unique_codes:
+        return None, "Invalid coupon code"
+    if coupon_code.redeemed_at:
+        return None, "This code has already been used"
+    return coupon_code, None
+
+
+def redeem(coupon_code, user):
+    """Claim a code for ``user``. ``False`` if someone redeemed it first."""
+    return bool(
+        CouponCode.objects.filter(pk=coupon_code.pk, redeemed_at__isnull=True).update(
+            redeemed_by=user, redeemed_at=timezone.now()
+        )
+    )
+
+
+def csv_lines(coupon_id, first_serial=None, last_serial=None):
+    """CSV of a coupon's codes and their redemption, read in keyset chunks of ``EXPORT_CHUNK_SIZE``."""
+    key = _key()
+    rows = CouponCode.objects.filter(coupon_id=coupon_id).order_by("serial")
+    if first_serial is not None:
+        rows = rows.filter(serial__gte=first_serial)
+    if last_serial is not None:
+        rows = rows.filter(serial__lte=last_serial)
+    size = _setting("EXPORT_CHUNK_SIZE", 2000)
+    yield "code,serial,redeemed_at\r\n"
+    last = -1
+    while True:
+        chunk = list(rows.filter(serial__gt=last).values_list("serial", "redeemed_at")[:size])
+        if not chunk:
+            return
+        yield "".join(
+            f"{encode(coupon_id, serial, key)},{serial},{redeemed_at.isoformat() if redeemed_at else ''}\r\n"
+            for serial, redeemed_at in chunk
+        )
+        last = chunk[-1][0]
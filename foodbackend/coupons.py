@@ -0,0 +1,266 @@
+"""
+Coupon eligibility, evaluated in one pass.
+
+``ruleset()`` compiles every live coupon into a plain dict, including the
+payload the coupon list returns and its free item or category. The compiled
+set is cached under a key tied to the catalog version, since free item names
+and prices come from the menu. ``invalidate_on_commit`` drops it after coupon
+writes in the admin. ``used_count`` changes with every order, so it is not
+part of the ruleset: the usage of capped coupons is read fresh, in one query.
+
+``user_facts`` loads what the rules need to know about a customer: how many
+orders they placed, from ``CustomerStats``, and how often they used each
+coupon, from ``UserCouponUsage``. ``Coupon.can_be_used_by_user`` reads the
+same two sources through ``order_count`` and ``coupon_uses``, so the coupon
+list and checkout cannot disagree. ``available_for`` checks every rule
+against the facts in memory, so the coupon list costs the same few queries
+however many promotions are live. ``best_offers`` goes one step further and prices every
+eligible coupon against a cart, loading all the free items involved at once.
+"""
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, transaction
+from django.utils import timezone
+
+from . import catalog
+from .models import ComboItem, Coupon, CustomerStats, Item, Order, UserCouponUsage
+
+RULESET_KEY = "coupons:ruleset:v2"
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _payload(coupon):
+    payload = {
+        'id': coupon.id,
+        'code': coupon.code,
+        'description': coupon.description,
+        'discount_type': coupon.discount_type,
+        'discount_value': float(coupon.discount_value) if coupon.discount_value else None,
+        'min_order_amount': float(coupon.min_order_amount),
+        'max_discount_amount': float(coupon.max_discount_amount) if coupon.max_discount_amount else None,
+        'for_first_time_users_only': coupon.for_first_time_users_only,
+        'valid_until': coupon.valid_until.isoformat() if coupon.valid_until else None,
+    }
+    if coupon.discount_type == 'free_item':
+        if coupon.free_item:
+            payload['free_item'] = {
+                'id': coupon.free_item.id,
+                'name': coupon.free_item.name,
+                'price': float(coupon.free_item.price)
+            }
+        elif coupon.free_item_category:
+            payload['free_item_category'] = {
+                'id': coupon.free_item_category.id,
+                'name': coupon.free_item_category.name
+            }
+    return payload
+
+
+def _compile(coupon):
+    return {
+        "id": coupon.id,
+        "code": coupon.code,
+        "discount_type": coupon.discount_type,
+        "discount_value": coupon.discount_value,
+        "min_order_amount": coupon.min_order_amount,
+        "max_discount_amount": coupon.max_discount_amount,
+        "for_first_time_users_only": coupon.for_first_time_users_only,
+        "max_uses": coupon.max_uses,
+        "max_uses_per_user": coupon.max_uses_per_user,
+        "valid_from": coupon.valid_from,
+        "valid_until": coupon.valid_until,
+        "free_item_id": coupon.free_item_id,
+        "free_item_category_id": coupon.free_item_category_id,
+        "payload": _payload(coupon),
+    }
+
+
+def compile_ruleset():
+    """
+    Compiled rules of the active, unexpired coupons, newest first. Coupons
+    redeemed with single-use codes are left out: only their codes unlock them.
+    """
+    now = timezone.now()
+    coupons = (
+        Coupon.objects.filter(is_active=True, unique_codes=False)
+        .filter(models.Q(valid_until__isnull=True) | models.Q(valid_until__gte=now))
+        .select_related("free_item", "free_item_category")
+        .order_by("-created_at", "-id")
+    )
+    return [_compile(coupon) for coupon in coupons]
+
+
+def ruleset():
+    key = catalog.cache_key(RULESET_KEY)
+    rules = cache.get(key)
+    if rules is None:
+        rules = compile_ruleset()
+        cache.set(key, rules, _setting("COUPON_RULESET_TTL", 300))
+    return rules
+
+
+def invalidate():
+    cache.delete(catalog.cache_key(RULESET_KEY))
+
+
+def invalidate_on_commit():
+    """Drop the compiled ruleset once the current transaction commits, once per transaction."""
+    connection = transaction.get_connection()
+    if connection.in_atomic_block and any(entry[1] is invalidate for entry in connection.run_on_commit):
+        return
+    transaction.on_commit(invalidate)
+
+
+def order_count(user):
+    count = CustomerStats.objects.filter(user=user).values_list("order_count", flat=True).first()
+    if count is None:
+        # No stats yet: a new customer, or stats not rebuilt since a lost update.
+        count = Order.objects.filter(user=user).count()
+    return count
+
+
+def coupon_uses(user, coupon_id=None):
+    """``{coupon_id: uses}`` of the customer's ``UserCouponUsage`` rows, optionally for one coupon."""
+    usage = UserCouponUsage.objects.filter(user=user)
+    if coupon_id is not None:
+        usage = usage.filter(coupon_id=coupon_id)
+    return dict(usage.order_by().values_list("coupon_id").annotate(uses=models.Count("id")))
+
+
+def user_facts(user):
+    """``{"order_count", "coupon_uses"}`` for a customer."""
+    return {"order_count": order_count(user), "coupon_uses": coupon_uses(user)}
+
+
+def usage_counts(rules):
+    """Current ``used_count`` of the capped coupons among ``rules``."""
+    capped = [rule["id"] for rule in rules if rule["max_uses"]]
+    if not capped:
+        return {}
+    return dict(Coupon.objects.filter(id__in=capped).values_list("id", "used_count"))
+
+
+def check(rule, facts, used_count=0, now=None):
+    """``(ok, message)`` for one compiled rule, with the messages of ``Coupon.is_valid``/``can_be_used_by_user``."""
+    now = now or timezone.now()
+    if now < rule["valid_from"]:
+        return False, "Coupon is not yet valid"
+    if rule["valid_until"] and now > rule["valid_until"]:
+        return False, "Coupon has expired"
+    if rule["max_uses"] and used_count >= rule["max_uses"]:
+        return False, "Coupon usage limit reached"
+    if rule["for_first_time_users_only"] and facts["order_count"] > 0:
+        return False, "Coupon is only for first-time users"
+    if rule["max_uses_per_user"] and facts["coupon_uses"].get(rule["id"], 0) >= rule["max_uses_per_user"]:
+        return False, "You have already used this coupon"
+    return True, "Eligible"
+
+
+def available_for(user):
+    """Compiled rules of the coupons ``user`` can use right now."""
+    rules = ruleset()
+    facts = user_facts(user)
+    used = usage_counts(rules)
+    now = timezone.now()
+    return [rule for rule in rules if check(rule, facts, used.get(rule["id"], 0), now)[0]]
+
+
+def _free_choices(rules):
+    """
+    ``(items, categories)``: the effective price of each fixed free item, and
+    the priciest item a customer could pick in each free category, for ``rules``.
+    """
+    item_ids = {rule["free_item_id"] for rule in rules if rule["free_item_id"]}
+    category_ids = {
+        rule["free_item_category_id"] for rule in rules if not rule["free_item_id"] and rule["free_item_category_id"]
+    }
+    if not item_ids and not category_ids:
+        return {}, {}
+    candidates = Item.objects.filter(
+        models.Q(id__in=item_ids) | models.Q(category_id__in=category_ids, is_available=True, is_combo=False)
+    ).prefetch_related(
+        models.Prefetch("combo_links", queryset=ComboItem.objects.select_related("item"), to_attr="prefetched_combo_links")
+    )
+    items, categories = {}, {}
+    for item in candidates:
+        price = item.get_effective_price()
+        if item.id in item_ids:
+            items[item.id] = (item, price)
+        if item.category_id in category_ids and item.is_available and not item.is_combo:
+            best = categories.get(item.category_id)
+            if best is None or (price, -item.id) > (best[1], -best[0].id):
+                categories[item.category_id] = (item, price)
+    return items, categories
+
+
+def discount(rule, subtotal, free_choice=None):
+    """The discount ``rule`` gives on ``subtotal``, the way ``checkout`` computes it."""
+    if rule["discount_type"] == 'percentage':
+        amount = (subtotal * (rule["discount_value"] or 0)) / Decimal('100')
+        if rule["max_discount_amount"]:
+            amount = min(amount, rule["max_discount_amount"])
+        return amount
+    if rule["discount_type"] == 'fixed':
+        return min(rule["discount_value"] or Decimal('0.00'), subtotal)
+    if rule["discount_type"] == 'free_item' and free_choice:
+        return free_choice[1]
+    return Decimal('0.00')
+
+
+def best_offers(user, subtotal):
+    """
+    Price every coupon ``user`` can use against a cart ``subtotal``.
+
+    Returns ``(offers, out_of_reach)``: the applicable coupons with their
+    discount, best first, and the eligible coupons the cart is still too small
+    for, with the amount missing.
+    """
+    rules = ruleset()
+    facts = user_facts(user)
+    used = usage_counts(rules)
+    now = timezone.now()
+
+    applicable, out_of_reach = [], []
+    for rule in rules:
+        if not check(rule, facts, used.get(rule["id"], 0), now)[0]:
+            continue
+        if subtotal < rule["min_order_amount"]:
+            out_of_reach.append({
+                **rule["payload"],
+                "amount_needed": float(rule["min_order_amount"] - subtotal),
+            })
+            continue
+        applicable.append(rule)
+
+    items, categories = _free_choices([rule for rule in applicable if rule["discount_type"] == 'free_item'])
+    offers = []
+    for rule in applicable:
+        offer = {**rule["payload"], "free_item_selection_required": False}
+        free_choice = None
+        if rule["discount_type"] == 'free_item':
+            if rule["free_item_id"]:
+                free_choice = items.get(rule["free_item_id"])
+            elif rule["free_item_category_id"]:
+                free_choice = categories.get(rule["free_item_category_id"])
+                offer["free_item_selection_required"] = True
+            if free_choice is None:
+                continue
+            offer["selected_item"] = {
+                "id": free_choice[0].id,
+                "name": free_choice[0].name,
+                "price": float(free_choice[1]),
+            }
+        amount = discount(rule, subtotal, free_choice).quantize(Decimal('0.01'))
+        if amount <= 0:
+            continue
+        offer["discount_amount"] = float(amount)
+        offers.append((amount, offer))
+
+    offers.sort(key=lambda pair: (-pair[0], pair[1]["id"]))
+    out_of_reach.sort(key=lambda offer: offer["amount_needed"])
+    return [offer for _, offer in offers], out_of_reach
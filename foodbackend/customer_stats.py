@@ -0,0 +1,222 @@
+"""
+Per-customer stats.
+
+``CustomerStats`` holds one row per customer who has ordered: order and
+delivered counts, lifetime spend (the total of delivered orders), the last
+order time, the favorite category (most items delivered) and the ratings they
+gave. Coupon eligibility, campaign segments and the admin user list read it
+instead of aggregating ``Order``.
+
+``order_states`` reports placed orders and moves into or out of ``delivered``
+here. Like the rollups, the counters are applied after the order's
+transaction commits, as one ``INSERT ... ON CONFLICT DO UPDATE`` of deltas.
+The favorite category and the rating figures are recomputed for the affected
+customers only, from their own delivered items and reviews. A delta lost to a
+crash between commit and apply is repaired with
+``python manage.py rebuild_customer_stats``; the migration that adds the
+table runs the same rebuild, so existing customers start with their history.
+"""
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.db.models import Count, Max, Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import CustomerStats, Order, OrderItem, OrderReview
+
+COUNTERS = ("order_count", "delivered_count", "lifetime_spend")
+
+
+def _merge(rows):
+    """Sum deltas per customer; one INSERT may not touch a row twice."""
+    merged = {}
+    for user_id, orders, delivered, spend, last_order_at in rows:
+        if user_id in merged:
+            previous = merged[user_id]
+            orders, delivered, spend = previous[0] + orders, previous[1] + delivered, previous[2] + spend
+            if previous[3] and (not last_order_at or previous[3] > last_order_at):
+                last_order_at = previous[3]
+        merged[user_id] = (orders, delivered, spend, last_order_at)
+    return [(user_id, *values) for user_id, values in merged.items()]
+
+
+def _apply(rows):
+    """Add each ``(user_id, orders, delivered, spend, last_order_at)`` delta."""
+    rows = _merge(rows)
+    if not rows:
+        return
+    ops = connection.ops
+    table = ops.quote_name(CustomerStats._meta.db_table)
+    now = ops.adapt_datetimefield_value(timezone.now())
+    params = []
+    for user_id, orders, delivered, spend, last_order_at in rows:
+        params += [
+            user_id,
+            orders,
+            delivered,
+            ops.adapt_decimalfield_value(spend, 14, 2),
+            ops.adapt_datetimefield_value(last_order_at),
+            now,
+        ]
+    placeholders = ", ".join(["(%s, %s, %s, %s, %s, 0, 0, %s)"] * len(rows))
+    updates = ", ".join(f"{name} = {table}.{name} + EXCLUDED.{name}" for name in COUNTERS)
+    sql = (
+        f"INSERT INTO {table} (user_id, {', '.join(COUNTERS)}, last_order_at, rating_count, rating_sum, updated_at) "
+        f"VALUES {placeholders} "
+        f"ON CONFLICT (user_id) DO UPDATE SET {updates}, "
+        f"last_order_at = CASE WHEN {table}.last_order_at IS NULL OR EXCLUDED.last_order_at > {table}.last_order_at "
+        f"THEN EXCLUDED.last_order_at ELSE {table}.last_order_at END, "
+        f"updated_at = EXCLUDED.updated_at"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+def _delivery_delta(order, sign):
+    return (order["user_id"], 0, sign, sign * Decimal(order["total_price"] or 0), None)
+
+
+def order_placed_on_commit(order):
+    row = (order.user_id, 1, 0, Decimal(0), order.created_at)
+    delivered = order.status == "delivered"
+    values = {"user_id": order.user_id, "total_price": order.total_price}
+
+    def apply():
+        _apply([row, _delivery_delta(values, 1)] if delivered else [row])
+        if delivered:
+            refresh_favorites([order.user_id])
+
+    transaction.on_commit(lambda: _safely(apply))
+
+
+def statuses_changed_on_commit(changes, to_status):
+    """Account for ``(order_id, from_status)`` pairs that moved to ``to_status``."""
+    changes = {
+        order_id: from_status
+        for order_id, from_status in dict(changes).items()
+        if from_status != to_status and "delivered" in (from_status, to_status)
+    }
+    if changes:
+        transaction.on_commit(lambda: _safely(_statuses_changed, changes, to_status))
+
+
+def status_changed_on_commit(order_id, from_status, to_status):
+    statuses_changed_on_commit([(order_id, from_status)], to_status)
+
+
+def _statuses_changed(changes, to_status):
+    sign = 1 if to_status == "delivered" else -1
+    orders = list(Order.objects.filter(id__in=changes).values("user_id", "total_price"))
+    _apply([_delivery_delta(order, sign) for order in orders])
+    refresh_favorites({order["user_id"] for order in orders})
+
+
+def reviews_changed_on_commit(user_id):
+    transaction.on_commit(lambda: _safely(refresh_ratings, [user_id]))
+
+
+def _safely(func, *args):
+    try:
+        func(*args)
+    except Exception as e:
+        print(f"Customer stats update failed: {e}")
+
+
+def _favorites(user_ids=None, order_item_model=OrderItem):
+    """``{user_id: category_id}`` of the category each customer had most items delivered from."""
+    items = order_item_model.objects.filter(order__status="delivered", item__isnull=False)
+    if user_ids is not None:
+        items = items.filter(order__user_id__in=user_ids)
+    favorites = {}
+    rows = (
+        items.order_by()
+        .values_list("order__user_id", "item__category_id")
+        .annotate(quantity=Sum("quantity"))
+        .order_by("order__user_id", "-quantity", "item__category_id")
+    )
+    for user_id, category_id, _ in rows.iterator():
+        favorites.setdefault(user_id, category_id)
+    return favorites
+
+
+def refresh_favorites(user_ids):
+    user_ids = set(user_ids)
+    favorites = _favorites(user_ids)
+    for user_id in user_ids:
+        CustomerStats.objects.filter(user_id=user_id).update(favorite_category_id=favorites.get(user_id))
+
+
+def _rating_figures(user_ids=None, review_model=OrderReview):
+    """``{user_id: (count, sum)}`` of the ratings customers gave (overall, else delivery)."""
+    reviews = review_model.objects.all()
+    if user_ids is not None:
+        reviews = reviews.filter(user_id__in=user_ids)
+    rows = (
+        reviews.order_by()
+        .values_list("user_id")
+        .annotate(count=Count("id"), total=Sum(Coalesce("overall_rating", "delivery_rating")))
+    )
+    return {user_id: (count, total or 0) for user_id, count, total in rows.iterator()}
+
+
+def _average(count, total):
+    return (Decimal(total) / count).quantize(Decimal("0.01")) if count else None
+
+
+def refresh_ratings(user_ids):
+    user_ids = set(user_ids)
+    figures = _rating_figures(user_ids)
+    for user_id in user_ids:
+        count, total = figures.get(user_id, (0, 0))
+        # Update only: a new row would claim the customer never ordered. A
+        # customer without a row is repaired by ``rebuild``.
+        CustomerStats.objects.filter(user_id=user_id).update(
+            rating_count=count, rating_sum=total, average_rating=_average(count, total)
+        )
+
+
+def rebuild(batch_size=1000, apps=None):
+    """
+    Recompute every customer's stats from orders and reviews. Returns the rows
+    written. Migrations pass their ``apps`` to run on the historical models.
+    """
+    if apps is not None:
+        stats_model, order_model = apps.get_model("foodbackend", "CustomerStats"), apps.get_model("foodbackend", "Order")
+        favorites = _favorites(order_item_model=apps.get_model("foodbackend", "OrderItem"))
+        ratings = _rating_figures(review_model=apps.get_model("foodbackend", "OrderReview"))
+    else:
+        stats_model, order_model = CustomerStats, Order
+        favorites = _favorites()
+        ratings = _rating_figures()
+    per_user = (
+        order_model.objects.order_by()
+        .values("user_id")
+        .annotate(
+            orders=Count("id"),
+            delivered=Count("id", filter=Q(status="delivered")),
+            spend=Sum("total_price", filter=Q(status="delivered")),
+            last_order_at=Max("created_at"),
+        )
+    )
+    rows = []
+    with transaction.atomic():
+        stats_model.objects.all().delete()
+        for row in per_user.iterator():
+            count, total = ratings.pop(row["user_id"], (0, 0))
+            rows.append(stats_model(
+                user_id=row["user_id"],
+                order_count=row["orders"],
+                delivered_count=row["delivered"],
+                lifetime_spend=row["spend"] or 0,
+                last_order_at=row["last_order_at"],
+                favorite_category_id=favorites.get(row["user_id"]),
+                rating_count=count,
+                rating_sum=total,
+                average_rating=_average(count, total),
+            ))
+        for user_id, (count, total) in ratings.items():
+            rows.append(stats_model(
+                user_id=user_id, rating_count=count, rating_sum=total, average_rating=_average(count, total)
+            ))
+        return len(stats_model.objects.bulk_create(rows, batch_size=batch_size))
@@ -0,0 +1,390 @@
+"""
+Nearest-rider dispatch.
+
+Idle riders' latest positions are held in an in-memory grid index that is fed
+by every fix passing through ``rider_location`` and periodically reseeded from
+the shared location store, so lookups never hit the database. A rider leaves
+the index when they claim an order or their rider app disconnects, and comes
+back when their last delivery closes or the app reconnects. Those events are
+also marked in the shared cache, so every process drops the rider, and a
+lookup checks its candidates' marks in one cache read. When an order
+becomes ready for pickup it is offered to the k nearest idle riders. Offers
+live in the shared cache; once an offer times out it escalates to the next
+ring of riders with a wider fan-out, and after the last round the order is
+broadcast to every rider the way the pull list used to work. Every round is
+also published on the riders' pub/sub channels for connected rider apps.
+
+Several processes may start or escalate the same offer at once (the web
+workers on commit and on rider polls, and ``run_dispatcher``). An offer is
+created with ``cache.add``, and each round is claimed with ``cache.add`` on a
+key of the offer's ``dispatch_id`` and round number, so only one process
+moves an offer forward. A ready order without an offer is visible to no
+rider until it has been dispatched. ``run_dispatcher`` publishes from its own
+process, so it needs the ``postgres`` pub/sub backend.
+"""
+import math
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import pubsub, rider_location
+from .models import Order, Rider
+
+OFFER_KEY = "dispatch:offer:{order_id}"
+ROUND_KEY = "dispatch:round:{dispatch_id}:{round}"
+BUSY_KEY = "dispatch:busy:{rider_id}"
+OFFLINE_KEY = "dispatch:offline:{rider_id}"
+
+# Orders that keep a rider busy; a rider is freed once none are left.
+BUSY_STATUSES = [
+    "on_the_way",
+    "delivery_pending",
+    "delivery_failed",
+    "delivery_rescheduled",
+]
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class RiderIndex:
+    """Uniform lat/lng grid of rider positions. Updates are O(1)."""
+
+    def __init__(self, cell_deg=0.01):
+        self.cell_deg = cell_deg
+        self._cells = {}
+        self._riders = {}
+        self._lock = threading.Lock()
+
+    def _cell(self, lat, lng):
+        return int(math.floor(lat / self.cell_deg)), int(math.floor(lng / self.cell_deg))
+
+    def update(self, rider_id, lat, lng, ts):
+        cell = self._cell(lat, lng)
+        with self._lock:
+            previous = self._riders.get(rider_id)
+            if previous and previous[3] > ts:
+                return
+            if previous and previous[2] != cell:
+                members = self._cells.get(previous[2])
+                if members:
+                    members.discard(rider_id)
+                    if not members:
+                        del self._cells[previous[2]]
+            self._riders[rider_id] = (lat, lng, cell, ts)
+            self._cells.setdefault(cell, set()).add(rider_id)
+
+    def remove(self, rider_id):
+        with self._lock:
+            previous = self._riders.pop(rider_id, None)
+            if previous:
+                members = self._cells.get(previous[2])
+                if members:
+                    members.discard(rider_id)
+                    if not members:
+                        del self._cells[previous[2]]
+
+    def __len__(self):
+        return len(self._riders)
+
+    def rider_ids(self):
+        with self._lock:
+            return set(self._riders)
+
+    def nearest(self, lat, lng, k, max_distance_m, min_ts=0, exclude=()):
+        """Return up to k ``(distance_m, rider_id)`` pairs, nearest first."""
+        exclude = set(exclude)
+        cell_lat, cell_lng = self._cell(lat, lng)
+        # Smallest ground size of one cell around here, for the stopping rule.
+        cell_m = self.cell_deg * math.pi / 180 * rider_location.EARTH_RADIUS_M * max(
+            math.cos(math.radians(lat)), 0.01
+        )
+        max_ring = int(math.ceil(max_distance_m / cell_m)) + 1
+
+        found = []
+        with self._lock:
+            for ring in range(max_ring + 1):
+                if len(found) >= k and (ring - 1) * cell_m > found[k - 1][0]:
+                    break
+                for cell in self._ring_cells(cell_lat, cell_lng, ring):
+                    for rider_id in self._cells.get(cell, ()):
+                        if rider_id in exclude:
+                            continue
+                        r_lat, r_lng, _, ts = self._riders[rider_id]
+                        if ts < min_ts:
+                            continue
+                        distance = rider_location.distance_m(lat, lng, r_lat, r_lng)
+                        if distance <= max_distance_m:
+                            found.append((distance, rider_id))
+                found.sort()
+        return found[:k]
+
+    @staticmethod
+    def _ring_cells(cell_lat, cell_lng, ring):
+        if ring == 0:
+            yield cell_lat, cell_lng
+            return
+        for d in range(-ring, ring + 1):
+            yield cell_lat - ring, cell_lng + d
+            yield cell_lat + ring, cell_lng + d
+        for d in range(-ring + 1, ring):
+            yield cell_lat + d, cell_lng - ring
+            yield cell_lat + d, cell_lng + ring
+
+
+index = RiderIndex()
+# Riders this process knows to be busy or offline; their fixes are not indexed.
+_away = set()
+_last_refresh = 0.0
+_refresh_lock = threading.Lock()
+
+
+def _on_position(position):
+    if position["rider_id"] in _away:
+        return
+    ts = rider_location.parse_timestamp(position["updated_at"]).timestamp()
+    index.update(position["rider_id"], position["latitude"], position["longitude"], ts)
+
+
+rider_location.add_position_listener(_on_position)
+
+
+def refresh_index(force=False):
+    """
+    Reseed the index from the shared location store so this process also
+    knows about riders whose pings were handled by other workers.
+    """
+    global _last_refresh
+
+    interval = _setting("DISPATCH_INDEX_REFRESH_SECONDS", 30)
+    with _refresh_lock:
+        if not force and time.monotonic() - _last_refresh < interval:
+            return
+        _last_refresh = time.monotonic()
+
+    rider_ids = set(Rider.objects.filter(is_active=True).values_list("id", flat=True))
+    away = _marked_away(rider_ids)
+    # Deactivated riders leave the index too.
+    for rider_id in index.rider_ids() - rider_ids:
+        index.remove(rider_id)
+    for rider_id in away:
+        _set_away(rider_id)
+    _away.intersection_update(away)
+    for position in rider_location.get_positions(rider_ids - away).values():
+        _on_position(position)
+
+
+def _marked_away(rider_ids):
+    """The riders among ``rider_ids`` marked busy or offline by any process."""
+    keys = {}
+    for rider_id in rider_ids:
+        keys[BUSY_KEY.format(rider_id=rider_id)] = rider_id
+        keys[OFFLINE_KEY.format(rider_id=rider_id)] = rider_id
+    if not keys:
+        return set()
+    return {keys[key] for key in cache.get_many(list(keys))}
+
+
+def _set_away(rider_id):
+    _away.add(rider_id)
+    index.remove(rider_id)
+
+
+def _mark(key, rider_id, away):
+    key = key.format(rider_id=rider_id)
+    if away:
+        cache.set(key, 1, timeout=_setting("DISPATCH_AWAY_TTL_SECONDS", 12 * 60 * 60))
+        _set_away(rider_id)
+        return
+    cache.delete(key)
+    if not _marked_away([rider_id]):
+        _away.discard(rider_id)
+        position = rider_location.get_position(rider_id)
+        if position:
+            _on_position(position)
+
+
+def rider_busy(rider_id):
+    """The rider claimed an order: stop offering them others."""
+    _mark(BUSY_KEY, rider_id, away=True)
+
+
+def rider_free(rider_id):
+    """The rider has no order left: offer them orders again from their last position."""
+    _mark(BUSY_KEY, rider_id, away=False)
+
+
+def rider_offline(rider_id):
+    _mark(OFFLINE_KEY, rider_id, away=True)
+
+
+def rider_online(rider_id):
+    _mark(OFFLINE_KEY, rider_id, away=False)
+
+
+def release_rider(rider_id):
+    """Free a rider whose order just closed, unless another of their orders keeps them busy."""
+    if not Order.objects.filter(rider_id=rider_id, status__in=BUSY_STATUSES).exists():
+        rider_free(rider_id)
+
+
+def find_riders(lat, lng, k, exclude=()):
+    """k nearest idle riders with a recent fix, as a list of rider ids."""
+    refresh_index()
+    max_age = _setting("DISPATCH_MAX_POSITION_AGE_SECONDS", 300)
+    candidates = index.nearest(
+        lat,
+        lng,
+        k * 4,
+        max_distance_m=_setting("DISPATCH_MAX_RADIUS_M", 8000),
+        min_ts=time.time() - max_age,
+        exclude=exclude,
+    )
+    # Another process may have marked a rider since this index last heard.
+    away = _marked_away([rider_id for _, rider_id in candidates])
+    return [rider_id for _, rider_id in candidates if rider_id not in away][:k]
+
+
+def get_offer(order_id):
+    return cache.get(OFFER_KEY.format(order_id=order_id))
+
+
+def get_offers(order_ids):
+    keys = {OFFER_KEY.format(order_id=order_id): order_id for order_id in order_ids}
+    if not keys:
+        return {}
+    return {keys[key]: offer for key, offer in cache.get_many(list(keys)).items()}
+
+
+def clear_offer(order_id):
+    cache.delete(OFFER_KEY.format(order_id=order_id))
+    pubsub.publish(pubsub.RIDERS_CHANNEL, {"event": "offer_closed", "data": {"order_id": int(order_id)}})
+
+
+def _offer_ttl():
+    return _setting("DISPATCH_OFFER_TTL_SECONDS", 6 * 60 * 60)
+
+
+def _save_offer(offer):
+    cache.set(OFFER_KEY.format(order_id=offer["order_id"]), offer, timeout=_offer_ttl())
+    return offer
+
+
+def offer_order(order_id, pickup_lat, pickup_lng):
+    """
+    Start dispatching an order that just became ready for pickup. Returns the
+    order's offer, which is the existing one if another process got there first.
+    """
+    offer = {
+        "order_id": order_id,
+        "dispatch_id": uuid.uuid4().hex,
+        "pickup": [pickup_lat, pickup_lng],
+        "round": 0,
+        "riders": [],
+        "offered": [],
+        "broadcast": False,
+        "expires_at": 0,
+    }
+    if not cache.add(OFFER_KEY.format(order_id=order_id), offer, timeout=_offer_ttl()):
+        return get_offer(order_id)
+    return _advance(offer)
+
+
+def _advance(offer):
+    """Move ``offer`` to its next round unless another process already did."""
+    claimed = cache.add(
+        ROUND_KEY.format(dispatch_id=offer.get("dispatch_id"), round=offer["round"] + 1),
+        1,
+        timeout=_offer_ttl(),
+    )
+    if not claimed:
+        return get_offer(offer["order_id"]) or offer
+    return _next_round(offer)
+
+
+def _next_round(offer):
+    offer = dict(offer)
+    fanout = _setting("DISPATCH_FANOUT", 3)
+    max_rounds = _setting("DISPATCH_MAX_ROUNDS", 3)
+
+    offer["round"] += 1
+    riders = []
+    if offer["round"] <= max_rounds:
+        # Widen the fan-out each round: k, 2k, 4k, ...
+        riders = find_riders(
+            offer["pickup"][0],
+            offer["pickup"][1],
+            fanout * 2 ** (offer["round"] - 1),
+            exclude=offer["offered"],
+        )
+
+    if riders:
+        offer["riders"] = riders
+        offer["offered"] = offer["offered"] + riders
+        offer["expires_at"] = time.time() + _setting("DISPATCH_OFFER_TIMEOUT_SECONDS", 30)
+    else:
+        offer["riders"] = []
+        offer["broadcast"] = True
+        offer["expires_at"] = 0
+    _save_offer(offer)
+    _publish_offer(offer)
+    return offer
+
+
+def _publish_offer(offer):
+    message = {
+        "event": "offer",
+        "data": {
+            "order_id": offer["order_id"],
+            "round": offer["round"],
+            "broadcast": offer["broadcast"],
+            "expires_at": offer["expires_at"] or None,
+        },
+    }
+    if offer["broadcast"]:
+        pubsub.publish(pubsub.RIDERS_CHANNEL, message)
+    for rider_id in offer["riders"]:
+        pubsub.publish(pubsub.rider_channel(rider_id), message)
+
+
+def escalate_expired(offers):
+    """Move every timed-out offer in ``{order_id: offer}`` to its next round."""
+    now = time.time()
+    for order_id, offer in offers.items():
+        if offer and not offer["broadcast"] and offer["expires_at"] <= now:
+            offers[order_id] = _advance(offer)
+    return offers
+
+
+def is_visible_to(offer, rider_id):
+    """Broadcast orders are open to every rider, others only to the riders offered them."""
+    return offer is not None and (offer["broadcast"] or rider_id in offer["offered"])
+
+
+def ensure_offers(order_ids, offers):
+    """
+    Dispatch the delivery orders among ``order_ids`` that have no offer (the
+    dispatch on commit failed, or the offer was evicted). Returns ``offers``
+    with theirs added.
+    """
+    missing = [order_id for order_id in order_ids if offers.get(order_id) is None]
+    if missing:
+        from .views import _get_restaurant_coords
+
+        lat, lng = _get_restaurant_coords()
+        # Self-pickup orders (no delivery OTP) never need a rider.
+        for order_id in Order.objects.filter(id__in=missing, delivery_otp__isnull=False).values_list("id", flat=True):
+            offers[order_id] = offer_order(order_id, lat, lng)
+    return offers
+
+
+def run_once():
+    """Dispatch or escalate the offers of every unassigned ready order."""
+    order_ids = list(
+        Order.objects.filter(status="ready_for_pickup", rider__isnull=True).values_list("id", flat=True)
+    )
+    return escalate_expired(ensure_offers(order_ids, get_offers(order_ids)))
@@ -0,0 +1,151 @@
+"""
+Local stand-in for Expo's push API, for tests and load tests.
+
+Implements ``POST /send`` and ``POST /getReceipts`` closely enough for
+``push``: more than 100 messages in one request is rejected like Expo does,
+tokens in ``rejected`` get an immediate ``DeviceNotRegistered`` ticket,
+tokens in ``throttled`` a ``MessageRateExceeded`` ticket, and tokens in
+``unregistered`` get an ok ticket whose receipt later reports
+``DeviceNotRegistered``. Each status in ``send_errors`` answers one send
+request in turn, after the request was seen. Point ``EXPO_API_URL`` at ``url``.
+
+    python -m foodbackend.expo_standin --port 8765
+"""
+import argparse
+import itertools
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MAX_MESSAGES = 100
+MAX_RECEIPT_IDS = 1000
+
+
+class ExpoStandIn:
+    def __init__(self, host="127.0.0.1", port=0, unregistered=(), rejected=(), throttled=(), send_errors=()):
+        self.unregistered = set(unregistered)
+        self.rejected = set(rejected)
+        self.throttled = set(throttled)
+        self.send_errors = list(send_errors)
+        self.requests = []
+        self.receipts = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="expo-standin", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def sent_messages(self):
+        return [message for path, body in self.requests if path == "send" for message in body]
+
+    def send(self, messages):
+        if not isinstance(messages, list):
+            messages = [messages]
+        if len(messages) > MAX_MESSAGES:
+            return 400, {"errors": [{
+                "code": "PUSH_TOO_MANY_NOTIFICATIONS",
+                "message": f"You are trying to send more than {MAX_MESSAGES} push notifications in one request.",
+            }]}
+        with self._lock:
+            if self.send_errors:
+                return self.send_errors.pop(0), {"errors": [{"code": "INTERNAL_SERVER_ERROR", "message": "Failed"}]}
+        tickets = []
+        for message in messages:
+            token = message.get("to")
+            if token in self.rejected:
+                tickets.append({
+                    "status": "error",
+                    "message": f'"{token}" is not a registered push notification recipient',
+                    "details": {"error": "DeviceNotRegistered"},
+                })
+                continue
+            if token in self.throttled:
+                tickets.append({
+                    "status": "error",
+                    "message": f'"{token}" is receiving too many messages',
+                    "details": {"error": "MessageRateExceeded"},
+                })
+                continue
+            with self._lock:
+                ticket_id = f"ticket-{next(self._ids)}"
+            receipt = {"status": "ok"}
+            if token in self.unregistered:
+                receipt = {"status": "error", "details": {"error": "DeviceNotRegistered"}}
+            self.receipts[ticket_id] = receipt
+            tickets.append({"status": "ok", "id": ticket_id})
+        return 200, {"data": tickets}
+
+    def get_receipts(self, body):
+        ids = body.get("ids") or []
+        if len(ids) > MAX_RECEIPT_IDS:
+            return 400, {"errors": [{"code": "PUSH_TOO_MANY_RECEIPTS", "message": "Too many receipt ids"}]}
+        return 200, {"data": {ticket_id: self.receipts[ticket_id] for ticket_id in ids if ticket_id in self.receipts}}
+
+    def _handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                path = self.path.rstrip("/").rsplit("/", 1)[-1]
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"null")
+                except ValueError:
+                    return self._reply(400, {"errors": [{"code": "VALIDATION_ERROR", "message": "Invalid JSON"}]})
+                with standin._lock:
+                    standin.requests.append((path, body))
+                if path == "send":
+                    return self._reply(*standin.send(body))
+                if path == "getReceipts":
+                    return self._reply(*standin.get_receipts(body or {}))
+                self._reply(404, {"errors": [{"code": "NOT_FOUND", "message": self.path}]})
+
+            def _reply(self, status, payload):
+                content = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    server = ExpoStandIn(args.host, args.port)
+    print(f"Expo stand-in listening on {server.url}")
+    server.start()
+    try:
+        server._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
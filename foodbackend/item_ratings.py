@@ -0,0 +1,160 @@
+"""
+Per-item rating aggregates for the menu.
+
+Every ``Item`` carries its rating count and sum, their average, and the count
+and average of the ratings from the last ``ITEM_RATING_RECENT_DAYS`` days.
+``home_data`` and ``get_combos`` serve them from the cached menu payload, so
+ratings cost nothing at serve time.
+
+Writers report the item reviews they add and remove with ``apply_on_commit``.
+Once the transaction commits, the count and sum move by the net delta of each
+item in one conditional ``UPDATE``, which also recomputes the average from
+the updated columns; the recent figures are re-read from the
+``(item, created_at)`` index, bounded to the window. The cached menu is then
+invalidated, at most once per ``ITEM_RATINGS_BUMP_SECONDS``: a burst of
+reviews does not keep the menu cold, and the figures it skips reach the menu
+within the menu's own cache TTL.
+
+Recent averages of items that receive no new ratings drift as the window
+slides; ``python manage.py rebuild_item_ratings`` (run daily) recomputes
+every item, and repairs deltas lost to a crash between commit and apply or
+reviews deleted along with their order.
+"""
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, Count, F, FloatField, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Cast
+from django.utils import timezone
+
+from . import catalog
+from .models import Item, OrderItem, OrderItemReview
+
+BUMP_KEY = "item_ratings:bumped"
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _since():
+    return timezone.now() - timedelta(days=_setting("ITEM_RATING_RECENT_DAYS", 30))
+
+
+def _average(count, total):
+    return (Decimal(total) / count).quantize(Decimal("0.01")) if count else None
+
+
+def _deltas(added, removed):
+    """``{item_id: (count, sum)}`` net of ``(item_id, rating)`` pairs added and removed."""
+    deltas = defaultdict(lambda: [0, 0])
+    for rows, sign in ((added, 1), (removed, -1)):
+        for item_id, rating in rows:
+            if item_id is not None:
+                deltas[item_id][0] += sign
+                deltas[item_id][1] += sign * rating
+    return {item_id: delta for item_id, delta in deltas.items() if delta != [0, 0]}
+
+
+def _recent(item_ids, since):
+    """``{item_id: (count, sum)}`` of the ratings in the recent window."""
+    rows = (
+        OrderItemReview.objects.filter(item_id__in=item_ids, created_at__gte=since)
+        .order_by()
+        .values_list("item_id")
+        .annotate(count=Count("id"), total=Sum("rating"))
+    )
+    return {item_id: (count, total) for item_id, count, total in rows}
+
+
+def apply(added, removed=()):
+    """Move the aggregates of the items behind the ``(item_id, rating)`` pairs added and removed."""
+    deltas = _deltas(added, removed)
+    if not deltas:
+        return
+    recent = _recent(list(deltas), _since())
+    for item_id, (count, total) in deltas.items():
+        new_count, new_sum = F("rating_count") + count, F("rating_sum") + total
+        recent_count, recent_sum = recent.get(item_id, (0, 0))
+        Item.objects.filter(id=item_id).update(
+            rating_count=new_count,
+            rating_sum=new_sum,
+            # Right-hand sides read the old row, so this is "new count > 0".
+            average_rating=Case(
+                When(Q(rating_count__gt=-count), then=Cast(new_sum, FloatField()) / new_count),
+                default=Value(None),
+                output_field=FloatField(),
+            ),
+            recent_rating_count=recent_count,
+            recent_average_rating=_average(recent_count, recent_sum),
+        )
+    _bump()
+
+
+def apply_on_commit(added, removed=()):
+    added, removed = list(added), list(removed)
+    if added or removed:
+        transaction.on_commit(lambda: _safely(apply, added, removed))
+
+
+def _bump():
+    if cache.add(BUMP_KEY, 1, timeout=_setting("ITEM_RATINGS_BUMP_SECONDS", 60)):
+        catalog.bump()
+
+
+def _safely(func, *args):
+    try:
+        func(*args)
+    except Exception as e:
+        print(f"Item rating update failed: {e}")
+
+
+def ratings_of(queryset):
+    """``(item_id, rating)`` pairs of an ``OrderItemReview`` queryset, to report before deleting it."""
+    return list(queryset.values_list("item_id", "rating"))
+
+
+def rebuild(batch_size=1000):
+    """Recompute every item's aggregates from its reviews. Returns the number of rated items."""
+    since = _since()
+    with transaction.atomic():
+        # Reviews written before items were copied onto them.
+        OrderItemReview.objects.filter(item__isnull=True, order_item__item__isnull=False).update(
+            item_id=Subquery(OrderItem.objects.filter(id=OuterRef("order_item_id")).values("item_id")[:1])
+        )
+        rows = (
+            OrderItemReview.objects.filter(item__isnull=False)
+            .order_by()
+            .values_list("item_id")
+            .annotate(
+                count=Count("id"),
+                total=Sum("rating"),
+                recent_count=Count("id", filter=Q(created_at__gte=since)),
+                recent_total=Sum("rating", filter=Q(created_at__gte=since)),
+            )
+        )
+        items = [
+            Item(
+                id=item_id,
+                rating_count=count,
+                rating_sum=total,
+                average_rating=_average(count, total),
+                recent_rating_count=recent_count,
+                recent_average_rating=_average(recent_count, recent_total or 0),
+            )
+            for item_id, count, total, recent_count, recent_total in rows.iterator()
+        ]
+        Item.objects.exclude(id__in=[item.id for item in items]).exclude(rating_count=0, recent_rating_count=0).update(
+            rating_count=0, rating_sum=0, average_rating=None, recent_rating_count=0, recent_average_rating=None
+        )
+        Item.objects.bulk_update(
+            items,
+            ["rating_count", "rating_sum", "average_rating", "recent_rating_count", "recent_average_rating"],
+            batch_size=batch_size,
+        )
+        catalog.bump_on_commit()
+    return len(items)
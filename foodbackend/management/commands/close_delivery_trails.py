@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from foodbackend.models import RiderLocation
+from foodbackend.trails import close_trail
+
+
+class Command(BaseCommand):
+    help = "Compress leftover raw rider fixes of finished orders into delivery trails."
+
+    def handle(self, *args, **options):
+        order_ids = (
+            RiderLocation.objects.filter(order__status__in=["delivered", "cancelled"])
+            .values_list("order_id", flat=True)
+            .distinct()
+        )
+        closed = 0
+        for order_id in list(order_ids):
+            close_trail(order_id)
+            closed += 1
+        self.stdout.write(self.style.SUCCESS(f"Closed {closed} delivery trail(s)"))
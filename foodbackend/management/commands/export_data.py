@@ -0,0 +1,33 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.exceptions import ValidationError
+
+from foodbackend import exports
+from foodbackend.admin_api import date_bounds
+
+
+class Command(BaseCommand):
+    help = "Stream orders, order items, reviews or coupon usage to a CSV/NDJSON file (or stdout)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("dataset", choices=sorted(exports.DATASETS))
+        parser.add_argument("--format", dest="export_format", choices=sorted(exports.FORMATS), default="csv")
+        parser.add_argument("--from", dest="date_from", help="YYYY-MM-DD or ISO datetime")
+        parser.add_argument("--to", dest="date_to", help="YYYY-MM-DD (inclusive) or ISO datetime")
+        parser.add_argument("--output", "-o", help="File to write, default stdout")
+
+    def handle(self, *args, **options):
+        params = {name: options[name] for name in ("date_from", "date_to") if options[name]}
+        try:
+            bounds = date_bounds(params)
+        except ValidationError as e:
+            raise CommandError(e.detail)
+
+        output = open(options["output"], "w", newline="", encoding="utf-8") if options["output"] else sys.stdout
+        try:
+            for chunk in exports.lines(options["dataset"], options["export_format"], bounds):
+                output.write(chunk)
+        finally:
+            if output is not sys.stdout:
+                output.close()
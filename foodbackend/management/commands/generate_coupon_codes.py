@@ -0,0 +1,39 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from foodbackend import coupon_codes
+from foodbackend.models import Coupon
+
+
+class Command(BaseCommand):
+    help = "Add a batch of single-use codes to a unique_codes coupon and write them out as CSV."
+
+    def add_arguments(self, parser):
+        parser.add_argument("coupon", help="The coupon's shared code")
+        parser.add_argument("count", type=int)
+        parser.add_argument("--output", "-o", help="File to write, default stdout")
+
+    def handle(self, *args, **options):
+        try:
+            coupon = Coupon.objects.get(code=options["coupon"].upper())
+        except Coupon.DoesNotExist:
+            raise CommandError(f"Coupon {options['coupon']} not found")
+        if not coupon.unique_codes:
+            raise CommandError(f"Coupon {coupon.code} does not use single-use codes")
+        if options["count"] < 1:
+            raise CommandError("Count must be at least 1")
+
+        try:
+            serials = coupon_codes.generate(coupon, options["count"])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        output = open(options["output"], "w", newline="", encoding="utf-8") if options["output"] else sys.stdout
+        try:
+            for chunk in coupon_codes.csv_lines(coupon.id, serials[0], serials[-1]):
+                output.write(chunk)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        self.stderr.write(f"Added {len(serials)} codes to {coupon.code} (serials {serials[0]}-{serials[-1]})")
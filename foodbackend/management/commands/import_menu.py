@@ -0,0 +1,47 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from foodbackend import menu_import
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk-import menu categories, items and combo compositions from CSV files or one JSON file. "
+        "Changes are applied in one transaction with a single catalog cache invalidation."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--json", dest="json_file", help='JSON file: {"categories": [...], "items": [...], "combos": [...]}')
+        for kind in menu_import.KINDS:
+            parser.add_argument(f"--{kind}", help=f"CSV file of {kind}")
+        parser.add_argument("--dry-run", action="store_true", help="Report the changes without writing them")
+
+    def handle(self, *args, **options):
+        data = {}
+        try:
+            if options["json_file"]:
+                with open(options["json_file"], encoding="utf-8") as f:
+                    data = json.load(f)
+                if not isinstance(data, dict):
+                    raise CommandError("The JSON file must hold an object")
+            for kind in menu_import.KINDS:
+                if options[kind]:
+                    with open(options[kind], newline="", encoding="utf-8-sig") as f:
+                        data[kind] = menu_import.read_csv(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        if not data:
+            raise CommandError("Give --json or at least one of --categories, --items, --combos")
+
+        report = menu_import.import_menu(data, dry_run=options["dry_run"])
+        for line in menu_import.summary_lines(report):
+            self.stdout.write(line)
+        if report["errors"]:
+            raise CommandError(f"{len(report['errors'])} invalid row(s); nothing was written")
+        if report["dry_run"]:
+            self.stdout.write(self.style.WARNING("Dry run: nothing was written"))
+        elif report["applied"]:
+            self.stdout.write(self.style.SUCCESS("Menu updated"))
+        else:
+            self.stdout.write("Menu already up to date")
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from foodbackend import push
+
+
+class Command(BaseCommand):
+    help = (
+        "Fetch Expo receipts for sent push notifications and deactivate tokens of uninstalled apps. "
+        "Run every few minutes (receipts are ready about 15 minutes after sending)."
+    )
+
+    def handle(self, *args, **options):
+        stats = push.process_receipts()
+        self.stdout.write(self.style.SUCCESS(
+            f"Checked {stats['checked']} receipt(s), deactivated {stats['deactivated']} token(s), "
+            f"dropped {stats['expired']} expired ticket(s)"
+        ))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from foodbackend import customer_stats
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute every customer's stats (order counts, lifetime spend, favorite category, ratings) "
+        "from orders and reviews. Run once after deploying customer stats, and whenever they drift."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="Rows per INSERT")
+
+    def handle(self, *args, **options):
+        written = customer_stats.rebuild(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Wrote {written} customer stats row(s)"))
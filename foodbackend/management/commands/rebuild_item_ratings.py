@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from foodbackend import item_ratings
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute every menu item's rating count, average and recent average from the item reviews. "
+        "Run once after deploying item ratings, then daily so recent averages follow the window."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="Items per UPDATE")
+
+    def handle(self, *args, **options):
+        rated = item_ratings.rebuild(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Recomputed ratings, {rated} rated item(s)"))
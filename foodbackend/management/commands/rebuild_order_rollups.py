@@ -0,0 +1,34 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from foodbackend import rollups
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the admin dashboard's hourly/daily order rollups from the orders table. "
+        "Run once after deploying rollups, and whenever they drift (e.g. orders deleted by hand)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from", dest="date_from", help="First day to rebuild (YYYY-MM-DD), default: all history")
+        parser.add_argument("--to", dest="date_to", help="Last day to rebuild (YYYY-MM-DD), inclusive")
+
+    def handle(self, *args, **options):
+        start = self._day(options["date_from"])
+        end = self._day(options["date_to"])
+        if end:
+            end += timedelta(days=1)
+
+        written = rollups.rebuild(start, end)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {written} rollup row(s)"))
+
+    def _day(self, value):
+        if not value:
+            return None
+        day = parse_date(value)
+        if day is None:
+            raise CommandError(f"Invalid date: {value}")
+        return rollups.day_start(day)
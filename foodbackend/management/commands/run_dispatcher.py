@@ -0,0 +1,28 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from foodbackend import dispatch
+
+
+class Command(BaseCommand):
+    help = "Dispatch ready orders that have no offer and escalate timed-out offers, without waiting for rider polls."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=5.0, help="Seconds between sweeps")
+        parser.add_argument("--once", action="store_true", help="Run a single sweep and exit")
+
+    def handle(self, *args, **options):
+        if getattr(settings, "PUBSUB_BACKEND", "local") != "postgres":
+            raise CommandError(
+                "run_dispatcher needs PUBSUB_BACKEND=postgres: with the local broker its offers "
+                "never reach the riders connected to the web workers."
+            )
+        while True:
+            offers = dispatch.run_once()
+            if options["verbosity"] > 1:
+                self.stdout.write(f"Checked {len(offers)} open offer(s)")
+            if options["once"]:
+                return
+            time.sleep(options["interval"])
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from foodbackend import outbox
+
+
+class Command(BaseCommand):
+    help = "Send the order status pushes queued in the notification outbox, in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=1.0, help="Seconds to wait when nothing is due")
+        parser.add_argument("--once", action="store_true", help="Drain a single batch and exit")
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            stats = outbox.drain()
+            if options["verbosity"] > 1 or (options["once"] and any(stats.values())):
+                self.stdout.write(
+                    f"Sent {stats['sent']}, retrying {stats['retried']}, dropped {stats['dropped']} order push(es)"
+                )
+            if options["once"]:
+                return
+            if not any(stats.values()):
+                time.sleep(options["interval"])
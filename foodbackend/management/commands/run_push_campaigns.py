@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from foodbackend import campaigns
+
+
+class Command(BaseCommand):
+    help = "Send running push campaigns at their configured rate, resuming each from its saved cursor."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=5.0, help="Seconds to wait when no campaign is running")
+        parser.add_argument("--once", action="store_true", help="Send one campaign (if any is running) and exit")
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            campaign, lease_until = campaigns.claim_next()
+            if campaign:
+                status = campaigns.dispatch(campaign, lease_until)
+                self.stdout.write(f"Campaign #{campaign.id} {campaign.name!r}: {status}")
+            if options["once"]:
+                return
+            if not campaign:
+                time.sleep(options["interval"])
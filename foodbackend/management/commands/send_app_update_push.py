@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from foodbackend.models import AppVersion
+from foodbackend.views import notify_app_update
+
+
+class Command(BaseCommand):
+    help = "Push an app update notification to every active device, streamed in Expo-sized batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument("version")
+        parser.add_argument("--platform", default="all", choices=["all", "ios", "android"])
+
+    def handle(self, *args, **options):
+        if not AppVersion.objects.filter(version=options["version"], platform=options["platform"]).exists():
+            raise CommandError(f"App version {options['version']} ({options['platform']}) not found")
+        stats = notify_app_update(options["version"], options["platform"])
+        if stats is None:
+            raise CommandError("Sending failed, see the log above")
+        self.stdout.write(self.style.SUCCESS(
+            f"Sent {stats['sent']}, failed {stats['failed']}, deactivated {stats['deactivated']} token(s)"
+        ))
@@ -0,0 +1,402 @@
+"""
+Bulk menu import: categories, items and combo compositions from CSV or JSON.
+
+``import_menu`` diffs the rows against the current menu, fetches and
+normalises any images on a small thread pool, and then (unless it is a dry
+run) writes every difference with ``bulk_create`` / ``bulk_update`` in one
+transaction and bumps the catalog version once. The report lists what was
+(or would be) created, updated and deleted. Any error rejects the whole
+import.
+
+Row formats (CSV columns or JSON object keys; a missing key or blank cell
+leaves the field unchanged, ``none`` clears a nullable field):
+
+``categories``
+    ``id`` (optional, to rename), ``name``, ``gst_rate``, ``image``
+``items``
+    ``id`` (optional, to rename), ``name``, ``category`` (name),
+    ``price``, ``description``, ``gst_rate``, ``is_available``,
+    ``is_combo``, ``image``
+``combos``
+    ``combo`` (item name), ``item`` (item name), ``quantity``. A combo listed
+    here gets exactly the listed components; links not listed are removed.
+
+``image`` is an http(s) URL. Images are stored under a content hash, so
+re-importing the same picture is not a change.
+"""
+import csv
+import hashlib
+import io
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+import requests
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.db import models, transaction
+from PIL import Image, UnidentifiedImageError
+
+from . import catalog
+from .models import Category, ComboItem, Item
+
+KINDS = ("categories", "items", "combos")
+FIELDS = {
+    "categories": ("name", "gst_rate"),
+    "items": ("name", "category", "price", "description", "gst_rate", "is_available", "is_combo"),
+}
+BOOLEANS = {"true": True, "1": True, "yes": True, "false": False, "0": False, "no": False}
+IMAGE_FORMATS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp"}
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def read_csv(file):
+    """Rows of a CSV file or upload as dicts, without blank cells."""
+    text = file.read()
+    if isinstance(text, bytes):
+        text = text.decode("utf-8-sig")
+    return [
+        {key.strip(): value.strip() for key, value in row.items() if key and isinstance(value, str) and value.strip()}
+        for row in csv.DictReader(io.StringIO(text))
+    ]
+
+
+def _show(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, models.Model):
+        return str(value.name)
+    return value
+
+
+def _clean(model, name, value):
+    field = model._meta.get_field(name)
+    if isinstance(value, str):
+        value = value.strip()
+        if field.null and value.lower() == "none":
+            value = None
+        elif isinstance(field, models.BooleanField):
+            if value.lower() not in BOOLEANS:
+                raise ValidationError("Use true or false.")
+            value = BOOLEANS[value.lower()]
+    return field.clean(value, None)
+
+
+class _Index:
+    """Existing and to-be-created rows of one model, looked up by id or case-insensitive name."""
+
+    def __init__(self, objects):
+        self.by_id = {obj.id: obj for obj in objects}
+        self.by_name = {}
+        for obj in objects:
+            self.by_name.setdefault(obj.name.lower(), []).append(obj)
+
+    def find(self, row_id=None, name=None):
+        """``(obj or None, error or None)``."""
+        if row_id not in (None, ""):
+            try:
+                obj = self.by_id.get(int(row_id))
+            except (TypeError, ValueError):
+                obj = None
+            return (obj, None) if obj else (None, f"no row with id {row_id}")
+        matches = self.by_name.get(str(name).strip().lower(), [])
+        if len(matches) > 1:
+            return None, f"'{name}' matches {len(matches)} rows; give an id"
+        return (matches[0] if matches else None), None
+
+    def add(self, obj):
+        self.by_name.setdefault(obj.name.lower(), []).append(obj)
+
+
+class _Import:
+    def __init__(self, data):
+        self.data = {kind: list(data.get(kind) or []) for kind in KINDS}
+        self.errors = []
+        self.report = {kind: {"created": [], "updated": [], "unchanged": 0} for kind in KINDS}
+        self.report["combos"]["deleted"] = []
+        self.creates = {kind: [] for kind in KINDS}
+        self.updates = {kind: {} for kind in KINDS}
+        self.deletes = []
+        self.images = []
+
+    def error(self, kind, row_no, message):
+        self.errors.append(f"{kind} row {row_no}: {message}")
+
+    def plan(self):
+        self.categories = _Index(list(Category.objects.all()))
+        self._plan_rows("categories", Category, self.categories)
+        items = Item.objects.all()
+        if self.data["combos"]:
+            items = items.prefetch_related("combo_links")
+        self.items = _Index(list(items))
+        self._plan_rows("items", Item, self.items)
+        self._plan_combos()
+
+    def _plan_rows(self, kind, model, index):
+        seen = set()
+        for row_no, row in enumerate(self.data[kind], start=1):
+            if not isinstance(row, dict):
+                self.error(kind, row_no, "expected an object")
+                continue
+            obj, problem = index.find(row.get("id"), row.get("name", ""))
+            if problem:
+                self.error(kind, row_no, problem)
+                continue
+            if obj is None and not str(row.get("name") or "").strip():
+                self.error(kind, row_no, "name is required")
+                continue
+            if obj is not None and id(obj) in seen:
+                self.error(kind, row_no, f"'{obj.name}' appears more than once")
+                continue
+
+            values, problems = {}, []
+            for name in FIELDS[kind]:
+                if name not in row or row[name] == "":
+                    continue
+                if name == "name" and obj is not None and row.get("id") in (None, ""):
+                    continue  # The name only matched the row; renames need an id.
+                try:
+                    values[name] = self._category(row[name]) if name == "category" else _clean(model, name, row[name])
+                except ValidationError as e:
+                    problems.append(f"{name}: {' '.join(e.messages)}")
+            if problems:
+                self.error(kind, row_no, "; ".join(problems))
+                continue
+
+            if obj is None:
+                obj = self._plan_create(kind, model, row_no, values)
+                if obj is None:
+                    continue
+                index.add(obj)
+            else:
+                self._plan_update(kind, obj, values)
+                if "name" in values:
+                    index.add(obj)
+            seen.add(id(obj))
+            if row.get("image"):
+                self.images.append((kind, row_no, obj, str(row["image"]).strip()))
+
+    def _plan_create(self, kind, model, row_no, values):
+        obj = model(**values)
+        try:
+            obj.clean_fields(exclude=["image", "category"])
+        except ValidationError as e:
+            self.error(kind, row_no, "; ".join(f"{k}: {' '.join(v)}" for k, v in e.message_dict.items()))
+            return None
+        if kind == "items" and "category" not in values:
+            self.error(kind, row_no, "category: This field is required.")
+            return None
+        self.creates[kind].append(obj)
+        self.report[kind]["created"].append(obj.name)
+        return obj
+
+    def _plan_update(self, kind, obj, values):
+        changes = {}
+        for name, value in values.items():
+            if name == "category":
+                # Compare ids so the current category is never loaded per item.
+                if value.pk is not None and value.pk == obj.category_id:
+                    continue
+                current = self.categories.by_id[obj.category_id]
+            else:
+                current = getattr(obj, name)
+                if current == value:
+                    continue
+            changes[name] = [_show(current), _show(value)]
+            setattr(obj, name, value)
+        if changes:
+            self._changed(kind, obj).update(changes)
+        else:
+            self.report[kind]["unchanged"] += 1
+
+    def _changed(self, kind, obj):
+        """The report's ``changes`` dict for ``obj``, moving it from unchanged to updated if needed."""
+        if id(obj) not in self.updates[kind]:
+            entry = {"name": obj.name, "changes": {}}
+            self.updates[kind][id(obj)] = (obj, entry["changes"])
+            self.report[kind]["updated"].append(entry)
+        return self.updates[kind][id(obj)][1]
+
+    def _category(self, name):
+        category, problem = self.categories.find(name=name)
+        if problem or category is None:
+            raise ValidationError(problem or f"unknown category '{name}'")
+        return category
+
+    def _plan_combos(self):
+        wanted = {}
+        for row_no, row in enumerate(self.data["combos"], start=1):
+            if not isinstance(row, dict):
+                self.error("combos", row_no, "expected an object")
+                continue
+            combo, problem = self.items.find(name=row.get("combo", ""))
+            item, item_problem = self.items.find(name=row.get("item", ""))
+            if problem or combo is None:
+                self.error("combos", row_no, problem or f"unknown combo '{row.get('combo')}'")
+                continue
+            if item_problem or item is None:
+                self.error("combos", row_no, item_problem or f"unknown item '{row.get('item')}'")
+                continue
+            if not combo.is_combo:
+                self.error("combos", row_no, f"'{combo.name}' is not a combo")
+                continue
+            try:
+                quantity = _clean(ComboItem, "quantity", row.get("quantity") or 1)
+            except ValidationError as e:
+                self.error("combos", row_no, f"quantity: {' '.join(e.messages)}")
+                continue
+            if quantity < 1:
+                self.error("combos", row_no, "quantity: must be at least 1")
+                continue
+            components = wanted.setdefault(id(combo), (combo, {}))[1]
+            if id(item) in components:
+                self.error("combos", row_no, f"'{item.name}' is listed twice in '{combo.name}'")
+                continue
+            components[id(item)] = (item, quantity)
+
+        report = self.report["combos"]
+        for combo, components in wanted.values():
+            links = {id(self._item(link.item_id)): link for link in combo.combo_links.all()} if combo.pk else {}
+            for key, (item, quantity) in components.items():
+                label = f"{combo.name}: {item.name}"
+                link = links.pop(key, None)
+                if link is None:
+                    self.creates["combos"].append(ComboItem(combo=combo, item=item, quantity=quantity))
+                    report["created"].append(f"{label} x {quantity}")
+                elif link.quantity != quantity:
+                    changes = {"quantity": [link.quantity, quantity]}
+                    report["updated"].append({"name": label, "changes": changes})
+                    link.quantity = quantity
+                    self.updates["combos"][link.id] = (link, changes)
+                else:
+                    report["unchanged"] += 1
+            for link in links.values():
+                self.deletes.append(link.id)
+                report["deleted"].append(f"{combo.name}: {self._item(link.item_id).name}")
+
+    def _item(self, item_id):
+        return self.items.by_id[item_id]
+
+    def fetch_images(self):
+        """Fetch and normalise every image on a thread pool; keeps only the changed ones."""
+        if not self.images:
+            return
+        workers = _setting("MENU_IMPORT_IMAGE_WORKERS", 4)
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="menu-image") as pool:
+            results = list(pool.map(lambda entry: _fetch_image(entry[3]), self.images))
+
+        fetched = []
+        for (kind, row_no, obj, url), (image, problem) in zip(self.images, results):
+            if problem:
+                self.error(kind, row_no, f"image: {problem}")
+                continue
+            name, content = image
+            path = obj.image.field.generate_filename(obj, name)
+            if obj.image.name == path:
+                continue
+            fetched.append((obj, path, content))
+            if obj.pk:
+                if id(obj) not in self.updates[kind]:
+                    self.report[kind]["unchanged"] -= 1
+                self._changed(kind, obj)["image"] = [obj.image.name or None, path]
+        self.images = fetched
+
+    def save_images(self):
+        for obj, path, content in self.images:
+            storage = obj.image.storage
+            if not storage.exists(path):
+                path = storage.save(path, ContentFile(content))
+            obj.image.name = path
+
+    def apply(self):
+        with transaction.atomic():
+            for kind, model in (("categories", Category), ("items", Item), ("combos", ComboItem)):
+                if self.creates[kind]:
+                    model.objects.bulk_create(self.creates[kind])
+                if self.updates[kind]:
+                    objs = [obj for obj, _ in self.updates[kind].values()]
+                    fields = sorted(set().union(*(changes for _, changes in self.updates[kind].values())))
+                    model.objects.bulk_update(objs, fields, batch_size=500)
+            if self.deletes:
+                ComboItem.objects.filter(id__in=self.deletes).delete()
+            catalog.bump_on_commit()
+
+    @property
+    def changed(self):
+        return any(self.creates.values()) or any(self.updates.values()) or bool(self.deletes)
+
+
+def _fetch_image(url):
+    """``((name, bytes), None)`` for a downloaded image, or ``(None, error)``."""
+    if not url.startswith(("http://", "https://")):
+        return None, "must be an http(s) URL"
+    max_bytes = _setting("MENU_IMPORT_IMAGE_MAX_BYTES", 10 * 1024 * 1024)
+    try:
+        response = requests.get(url, timeout=_setting("MENU_IMPORT_IMAGE_TIMEOUT", 15), stream=True)
+        response.raise_for_status()
+        content = response.raw.read(max_bytes + 1, decode_content=True)
+    except requests.RequestException as e:
+        return None, f"could not fetch {url} ({e.__class__.__name__})"
+    if len(content) > max_bytes:
+        return None, f"{url} is larger than {max_bytes} bytes"
+
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            image.load()
+            image_format = image.format
+            max_side = _setting("MENU_IMPORT_IMAGE_MAX_SIDE", 1200)
+            if image_format not in IMAGE_FORMATS or max(image.size) > max_side:
+                # Re-encode oversized or unusual formats as a bounded JPEG.
+                image = image.convert("RGB")
+                image.thumbnail((max_side, max_side))
+                buffer = io.BytesIO()
+                image.save(buffer, "JPEG", quality=85, optimize=True)
+                content, image_format = buffer.getvalue(), "JPEG"
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError):
+        return None, f"{url} is not a readable image"
+
+    digest = hashlib.sha256(content).hexdigest()[:20]
+    return (f"{digest}.{IMAGE_FORMATS[image_format]}", content), None
+
+
+def import_menu(data, dry_run=False):
+    """
+    Diff ``data`` (``{"categories": [...], "items": [...], "combos": [...]}``)
+    against the menu and apply it unless ``dry_run``.
+
+    Returns the report: per kind ``created`` / ``updated`` (with
+    ``[old, new]`` per changed field) / ``unchanged`` (and ``deleted`` combo
+    links), plus ``errors``, ``dry_run`` and ``applied``.
+    """
+    job = _Import(data)
+    job.plan()
+    if not job.errors:
+        job.fetch_images()
+
+    applied = False
+    if not job.errors and not dry_run and job.changed:
+        job.save_images()
+        job.apply()
+        applied = True
+    return {**job.report, "errors": job.errors, "dry_run": dry_run, "applied": applied}
+
+
+def summary_lines(report):
+    """Human-readable lines for a report."""
+    lines = []
+    for kind in KINDS:
+        section = report[kind]
+        counts = f"{len(section['created'])} created, {len(section['updated'])} updated"
+        if "deleted" in section:
+            counts += f", {len(section['deleted'])} deleted"
+        lines.append(f"{kind}: {counts}, {section['unchanged']} unchanged")
+        lines += [f"  + {name}" for name in section["created"]]
+        for entry in section["updated"]:
+            changes = ", ".join(f"{field} {old} -> {new}" for field, (old, new) in entry["changes"].items())
+            lines.append(f"  ~ {entry['name']}: {changes}")
+        lines += [f"  - {name}" for name in section.get("deleted", [])]
+    lines += [f"error: {message}" for message in report["errors"]]
+    return lines
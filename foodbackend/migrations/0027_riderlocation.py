@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('foodbackend', '0026_api_performance_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RiderLocation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('latitude', models.DecimalField(decimal_places=6, max_digits=9)),
+                ('longitude', models.DecimalField(decimal_places=6, max_digits=9)),
+                ('recorded_at', models.DateTimeField()),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='rider_locations', to='foodbackend.order')),
+                ('rider', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='locations', to='foodbackend.rider')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['rider', 'recorded_at'], name='riderloc_rider_recorded_idx'), models.Index(fields=['order', 'recorded_at'], name='riderloc_order_recorded_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('foodbackend', '0027_riderlocation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RiderSyncEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=64)),
+                ('event_type', models.CharField(choices=[('accept', 'Accept Order'), ('deliver', 'Mark Delivered')], max_length=20)),
+                ('result', models.JSONField(default=dict)),
+                ('recorded_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.RemoveIndex(
+            model_name='riderlocation',
+            name='riderloc_rider_recorded_idx',
+        ),
+        migrations.AlterUniqueTogether(
+            name='riderlocation',
+            unique_together={('rider', 'recorded_at')},
+        ),
+        migrations.AddField(
+            model_name='ridersyncevent',
+            name='order',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='rider_sync_events', to='foodbackend.order'),
+        ),
+        migrations.AddField(
+            model_name='ridersyncevent',
+            name='rider',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sync_events', to='foodbackend.rider'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='ridersyncevent',
+            unique_together={('rider', 'event_id')},
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('foodbackend', '0028_ridersyncevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeliveryTrail',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('points', models.BinaryField()),
+                ('point_count', models.PositiveIntegerField(default=0)),
+                ('raw_point_count', models.PositiveIntegerField(default=0)),
+                ('distance_m', models.PositiveIntegerField(default=0)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('ended_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('order', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='trail', to='foodbackend.order')),
+                ('rider', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='trails', to='foodbackend.rider')),
+            ],
+        ),
+    ]
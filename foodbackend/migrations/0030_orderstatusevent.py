@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-19 04:49
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('foodbackend', '0029_deliverytrail'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderStatusEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_status', models.CharField(blank=True, max_length=20)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('confirmed', 'Confirmed'), ('preparing', 'Preparing'), ('ready_for_pickup', 'Ready For Pickup'), ('pickup_pending', 'Pickup Pending'), ('on_the_way', 'On The Way'), ('delivery_pending', 'Delivery Pending'), ('pickup_failed', 'Pickup Failed'), ('pickup_rescheduled', 'Pickup Rescheduled'), ('delivery_failed', 'Delivery Failed'), ('delivery_rescheduled', 'Delivery Rescheduled'), ('delivered', 'Delivered'), ('cancelled', 'Cancelled')], max_length=20)),
+                ('source', models.CharField(choices=[('customer', 'Customer'), ('rider', 'Rider'), ('staff', 'Staff'), ('system', 'System')], default='system', max_length=10)),
+                ('ts', models.DateTimeField(default=django.utils.timezone.now)),
+                ('actor', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='status_events', to='foodbackend.order')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['order', 'ts'], name='orderevent_order_ts_idx'), models.Index(fields=['status', 'ts'], name='orderevent_status_ts_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-19 05:10
+
+from django.db import migrations, models
+
+
+def backfill(apps, schema_editor):
+    from foodbackend import rollups
+
+    rollups.rebuild(apps=apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('foodbackend', '0031_order_admin_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('granularity', models.CharField(choices=[('hour', 'Hour'), ('day', 'Day')], max_length=4)),
+                ('bucket', models.DateTimeField(help_text='Start of the hour/day in ROLLUP_TIME_ZONE')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('confirmed', 'Confirmed'), ('preparing', 'Preparing'), ('ready_for_pickup', 'Ready For Pickup'), ('pickup_pending', 'Pickup Pending'), ('on_the_way', 'On The Way'), ('delivery_pending', 'Delivery Pending'), ('pickup_failed', 'Pickup Failed'), ('pickup_rescheduled', 'Pickup Rescheduled'), ('delivery_failed', 'Delivery Failed'), ('delivery_rescheduled', 'Delivery Rescheduled'), ('delivered', 'Delivered'), ('cancelled', 'Cancelled')], max_length=20)),
+                ('orders', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('discounts', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('delivery_charges', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('granularity', 'bucket', 'status'), name='orderrollup_bucket_status_uniq')],
+            },
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
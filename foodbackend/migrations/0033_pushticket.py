@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-19 05:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('foodbackend', '0032_orderrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PushTicket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ticket_id', models.CharField(max_length=64, unique=True)),
+                ('push_token', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['created_at'], name='pushticket_created_idx')],
+            },
+        ),
+    ]
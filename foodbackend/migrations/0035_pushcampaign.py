@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-19 05:30
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('foodbackend', '0034_notificationoutbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PushCampaign',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('title', models.CharField(max_length=100)),
+                ('body', models.CharField(max_length=255)),
+                ('data', models.JSONField(blank=True, default=dict)),
+                ('segment', models.JSONField(blank=True, default=dict)),
+                ('status', models.CharField(choices=[('draft', 'Draft'), ('running', 'Running'), ('paused', 'Paused'), ('completed', 'Completed'), ('cancelled', 'Cancelled')], default='draft', max_length=10)),
+                ('rate_per_minute', models.PositiveIntegerField(default=6000)),
+                ('total_recipients', models.PositiveIntegerField(default=0)),
+                ('sent_count', models.PositiveIntegerField(default=0)),
+                ('failed_count', models.PositiveIntegerField(default=0)),
+                ('last_recipient_id', models.BigIntegerField(default=0)),
+                ('lease_until', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'created_at'], name='campaign_status_created_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='CampaignRecipient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('push_token', models.CharField(max_length=255)),
+                ('campaign', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recipients', to='foodbackend.pushcampaign')),
+            ],
+            options={
+                'unique_together': {('campaign', 'push_token')},
+            },
+        ),
+    ]
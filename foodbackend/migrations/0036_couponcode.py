@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-19 05:36
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('foodbackend', '0035_pushcampaign'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='coupon',
+            name='max_uses_per_user',
+            field=models.PositiveIntegerField(blank=True, help_text='Maximum number of times one user can use this coupon (leave empty for unlimited)', null=True),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='unique_codes',
+            field=models.BooleanField(default=False, help_text='Redeemable only with single-use codes generated for it, not with the shared code'),
+        ),
+        migrations.CreateModel(
+            name='CouponCode',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('serial', models.PositiveIntegerField()),
+                ('redeemed_at', models.DateTimeField(blank=True, null=True)),
+                ('coupon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='codes', to='foodbackend.coupon')),
+                ('redeemed_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='usercouponusage',
+            name='coupon_code',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='usage', to='foodbackend.couponcode'),
+        ),
+        migrations.AddIndex(
+            model_name='usercouponusage',
+            index=models.Index(fields=['user', 'coupon'], name='couponusage_user_coupon_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='couponcode',
+            unique_together={('coupon', 'serial')},
+        ),
+    ]
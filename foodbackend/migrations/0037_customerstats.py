@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-19 05:40
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill(apps, schema_editor):
+    from foodbackend import customer_stats
+
+    customer_stats.rebuild(apps=apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('foodbackend', '0036_couponcode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='customer_stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('order_count', models.PositiveIntegerField(default=0)),
+                ('delivered_count', models.PositiveIntegerField(default=0)),
+                ('lifetime_spend', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('last_order_at', models.DateTimeField(blank=True, null=True)),
+                ('rating_count', models.PositiveIntegerField(default=0)),
+                ('rating_sum', models.PositiveIntegerField(default=0)),
+                ('average_rating', models.DecimalField(blank=True, decimal_places=2, max_digits=3, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('favorite_category', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='foodbackend.category')),
+            ],
+            options={
+                'verbose_name_plural': 'Customer stats',
+                'indexes': [models.Index(fields=['order_count'], name='custstats_orders_idx'), models.Index(fields=['lifetime_spend'], name='custstats_spend_idx'), models.Index(fields=['last_order_at'], name='custstats_last_order_idx')],
+            },
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
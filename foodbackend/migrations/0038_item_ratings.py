@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-19 05:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('foodbackend', '0037_customerstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='average_rating',
+            field=models.DecimalField(blank=True, decimal_places=2, editable=False, max_digits=3, null=True),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='recent_average_rating',
+            field=models.DecimalField(blank=True, decimal_places=2, editable=False, max_digits=3, null=True),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='recent_rating_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='orderitemreview',
+            name='item',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='reviews', to='foodbackend.item'),
+        ),
+        migrations.AddIndex(
+            model_name='orderitemreview',
+            index=models.Index(fields=['item', 'created_at'], name='itemreview_item_created_idx'),
+        ),
+    ]
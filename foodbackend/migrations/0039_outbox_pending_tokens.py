@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 06:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('foodbackend', '0038_item_ratings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notificationoutbox',
+            name='pending_tokens',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -107,6 +107,14 @@ class Item(models.Model):
         related_name="included_in_combos",
         blank=True,
     )
+    # Rating aggregates, maintained by item_ratings.py.
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    average_rating = models.DecimalField(max_digits=3, decimal_places=2, null=True, blank=True, editable=False)
+    recent_rating_count = models.PositiveIntegerField(default=0, editable=False)
+    recent_average_rating = models.DecimalField(
+        max_digits=3, decimal_places=2, null=True, blank=True, editable=False
+    )
 
     class Meta:
         indexes = [
@@ -122,7 +130,9 @@ class Item(models.Model):
     def get_effective_price(self):
         if not self.is_combo:
             return self.price
-        combo_items = self.combo_links.select_related("item")
+        combo_items = getattr(self, "prefetched_combo_links", None)
+        if combo_items is None:
+            combo_items = self.combo_links.select_related("item")
         return sum(ci.item.price * ci.quantity for ci in combo_items)
 
 
@@ -256,6 +266,9 @@ class Order(models.Model):
             models.Index(fields=["rider", "created_at"], name="order_rider_created_idx"),
             models.Index(fields=["status", "rider", "created_at"], name="order_status_rider_created_idx"),
             models.Index(fields=["rider_mobile"], name="order_rider_mobile_idx"),
+            models.Index(fields=["created_at", "id"], name="order_created_id_idx"),
+            models.Index(fields=["status", "created_at"], name="order_status_created_idx"),
+            models.Index(fields=["coupon", "created_at"], name="order_coupon_created_idx"),
         ]
 
     def __str__(self):
@@ -273,6 +286,140 @@ class OrderItem(models.Model):
         return f"{self.quantity} x {self.item.name if self.item else 'Deleted Item'}"
 
 
+class RiderLocation(models.Model):
+    """Append-only rider GPS history. The latest fix per rider lives in the cache."""
+    rider = models.ForeignKey(Rider, on_delete=models.CASCADE, related_name='locations')
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True, related_name='rider_locations')
+    latitude = models.DecimalField(max_digits=9, decimal_places=6)
+    longitude = models.DecimalField(max_digits=9, decimal_places=6)
+    recorded_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('rider', 'recorded_at')
+        indexes = [
+            models.Index(fields=["order", "recorded_at"], name="riderloc_order_recorded_idx"),
+        ]
+
+    def __str__(self):
+        return f"Rider {self.rider_id} @ {self.latitude},{self.longitude}"
+
+
+class RiderSyncEvent(models.Model):
+    """Status events replayed from a rider app's offline queue, kept so replays are idempotent."""
+    EVENT_TYPE_CHOICES = [
+        ('accept', 'Accept Order'),
+        ('deliver', 'Mark Delivered'),
+    ]
+
+    rider = models.ForeignKey(Rider, on_delete=models.CASCADE, related_name='sync_events')
+    event_id = models.CharField(max_length=64)
+    event_type = models.CharField(max_length=20, choices=EVENT_TYPE_CHOICES)
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True, related_name='rider_sync_events')
+    result = models.JSONField(default=dict)
+    recorded_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('rider', 'event_id')
+
+    def __str__(self):
+        return f"{self.event_type} {self.event_id} by rider {self.rider_id}"
+
+
+class DeliveryTrail(models.Model):
+    """Simplified, delta-encoded GPS trail of a delivery (format in trails.py)."""
+    order = models.OneToOneField(Order, on_delete=models.CASCADE, related_name='trail')
+    rider = models.ForeignKey(Rider, on_delete=models.SET_NULL, null=True, blank=True, related_name='trails')
+    points = models.BinaryField()
+    point_count = models.PositiveIntegerField(default=0)
+    raw_point_count = models.PositiveIntegerField(default=0)
+    distance_m = models.PositiveIntegerField(default=0)
+    started_at = models.DateTimeField(null=True, blank=True)
+    ended_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Trail for Order #{self.order_id} ({self.point_count} points)"
+
+
+class OrderStatusEvent(models.Model):
+    """Append-only log of order status transitions (see order_states.py)."""
+    SOURCE_CHOICES = [
+        ('customer', 'Customer'),
+        ('rider', 'Rider'),
+        ('staff', 'Staff'),
+        ('system', 'System'),
+    ]
+
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='status_events')
+    from_status = models.CharField(max_length=20, blank=True)
+    status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES)
+    source = models.CharField(max_length=10, choices=SOURCE_CHOICES, default='system')
+    actor = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    ts = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["order", "ts"], name="orderevent_order_ts_idx"),
+            models.Index(fields=["status", "ts"], name="orderevent_status_ts_idx"),
+        ]
+
+    def __str__(self):
+        return f"Order #{self.order_id}: {self.from_status or '-'} -> {self.status}"
+
+
+class OrderRollup(models.Model):
+    """Per-bucket order totals by current status, kept up to date by rollups.py."""
+    GRANULARITY_CHOICES = [
+        ('hour', 'Hour'),
+        ('day', 'Day'),
+    ]
+
+    granularity = models.CharField(max_length=4, choices=GRANULARITY_CHOICES)
+    bucket = models.DateTimeField(help_text="Start of the hour/day in ROLLUP_TIME_ZONE")
+    status = models.CharField(max_length=20, choices=Order.STATUS_CHOICES)
+    orders = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    discounts = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    delivery_charges = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["granularity", "bucket", "status"], name="orderrollup_bucket_status_uniq"),
+        ]
+
+    def __str__(self):
+        return f"{self.granularity} {self.bucket:%Y-%m-%d %H:%M} {self.status}: {self.orders}"
+
+
+class CustomerStats(models.Model):
+    """Per-customer order and review figures, kept up to date by customer_stats.py."""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='customer_stats')
+    order_count = models.PositiveIntegerField(default=0)
+    delivered_count = models.PositiveIntegerField(default=0)
+    lifetime_spend = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    last_order_at = models.DateTimeField(null=True, blank=True)
+    favorite_category = models.ForeignKey(
+        Category, on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    rating_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.PositiveIntegerField(default=0)
+    average_rating = models.DecimalField(max_digits=3, decimal_places=2, null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = "Customer stats"
+        indexes = [
+            models.Index(fields=["order_count"], name="custstats_orders_idx"),
+            models.Index(fields=["lifetime_spend"], name="custstats_spend_idx"),
+            models.Index(fields=["last_order_at"], name="custstats_last_order_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.user_id}: {self.order_count} orders, ₹{self.lifetime_spend}"
+
+
 class OrderReview(models.Model):
     order = models.OneToOneField(Order, on_delete=models.CASCADE, related_name='review')
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='order_reviews')
@@ -289,10 +436,17 @@ class OrderReview(models.Model):
 class OrderItemReview(models.Model):
     review = models.ForeignKey(OrderReview, on_delete=models.CASCADE, related_name='item_reviews')
     order_item = models.ForeignKey(OrderItem, on_delete=models.SET_NULL, null=True, blank=True, related_name='reviews')
+    # The order item's menu item, copied so item ratings aggregate without a join.
+    item = models.ForeignKey(Item, on_delete=models.SET_NULL, null=True, blank=True, related_name='reviews')
     item_name = models.CharField(max_length=150)
     rating = models.PositiveSmallIntegerField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["item", "created_at"], name="itemreview_item_created_idx"),
+        ]
+
     def __str__(self):
         return f"{self.item_name} ({self.rating}★)"
 class PushToken(models.Model):
@@ -311,6 +465,89 @@ class PushToken(models.Model):
         return f"{self.user.username} - {self.device_type}"
 
 
+class NotificationOutbox(models.Model):
+    """A status push owed to an order's customer; at most one pending row per order."""
+    order = models.OneToOneField(Order, on_delete=models.CASCADE, related_name='notification_outbox')
+    status = models.CharField(max_length=20)
+    version = models.PositiveIntegerField(default=0)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    available_at = models.DateTimeField()
+    last_error = models.CharField(max_length=255, blank=True)
+    # Tokens this version is still owed after a partly failed send; null means all of them.
+    pending_tokens = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["available_at"], name="outbox_available_idx"),
+        ]
+
+    def __str__(self):
+        return f"Order #{self.order_id}: {self.status}"
+
+
+class PushTicket(models.Model):
+    """An accepted Expo push whose delivery receipt has not been checked yet."""
+    ticket_id = models.CharField(max_length=64, unique=True)
+    push_token = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["created_at"], name="pushticket_created_idx"),
+        ]
+
+    def __str__(self):
+        return self.ticket_id
+
+
+class PushCampaign(models.Model):
+    """A marketing push to the devices of a user segment (see ``campaigns``)."""
+    STATUS_CHOICES = [
+        ('draft', 'Draft'),
+        ('running', 'Running'),
+        ('paused', 'Paused'),
+        ('completed', 'Completed'),
+        ('cancelled', 'Cancelled'),
+    ]
+
+    name = models.CharField(max_length=100)
+    title = models.CharField(max_length=100)
+    body = models.CharField(max_length=255)
+    data = models.JSONField(default=dict, blank=True)
+    segment = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='draft')
+    rate_per_minute = models.PositiveIntegerField(default=6000)
+    total_recipients = models.PositiveIntegerField(default=0)
+    sent_count = models.PositiveIntegerField(default=0)
+    failed_count = models.PositiveIntegerField(default=0)
+    last_recipient_id = models.BigIntegerField(default=0)
+    lease_until = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "created_at"], name="campaign_status_created_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.status})"
+
+
+class CampaignRecipient(models.Model):
+    """A device a campaign is addressed to, fixed when the campaign starts."""
+    campaign = models.ForeignKey(PushCampaign, on_delete=models.CASCADE, related_name='recipients')
+    push_token = models.CharField(max_length=255)
+
+    class Meta:
+        unique_together = ['campaign', 'push_token']
+
+    def __str__(self):
+        return f"{self.campaign_id}: {self.push_token}"
+
+
 class AppVersion(models.Model):
     """Track app versions for update notifications"""
     version = models.CharField(max_length=20, unique=True)
@@ -383,6 +620,15 @@ class Coupon(models.Model):
         blank=True,
         help_text="Maximum number of times this coupon can be used (leave empty for unlimited)"
     )
+    max_uses_per_user = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text="Maximum number of times one user can use this coupon (leave empty for unlimited)"
+    )
+    unique_codes = models.BooleanField(
+        default=False,
+        help_text="Redeemable only with single-use codes generated for it, not with the shared code"
+    )
     used_count = models.PositiveIntegerField(default=0)
     valid_from = models.DateTimeField(default=timezone.now)
     valid_until = models.DateTimeField(null=True, blank=True, help_text="Leave empty for no expiry")
@@ -420,24 +666,53 @@ class Coupon(models.Model):
 
     def can_be_used_by_user(self, user):
         """Check if user is eligible to use this coupon"""
+        # Same facts as the coupon list; coupons imports this module.
+        from .coupons import coupon_uses, order_count
+
         if self.for_first_time_users_only:
-            order_count = Order.objects.filter(user=user).count()
-            if order_count > 0:
+            if order_count(user):
                 return False, "Coupon is only for first-time users"
+
+        if self.max_uses_per_user:
+            if coupon_uses(user, self.id).get(self.id, 0) >= self.max_uses_per_user:
+                return False, "You have already used this coupon"
         
         return True, "Eligible"
 
 
+class CouponCode(models.Model):
+    """
+    One single-use code of a ``unique_codes`` coupon. The code text is not
+    stored: it is derived from ``(coupon, serial)`` (see ``coupon_codes``).
+    """
+    coupon = models.ForeignKey(Coupon, on_delete=models.CASCADE, related_name='codes')
+    serial = models.PositiveIntegerField()
+    redeemed_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    redeemed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ['coupon', 'serial']
+
+    def __str__(self):
+        return f"{self.coupon_id}#{self.serial}"
+
+
 class UserCouponUsage(models.Model):
     """Track which users have used which coupons"""
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='coupon_usage')
     coupon = models.ForeignKey(Coupon, on_delete=models.CASCADE, related_name='user_usage')
+    coupon_code = models.ForeignKey(
+        CouponCode, on_delete=models.SET_NULL, null=True, blank=True, related_name='usage'
+    )
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='coupon_usage')
     discount_amount = models.DecimalField(max_digits=10, decimal_places=2)
     used_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         ordering = ['-used_at']
+        indexes = [
+            models.Index(fields=["user", "coupon"], name="couponusage_user_coupon_idx"),
+        ]
 
     def __str__(self):
         return f"{self.user.username} used {self.coupon.code}"
@@ -0,0 +1,187 @@
+"""
+Order state machine.
+
+``TRANSITIONS`` declares which status may follow which. Every status change
+goes through :func:`transition`, which moves the order with a conditional
+``UPDATE ... WHERE status = <from>`` and appends an ``OrderStatusEvent`` in the
+same transaction, so the event log is a complete, ordered history that
+analytics can query directly (e.g. confirmed -> ready_for_pickup for prep time).
+Committed transitions are also published on the order's pub/sub channel and
+applied to the dashboard rollups (see rollups.py) and the customer's stats
+(see customer_stats.py). Every transition also owes the customer a push,
+which is queued in the notification outbox (see outbox.py).
+"""
+from django.db import transaction
+from django.utils import timezone
+
+from . import customer_stats, outbox, pubsub, rollups
+from .models import Order, OrderStatusEvent
+
+TRANSITIONS = {
+    "pending": {"confirmed", "cancelled"},
+    "confirmed": {"preparing", "cancelled"},
+    "preparing": {"ready_for_pickup", "cancelled"},
+    "ready_for_pickup": {"on_the_way", "delivered", "pickup_failed", "pickup_rescheduled", "cancelled"},
+    "pickup_pending": {"preparing", "ready_for_pickup", "delivered", "pickup_failed", "pickup_rescheduled", "cancelled"},
+    "pickup_failed": {"pickup_rescheduled", "cancelled"},
+    "pickup_rescheduled": {"ready_for_pickup", "pickup_pending", "delivered", "pickup_failed", "cancelled"},
+    "on_the_way": {"delivery_pending", "delivered", "delivery_failed", "delivery_rescheduled", "cancelled"},
+    "delivery_pending": {"on_the_way", "delivered", "delivery_failed", "delivery_rescheduled", "cancelled"},
+    "delivery_failed": {"on_the_way", "delivery_rescheduled", "cancelled"},
+    "delivery_rescheduled": {"on_the_way", "delivery_pending", "delivered", "delivery_failed", "cancelled"},
+    "delivered": set(),
+    "cancelled": set(),
+}
+
+TERMINAL_STATUSES = {status for status, targets in TRANSITIONS.items() if not targets}
+
+# Statuses the assigned rider may set through update_order_status. Delivery
+# itself needs the OTP and goes through mark_order_delivered.
+RIDER_STATUSES = {"on_the_way", "delivery_pending", "delivery_failed", "delivery_rescheduled"}
+
+
+class InvalidTransition(Exception):
+    def __init__(self, from_status, to_status):
+        self.from_status = from_status
+        self.to_status = to_status
+        super().__init__(f"Cannot move order from {from_status} to {to_status}")
+
+
+def can_transition(from_status, to_status):
+    return to_status in TRANSITIONS.get(from_status, ())
+
+
+def transition(order_id, from_status, to_status, source="system", actor=None, filters=None, **fields):
+    """
+    Move an order from ``from_status`` to ``to_status``.
+
+    The UPDATE only matches while the order is still in ``from_status`` (and
+    matches ``filters``), so concurrent writers cannot both win. Extra
+    ``fields`` are written in the same statement. Returns True when this call
+    made the change, False when the row had already moved on. Raises
+    InvalidTransition for edges the state machine does not allow.
+    """
+    if not can_transition(from_status, to_status):
+        raise InvalidTransition(from_status, to_status)
+
+    now = timezone.now()
+    with transaction.atomic():
+        updated = Order.objects.filter(id=order_id, status=from_status, **(filters or {})).update(
+            status=to_status,
+            updated_at=now,
+            **fields,
+        )
+        if not updated:
+            return False
+        OrderStatusEvent.objects.create(
+            order_id=order_id,
+            from_status=from_status,
+            status=to_status,
+            source=source,
+            actor=actor,
+            ts=now,
+        )
+        outbox.enqueue([(order_id, to_status)])
+        _publish_on_commit(order_id, from_status, to_status, now)
+        rollups.status_changed_on_commit(order_id, from_status, to_status)
+        customer_stats.status_changed_on_commit(order_id, from_status, to_status)
+    return True
+
+
+def transition_many(order_ids, to_status, source="system", actor=None):
+    """
+    Move many orders to ``to_status`` at once.
+
+    The orders are locked and checked against the state machine with one
+    ``SELECT ... FOR UPDATE``, moved with one ``UPDATE`` and logged with one
+    bulk insert of events. Returns ``(moved, skipped)``: ``(order,
+    from_status)`` pairs for the moved orders (``order`` carries ``id``,
+    ``status``, ``user_id``, ``rider_id`` and ``delivery_otp``) and
+    ``{order_id: reason}`` for the rest.
+    """
+    order_ids = set(order_ids)
+    now = timezone.now()
+    moved, skipped = [], {}
+    with transaction.atomic():
+        orders = list(
+            Order.objects.select_for_update()
+            .filter(id__in=order_ids)
+            .only("id", "status", "user_id", "rider_id", "delivery_otp")
+            # Lock in id order so concurrent batches cannot deadlock.
+            .order_by("id")
+        )
+        for order_id in order_ids - {order.id for order in orders}:
+            skipped[order_id] = "Order not found"
+        for order in orders:
+            if order.status == to_status:
+                skipped[order.id] = f"Order is already {to_status}"
+            elif not can_transition(order.status, to_status):
+                skipped[order.id] = str(InvalidTransition(order.status, to_status))
+            else:
+                moved.append((order, order.status))
+        if not moved:
+            return moved, skipped
+
+        Order.objects.filter(id__in=[order.id for order, _ in moved]).update(status=to_status, updated_at=now)
+        OrderStatusEvent.objects.bulk_create([
+            OrderStatusEvent(
+                order_id=order.id,
+                from_status=from_status,
+                status=to_status,
+                source=source,
+                actor=actor,
+                ts=now,
+            )
+            for order, from_status in moved
+        ])
+        outbox.enqueue([(order.id, to_status) for order, _ in moved])
+        for order, from_status in moved:
+            order.status = to_status
+            _publish_on_commit(order.id, from_status, to_status, now)
+        changes = [(order.id, from_status) for order, from_status in moved]
+        rollups.statuses_changed_on_commit(changes, to_status)
+        customer_stats.statuses_changed_on_commit(changes, to_status)
+    return moved, skipped
+
+
+def record_created(order, source="customer", actor=None):
+    """Log the initial status of a newly placed order."""
+    rollups.order_placed_on_commit(order)
+    customer_stats.order_placed_on_commit(order)
+    return OrderStatusEvent.objects.create(
+        order=order,
+        status=order.status,
+        source=source,
+        actor=actor,
+        ts=order.created_at or timezone.now(),
+    )
+
+
+def record_change(order_id, from_status, to_status, source="system", actor=None):
+    """Log a transition that was already written by a regular ``save()``."""
+    event = OrderStatusEvent.objects.create(
+        order_id=order_id,
+        from_status=from_status or "",
+        status=to_status,
+        source=source,
+        actor=actor,
+    )
+    outbox.enqueue([(order_id, to_status)])
+    _publish_on_commit(order_id, event.from_status, to_status, event.ts)
+    rollups.status_changed_on_commit(order_id, from_status, to_status)
+    customer_stats.status_changed_on_commit(order_id, from_status, to_status)
+    return event
+
+
+def _publish_on_commit(order_id, from_status, to_status, ts):
+    order_id = int(order_id)
+    message = {
+        "event": "status",
+        "data": {
+            "order_id": order_id,
+            "from_status": from_status,
+            "status": to_status,
+            "ts": ts.isoformat(),
+        },
+    }
+    transaction.on_commit(lambda: pubsub.publish(pubsub.order_channel(order_id), message))
@@ -0,0 +1,214 @@
+"""
+Transactional outbox for order status pushes.
+
+``order_states`` records every status change here in the same transaction as
+the change: one upsert into ``NotificationOutbox``, which keeps at most one
+row per order. A push is therefore owed exactly when the change commits, and
+the request that made it never waits on Expo.
+
+A row becomes due ``OUTBOX_COALESCE_SECONDS`` after it was first written.
+Changes to the same order before then only replace its status (and bump its
+``version``), so a burst like confirmed -> preparing -> ready_for_pickup
+reaches the customer as one push with the latest status.
+
+``drain`` (the ``run_notification_outbox`` worker) leases up to
+``OUTBOX_BATCH_SIZE`` due rows, sends them through ``push`` in one go and
+deletes the rows it delivered. Rows whose send failed are retried with
+exponential backoff, up to ``OUTBOX_MAX_ATTEMPTS`` times. A retry only goes
+to the devices that did not get the push, which the row keeps in
+``pending_tokens``; sends that Expo may have delivered anyway (see
+``push.DeliveryUnknown``) are not retried at all. A row that changed while
+its push was in flight is not deleted; it becomes due again at once so the
+newer status goes out. If a worker dies mid-batch its lease expires after
+``OUTBOX_LEASE_SECONDS`` and another worker picks the rows up.
+"""
+import operator
+from datetime import timedelta
+from functools import reduce
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import push
+from .models import NotificationOutbox, Order, PushToken
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def enqueue(changes):
+    """
+    Owe a push for each ``(order_id, status)``; call inside the transaction
+    that changes the status.
+    """
+    changes = dict(changes)
+    if not changes:
+        return
+    now = timezone.now()
+    available_at = now + timedelta(seconds=_setting("OUTBOX_COALESCE_SECONDS", 3))
+
+    ops = connection.ops
+    table = ops.quote_name(NotificationOutbox._meta.db_table)
+    params = []
+    for order_id, status in changes.items():
+        params += [
+            int(order_id),
+            status,
+            ops.adapt_datetimefield_value(available_at),
+            ops.adapt_datetimefield_value(now),
+        ]
+    placeholders = ", ".join(["(%s, %s, 0, 0, %s, '', NULL, %s)"] * len(changes))
+    sql = (
+        f"INSERT INTO {table} "
+        f"(order_id, status, version, attempts, available_at, last_error, pending_tokens, created_at) "
+        f"VALUES {placeholders} "
+        f"ON CONFLICT (order_id) DO UPDATE SET status = EXCLUDED.status, version = {table}.version + 1, "
+        f"pending_tokens = NULL"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+def order_status_message(order_id, new_status):
+    """(title, body, data) of the push for an order status change."""
+    # Status messages
+    status_messages = {
+        'confirmed': {
+            'title': '✅ Order Confirmed',
+            'body': f'Order #{order_id} has been confirmed and is being prepared.'
+        },
+        'preparing': {
+            'title': '👨‍🍳 Order is Being Prepared',
+            'body': f'Your delicious food is being prepared! Order #{order_id}'
+        },
+        'ready_for_pickup': {
+            'title': '📦 Order Ready for Pickup',
+            'body': f'Order #{order_id} is ready! Waiting for delivery partner.'
+        },
+        'on_the_way': {
+            'title': '🚴 Delivery Partner on the Way',
+            'body': f'Your order #{order_id} is on the way to you!'
+        },
+        'delivered': {
+            'title': '🎉 Order Delivered',
+            'body': f'Order #{order_id} has been delivered. Enjoy your meal!'
+        },
+        'cancelled': {
+            'title': '❌ Order Cancelled',
+            'body': f'Order #{order_id} has been cancelled.'
+        },
+    }
+
+    message = status_messages.get(new_status, {
+        'title': 'Order Update',
+        'body': f'Order #{order_id} status: {new_status}'
+    })
+
+    return (
+        message['title'],
+        message['body'],
+        {'order_id': order_id, 'status': new_status, 'type': 'order_update'},
+    )
+
+
+def send_order_statuses(statuses, only_tokens=None):
+    """
+    Push ``{order_id: status}`` to the orders' customers in one batch.
+    ``only_tokens`` (``{order_id: [push_token, ...]}``) limits an order to
+    those devices. Returns ``{order_id: [push_token, ...]}`` of the sends
+    worth retrying.
+    """
+    only_tokens = only_tokens or {}
+    owners = dict(Order.objects.filter(id__in=statuses).values_list("id", "user_id"))
+    tokens = {}
+    for user_id, token in PushToken.objects.filter(
+        user_id__in=set(owners.values()), is_active=True
+    ).values_list("user_id", "push_token"):
+        tokens.setdefault(user_id, []).append(token)
+
+    messages = []
+    for order_id, user_id in sorted(owners.items()):
+        order_tokens = tokens.get(user_id, [])
+        if order_id in only_tokens:
+            owed = set(only_tokens[order_id])
+            order_tokens = [token for token in order_tokens if token in owed]
+        if order_tokens:
+            messages += push.expo_messages(order_tokens, *order_status_message(order_id, statuses[order_id]))
+    if not messages:
+        return {}
+    failed = {}
+    for message in push.send_messages(messages, collect_failures=True)["failures"]:
+        failed.setdefault(message["data"]["order_id"], []).append(message["to"])
+    return failed
+
+
+def _lease():
+    """Claim the due rows for this worker. Returns them as dicts."""
+    now = timezone.now()
+    with transaction.atomic():
+        rows = list(
+            NotificationOutbox.objects.select_for_update(skip_locked=True)
+            .filter(available_at__lte=now)
+            .order_by("available_at")
+            .values("id", "order_id", "status", "version", "attempts", "pending_tokens")[
+                : _setting("OUTBOX_BATCH_SIZE", 500)
+            ]
+        )
+        lease_until = now + timedelta(seconds=_setting("OUTBOX_LEASE_SECONDS", 120))
+        NotificationOutbox.objects.filter(id__in=[row["id"] for row in rows]).update(available_at=lease_until)
+    return rows, lease_until
+
+
+def _same_version(rows):
+    return reduce(operator.or_, (Q(id=row["id"], version=row["version"]) for row in rows))
+
+
+def drain():
+    """Send one batch of due pushes. Returns ``{"sent", "retried", "dropped"}`` order counts."""
+    stats = {"sent": 0, "retried": 0, "dropped": 0}
+    rows, lease_until = _lease()
+    if not rows:
+        return stats
+
+    try:
+        failed = send_order_statuses(
+            {row["order_id"]: row["status"] for row in rows},
+            {row["order_id"]: row["pending_tokens"] for row in rows if row["pending_tokens"] is not None},
+        )
+    except Exception as e:
+        print(f"Order notification batch failed: {e}")
+        failed = {row["order_id"]: row["pending_tokens"] for row in rows}
+
+    now = timezone.now()
+    delivered = [row for row in rows if row["order_id"] not in failed]
+    if delivered:
+        NotificationOutbox.objects.filter(_same_version(delivered)).delete()
+        stats["sent"] = len(delivered)
+
+    max_attempts = _setting("OUTBOX_MAX_ATTEMPTS", 5)
+    backoff = _setting("OUTBOX_RETRY_BACKOFF", 30)
+    for row in rows:
+        if row["order_id"] not in failed:
+            continue
+        attempts = row["attempts"] + 1
+        pending = NotificationOutbox.objects.filter(id=row["id"], version=row["version"])
+        if attempts >= max_attempts:
+            if pending.delete()[0]:
+                print(f"Gave up on order #{row['order_id']} push after {attempts} attempts")
+                stats["dropped"] += 1
+            continue
+        stats["retried"] += pending.update(
+            attempts=attempts,
+            available_at=now + timedelta(seconds=backoff * 2 ** (attempts - 1)),
+            last_error="Expo send failed",
+            pending_tokens=failed[row["order_id"]],
+        )
+
+    # Rows that changed while in flight still hold the lease: send their new status now.
+    NotificationOutbox.objects.filter(id__in=[row["id"] for row in rows], available_at=lease_until).update(
+        available_at=now
+    )
+    return stats
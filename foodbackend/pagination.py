@@ -0,0 +1,205 @@
+"""
+Keyset (cursor) pagination for the app and admin list endpoints.
+
+Pages are ordered by ``(created_at, id)`` and continue from the last row a
+client has seen, so every page is an index range scan on the endpoint's
+``(<owner>, created_at)`` index no matter how much history sits behind it.
+An endpoint may order by another non-null column instead of ``created_at``,
+including one on a one-to-one related row; ``id`` always breaks ties.
+
+Query parameters:
+
+``page_size``
+    Rows per page, default ``API_PAGE_SIZE`` (20), capped at
+    ``API_MAX_PAGE_SIZE`` (100).
+``cursor``
+    Opaque ``next_cursor`` from a previous page; returns the next older page.
+``since``
+    Opaque ``since_cursor``; returns rows created after it, oldest first, for
+    incremental refresh. Keep polling with the new ``since_cursor`` while
+    ``has_more`` is true.
+"""
+import base64
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework import exceptions
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def encode_cursor(value, pk):
+    value = value.isoformat() if hasattr(value, "isoformat") else value
+    raw = f"{value}|{pk}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor, field):
+    """``(value, pk)`` from a cursor, with ``value`` converted for model ``field``."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        value, pk = raw.rsplit("|", 1)
+        value = field.to_python(value)
+        pk = int(pk)
+    except (ValueError, TypeError, UnicodeDecodeError, ValidationError):
+        raise InvalidCursor(cursor)
+    if value is None:
+        raise InvalidCursor(cursor)
+    return value, pk
+
+
+def _page_size(request, default, maximum):
+    try:
+        size = int(request.query_params.get("page_size", default))
+    except (TypeError, ValueError):
+        return None
+    return max(1, min(size, maximum))
+
+
+def _after(field, value, pk, descending):
+    """Rows strictly after ``(value, pk)`` in the page order."""
+    op = "lt" if descending else "gt"
+    # The bare range condition lets the planner bound the index scan.
+    return Q(**{f"{field}__{op}e": value}) & (Q(**{f"{field}__{op}": value}) | Q(**{f"pk__{op}": pk}))
+
+
+def _reversed(order):
+    return [name[1:] if name.startswith("-") else f"-{name}" for name in order]
+
+
+def _model_field(model, field):
+    """The model field behind ``field``, which may follow relations (``customer_stats__lifetime_spend``)."""
+    opts = model._meta
+    *relations, name = field.split("__")
+    for relation in relations:
+        opts = opts.get_field(relation).related_model._meta
+    return opts.pk if name == "pk" else opts.get_field(name)
+
+
+def _row_cursor(row, field):
+    value = row
+    for name in field.split("__"):
+        value = getattr(value, name)
+    return encode_cursor(value, row.pk)
+
+
+def paginate(queryset, request, field="created_at", descending=True, default_size=None, max_size=None):
+    """
+    Slice ``queryset`` into one keyset page ordered by ``(field, pk)``.
+
+    Returns ``(page, error)``. ``page`` has ``items`` (a list), ``has_more``,
+    ``next_cursor`` and ``since_cursor``, and ``since`` (True when the request
+    was an incremental refresh, whose items come in the opposite order).
+    """
+    size = _page_size(
+        request,
+        default_size or _setting("API_PAGE_SIZE", 20),
+        max_size or _setting("API_MAX_PAGE_SIZE", 100),
+    )
+    if size is None:
+        return None, "page_size must be an integer"
+
+    model_field = _model_field(queryset.model, field)
+    if model_field.primary_key and "__" not in field:
+        field = "pk"
+    order = [f"-{field}", "-pk"] if descending else [field, "pk"]
+    try:
+        cursor = request.query_params.get("cursor")
+        since = request.query_params.get("since")
+        if since:
+            value, pk = decode_cursor(since, model_field)
+            queryset = queryset.filter(_after(field, value, pk, not descending)).order_by(*_reversed(order))
+        else:
+            if cursor:
+                value, pk = decode_cursor(cursor, model_field)
+                queryset = queryset.filter(_after(field, value, pk, descending))
+            queryset = queryset.order_by(*order)
+    except InvalidCursor:
+        return None, "Invalid cursor"
+
+    items = list(queryset[: size + 1])
+    has_more = len(items) > size
+    items = items[:size]
+
+    if since:
+        return {
+            "items": items,
+            "has_more": has_more,
+            "next_cursor": None,
+            "since_cursor": _row_cursor(items[-1], field) if items else since,
+            "since": True,
+        }, None
+
+    return {
+        "items": items,
+        "has_more": has_more,
+        "next_cursor": _row_cursor(items[-1], field) if has_more else None,
+        # Only the first page knows the newest row a client has seen.
+        "since_cursor": _row_cursor(items[0], field) if items and not cursor else None,
+        "since": False,
+    }, None
+
+
+def page_fields(page):
+    """Cursor fields to merge into a dict response."""
+    return {
+        "next_cursor": page["next_cursor"],
+        "since_cursor": page["since_cursor"],
+        "has_more": page["has_more"],
+    }
+
+
+def set_page_headers(response, page):
+    """Cursor headers for endpoints whose body is a bare list."""
+    if page["next_cursor"]:
+        response["X-Next-Cursor"] = page["next_cursor"]
+    if page["since_cursor"]:
+        response["X-Since-Cursor"] = page["since_cursor"]
+    response["X-Has-More"] = "true" if page["has_more"] else "false"
+    return response
+
+
+class KeysetPagination(BasePagination):
+    """
+    DRF pagination class for ``paginate``.
+
+    The page order is the ``?ordering=`` field when the view lists it in
+    ``ordering_fields``, otherwise the view's ``ordering`` or the queryset's
+    ``order_by``. Responses stay bare lists; cursors go in the headers.
+    """
+    default_size_setting = "ADMIN_API_PAGE_SIZE"
+    max_size_setting = "ADMIN_API_MAX_PAGE_SIZE"
+
+    def _ordering(self, queryset, request, view):
+        requested = request.query_params.get("ordering", "")
+        if requested.lstrip("-") in getattr(view, "ordering_fields", []):
+            return requested
+        ordering = getattr(view, "ordering", None) or queryset.query.order_by
+        return ordering[0] if ordering else "-pk"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        ordering = self._ordering(queryset, request, view)
+        page, error = paginate(
+            queryset,
+            request,
+            field=ordering.lstrip("-"),
+            descending=ordering.startswith("-"),
+            default_size=_setting(self.default_size_setting, 50),
+            max_size=_setting(self.max_size_setting, 200),
+        )
+        if error:
+            raise exceptions.ValidationError({"detail": error})
+        self.page = page
+        return page["items"]
+
+    def get_paginated_response(self, data):
+        return set_page_headers(Response(data), self.page)
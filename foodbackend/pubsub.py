@@ -0,0 +1,214 @@
+"""
+Process-wide publish/subscribe for live order updates.
+
+Publishers are ordinary sync code (views, ``transaction.on_commit`` hooks);
+subscribers are async consumers such as the order SSE stream. Two brokers
+share the same interface:
+
+* ``local``    - in-process fan-out. Enough for a single ASGI worker and for
+                 development.
+* ``postgres`` - ``pg_notify`` on publish, plus one ``LISTEN`` connection per
+                 process that feeds the local fan-out, so every worker sees
+                 events published by every other worker.
+
+Pick one with ``PUBSUB_BACKEND``. Each subscription has a small bounded
+queue; a slow consumer loses its oldest messages rather than holding memory.
+"""
+import asyncio
+import json
+import select
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, connections
+
+PG_CHANNEL = "dipanddash_events"
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class Subscription:
+    """One consumer's queue, fed by any number of channels."""
+
+    def __init__(self, broker, loop):
+        self.broker = broker
+        self.channels = set()
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize=_setting("PUBSUB_QUEUE_SIZE", 100))
+
+    def push(self, message):
+        """Thread-safe: hand a message to the subscriber's event loop."""
+        try:
+            self._loop.call_soon_threadsafe(self._put, message)
+        except RuntimeError:
+            # Loop already closed; the subscriber is gone.
+            self.close()
+
+    def _put(self, message):
+        if self._queue.full():
+            self._queue.get_nowait()
+        self._queue.put_nowait(message)
+
+    async def get(self, timeout=None):
+        """Next message, or None if nothing arrived within ``timeout`` seconds."""
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def add(self, channel):
+        self.broker.join(self, channel)
+
+    def remove(self, channel):
+        self.broker.leave(self, channel)
+
+    def close(self):
+        for channel in list(self.channels):
+            self.broker.leave(self, channel)
+
+
+class LocalBroker:
+    def __init__(self):
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, *channels):
+        """Subscribe from inside a running event loop."""
+        subscription = Subscription(self, asyncio.get_running_loop())
+        for channel in channels:
+            self.join(subscription, channel)
+        return subscription
+
+    def join(self, subscription, channel):
+        with self._lock:
+            self._subscriptions.setdefault(channel, set()).add(subscription)
+            subscription.channels.add(channel)
+
+    def leave(self, subscription, channel):
+        with self._lock:
+            subscription.channels.discard(channel)
+            members = self._subscriptions.get(channel)
+            if members:
+                members.discard(subscription)
+                if not members:
+                    del self._subscriptions[channel]
+
+    def subscriber_count(self, channel=None):
+        with self._lock:
+            if channel is not None:
+                return len(self._subscriptions.get(channel, ()))
+            return sum(len(members) for members in self._subscriptions.values())
+
+    def publish(self, channel, message):
+        self._deliver(channel, message)
+
+    def _deliver(self, channel, message):
+        with self._lock:
+            members = list(self._subscriptions.get(channel, ()))
+        for subscription in members:
+            subscription.push(message)
+
+
+class PostgresBroker(LocalBroker):
+    """
+    Fan out through Postgres NOTIFY. All app channels share one Postgres
+    channel, so each process needs a single LISTEN connection no matter how
+    many orders are being watched.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._listener = None
+        self._listener_lock = threading.Lock()
+
+    def subscribe(self, *channels):
+        self._ensure_listener()
+        return super().subscribe(*channels)
+
+    def publish(self, channel, message):
+        payload = json.dumps({"channel": channel, "message": message}, default=str)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", [PG_CHANNEL, payload])
+
+    def _ensure_listener(self):
+        with self._listener_lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self._listen, name="pubsub-listener", daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        while True:
+            try:
+                self._listen_once()
+            except Exception as e:
+                print(f"Pub/sub listener error, reconnecting: {e}")
+                time.sleep(_setting("PUBSUB_RECONNECT_SECONDS", 2))
+
+    def _listen_once(self):
+        wrapper = connections["default"]
+        params = wrapper.get_connection_params()
+        if _setting("PUBSUB_LISTEN_HOST", ""):
+            params["host"] = settings.PUBSUB_LISTEN_HOST
+        conn = wrapper.get_new_connection(params)
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute(f"LISTEN {PG_CHANNEL}")
+            while True:
+                if select.select([conn], [], [], 5) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    try:
+                        data = json.loads(notify.payload)
+                    except ValueError:
+                        continue
+                    self._deliver(data["channel"], data["message"])
+        finally:
+            conn.close()
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            backend = _setting("PUBSUB_BACKEND", "local")
+            _broker = PostgresBroker() if backend == "postgres" else LocalBroker()
+        return _broker
+
+
+def is_shared():
+    """True when a subscriber sees messages published by every web worker."""
+    return _setting("PUBSUB_BACKEND", "local") == "postgres" or _setting("WEB_WORKERS", 1) <= 1
+
+
+def publish(channel, message):
+    """Publish a JSON-serialisable message. Failures are logged, never raised."""
+    try:
+        get_broker().publish(channel, message)
+    except Exception as e:
+        print(f"Pub/sub publish to {channel} failed: {e}")
+
+
+def subscribe(*channels):
+    return get_broker().subscribe(*channels)
+
+
+def order_channel(order_id):
+    return f"order:{order_id}"
+
+
+def rider_channel(rider_id):
+    return f"rider:{rider_id}"
+
+
+# Events addressed to every connected rider (broadcast offers, closed offers).
+RIDERS_CHANNEL = "riders"
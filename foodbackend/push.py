@@ -0,0 +1,269 @@
+"""
+Expo push delivery.
+
+Messages go to Expo in batches of at most ``EXPO_BATCH_SIZE`` (Expo's limit of
+100 per request), ``PUSH_CONCURRENCY`` requests at a time over one pooled
+``httpx.Client``. Broadcasts read their tokens in keyset chunks of
+``PUSH_TOKEN_CHUNK_SIZE`` and hand them to the senders as they go, so memory
+and fan-out cost follow the number of live devices rather than the size of
+the table, and no transaction stays open for the length of a broadcast.
+
+Expo answers every message with a ticket. A ticket that already reports
+``DeviceNotRegistered`` deactivates its token straight away; accepted tickets
+are saved as ``PushTicket`` rows and ``process_receipts`` (the
+``process_push_receipts`` command, run every few minutes) later asks Expo for
+their receipts, 1000 at a time, and deactivates every token Expo has dropped
+with one UPDATE per batch.
+
+Sends are not idempotent: a request Expo may already have accepted is never
+sent again. ``send`` is retried only on 429 and on errors that show the
+request never reached Expo (connect errors); a server error or a dropped
+response fails its batch as ``DeliveryUnknown``, which callers must not
+retry either. ``getReceipts`` is safe to repeat and retries on any transport
+error or 5xx.
+
+All database work happens on the calling thread; the pool threads only talk
+HTTP. ``EXPO_API_URL`` can point at ``expo_standin`` for tests and load tests.
+"""
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import timedelta
+
+import httpx
+from django.conf import settings
+from django.utils import timezone
+
+from .models import PushTicket, PushToken
+
+EXPO_BATCH_SIZE = 100
+EXPO_RECEIPT_BATCH_SIZE = 1000
+UNREGISTERED = "DeviceNotRegistered"
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def expo_url(path):
+    return f"{_setting('EXPO_API_URL', 'https://exp.host/--/api/v2/push').rstrip('/')}/{path}"
+
+
+def http_client():
+    """Process-wide pooled client shared by the sender threads."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            headers = {"Accept": "application/json", "Accept-Encoding": "gzip, deflate"}
+            access_token = _setting("EXPO_ACCESS_TOKEN", "")
+            if access_token:
+                headers["Authorization"] = f"Bearer {access_token}"
+            concurrency = _setting("PUSH_CONCURRENCY", 6)
+            _client = httpx.Client(
+                timeout=10,
+                headers=headers,
+                limits=httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency),
+            )
+        return _client
+
+
+def expo_messages(push_tokens, title, body, data=None):
+    return [
+        {
+            "to": token,
+            "sound": "default",
+            "title": title,
+            "body": body,
+            "data": data or {},
+            "priority": "high",
+            "channelId": "order-updates",
+        }
+        for token in push_tokens
+    ]
+
+
+def batches(items, size=EXPO_BATCH_SIZE):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Errors raised before the request could reach Expo.
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class DeliveryUnknown(httpx.HTTPError):
+    """Expo may have accepted the request; sending it again could duplicate it."""
+
+
+def _post(path, payload, idempotent=True):
+    """
+    POST to Expo and return the JSON body. Throttling and connect errors are
+    retried; server errors and dropped responses only when ``idempotent``,
+    otherwise they raise ``DeliveryUnknown`` at once.
+    """
+    attempts = _setting("PUSH_MAX_ATTEMPTS", 3)
+    backoff = _setting("PUSH_RETRY_BACKOFF", 1.0)
+    for attempt in range(1, attempts + 1):
+        try:
+            response = http_client().post(expo_url(path), json=payload)
+            if response.status_code != 429 and response.status_code < 500:
+                response.raise_for_status()
+                return response.json()
+            error = f"HTTP {response.status_code}"
+            if response.status_code != 429 and not idempotent:
+                raise DeliveryUnknown(f"Expo {path} failed ({error})")
+        except NOT_SENT_ERRORS as e:
+            error = f"{e.__class__.__name__}"
+        except httpx.TransportError as e:
+            error = f"{e.__class__.__name__}"
+            if not idempotent:
+                raise DeliveryUnknown(f"Expo {path} failed ({error})") from e
+        if attempt < attempts:
+            time.sleep(backoff * 2 ** (attempt - 1))
+    raise httpx.HTTPError(f"Expo {path} failed after {attempts} attempts ({error})")
+
+
+def _send_batch(batch):
+    """``(batch, tickets, error, retryable)`` for one Expo send request; runs on a pool thread."""
+    try:
+        return batch, _post("send", batch, idempotent=False).get("data") or [], None, False
+    except DeliveryUnknown as e:
+        return batch, [], str(e), False
+    except (httpx.HTTPError, ValueError) as e:
+        return batch, [], str(e), True
+
+
+def _record(result, stats):
+    batch, tickets, error, retryable = result
+    if error:
+        print(f"✗ Failed to send {len(batch)} notifications: {error}")
+        stats["failed"] += len(batch)
+        if retryable and "failures" in stats:
+            stats["failures"] += batch
+        return
+    record_tickets(batch, tickets, stats)
+
+
+def record_tickets(batch, tickets, stats=None):
+    """Save the accepted tickets of one sent batch and deactivate the tokens Expo rejected."""
+    stats = stats if stats is not None else {"sent": 0, "failed": 0, "deactivated": 0}
+    accepted, unregistered = [], []
+    for message, ticket in zip(batch, tickets):
+        if ticket.get("status") == "ok" and ticket.get("id"):
+            accepted.append(PushTicket(ticket_id=ticket["id"], push_token=message["to"]))
+        elif (ticket.get("details") or {}).get("error") == UNREGISTERED:
+            unregistered.append(message["to"])
+        else:
+            stats["failed"] += 1
+            if "failures" in stats:
+                stats["failures"].append(message)
+    PushTicket.objects.bulk_create(accepted, ignore_conflicts=True)
+    stats["sent"] += len(accepted)
+    stats["deactivated"] += deactivate(unregistered)
+    return stats
+
+
+def deactivate(push_tokens):
+    if not push_tokens:
+        return 0
+    return PushToken.objects.filter(push_token__in=set(push_tokens), is_active=True).update(
+        is_active=False, updated_at=timezone.now()
+    )
+
+
+def send_messages(messages, collect_failures=False):
+    """
+    Send Expo messages (any iterable, consumed lazily) and return
+    ``{"sent", "failed", "deactivated"}`` counts, plus the ``failures``
+    (messages worth retrying) when ``collect_failures`` is set.
+    """
+    stats = {"sent": 0, "failed": 0, "deactivated": 0}
+    if collect_failures:
+        stats["failures"] = []
+    concurrency = _setting("PUSH_CONCURRENCY", 6)
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="expo-push") as pool:
+        pending = set()
+        for batch in batches(messages):
+            # Bound the batches in flight so a huge broadcast never queues up in memory.
+            while len(pending) >= concurrency * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    _record(future.result(), stats)
+            pending.add(pool.submit(_send_batch, batch))
+        for future in pending:
+            _record(future.result(), stats)
+    if stats["sent"] or stats["failed"]:
+        print(f"✓ Sent {stats['sent']} notifications ({stats['failed']} failed, {stats['deactivated']} tokens deactivated)")
+    return stats
+
+
+def stream_tokens(queryset):
+    """Active push tokens of ``queryset`` in id order, fetched ``PUSH_TOKEN_CHUNK_SIZE`` at a time."""
+    queryset = queryset.filter(is_active=True).order_by("id")
+    size = _setting("PUSH_TOKEN_CHUNK_SIZE", 1000)
+    last_id = 0
+    while True:
+        chunk = list(queryset.filter(id__gt=last_id).values_list("id", "push_token")[:size])
+        for _, token in chunk:
+            yield token
+        if len(chunk) < size:
+            return
+        last_id = chunk[-1][0]
+
+
+def broadcast(tokens, title, body, data=None):
+    """Send one notification to every active token in the ``PushToken`` queryset ``tokens``."""
+    return send_messages(
+        message
+        for batch in batches(stream_tokens(tokens))
+        for message in expo_messages(batch, title, body, data)
+    )
+
+
+def process_receipts():
+    """
+    Check the receipts of tickets older than ``PUSH_RECEIPT_DELAY`` seconds.
+
+    Tickets with a receipt, and tickets past Expo's 24 hour receipt window,
+    are deleted. Returns ``{"checked", "deactivated", "expired"}`` counts.
+    """
+    now = timezone.now()
+    ready = PushTicket.objects.filter(created_at__lte=now - timedelta(seconds=_setting("PUSH_RECEIPT_DELAY", 900)))
+    stats = {"checked": 0, "deactivated": 0, "expired": 0}
+    last_id = 0
+    while True:
+        tickets = list(ready.filter(id__gt=last_id).order_by("id").values_list("id", "ticket_id", "push_token")[
+            :EXPO_RECEIPT_BATCH_SIZE
+        ])
+        if not tickets:
+            break
+        last_id = tickets[-1][0]
+        try:
+            receipts = _post("getReceipts", {"ids": [ticket_id for _, ticket_id, _ in tickets]}).get("data") or {}
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"✗ Failed to fetch push receipts: {e}")
+            break
+
+        done, unregistered = [], []
+        for pk, ticket_id, token in tickets:
+            receipt = receipts.get(ticket_id)
+            if receipt is None:
+                continue
+            done.append(pk)
+            if (receipt.get("details") or {}).get("error") == UNREGISTERED:
+                unregistered.append(token)
+        PushTicket.objects.filter(id__in=done).delete()
+        stats["checked"] += len(done)
+        stats["deactivated"] += deactivate(unregistered)
+
+    stats["expired"], _ = PushTicket.objects.filter(created_at__lte=now - timedelta(hours=24)).delete()
+    return stats
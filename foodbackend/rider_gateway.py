@@ -0,0 +1,408 @@
+"""
+WebSocket gateway for rider apps, mounted by ``food/asgi.py`` at ``/ws/rider/``.
+
+One persistent connection replaces location pings, polling the ready list
+and the accept/deliver calls. All frames are JSON text.
+
+Connect with ``?token=<jwt>`` (or an ``Authorization: Bearer`` header). To
+resume after a drop add ``&session=<id>&last_seq=<n>`` from the previous
+``welcome`` and the last message seen. When pub/sub is not shared between the
+processes (``pubsub.is_shared``) the socket is closed with 4503 and the app
+should fall back to polling.
+
+Rider -> server::
+
+    {"type": "fix", "order_id": 12, "latitude": .., "longitude": .., "recorded_at": ".."}
+    {"type": "fixes", "fixes": [<fix>, ...]}
+    {"type": "accept", "ref": "a1", "order_id": 12}
+    {"type": "deliver", "ref": "d1", "order_id": 12, "otp": "1234"}
+    {"type": "ack", "seq": 41}
+    {"type": "ping"} / {"type": "pong"}
+
+Server -> rider (every data message carries a ``seq``)::
+
+    {"type": "welcome", "session": "..", "resumed": true, "seq": 41, "heartbeat": 20}
+    {"type": "snapshot", "seq": 42, "data": {"assignments": [..], "offers": [..]}}
+    {"type": "offer" | "offer_closed" | "order_status" | "result", "seq": .., "data": {..}}
+    {"type": "ping"} / {"type": "pong"} / {"type": "error", "error": ".."}
+
+Fixes are decoded on the event loop and written in batches off it, so a fix
+costs a frame decode rather than a Django request. Outbound messages go
+through a bounded queue; a client that cannot keep up is closed with 1013
+and resumes. Unacknowledged messages are kept per session and replayed on
+resume, followed by a fresh snapshot. Sessions are saved to the shared cache
+on disconnect, so a resume can land on any worker that shares that cache.
+While connected the rider counts as online for dispatch; when their latest
+connection closes they are offered nothing until they reconnect.
+"""
+import asyncio
+import json
+import time
+import uuid
+from datetime import timedelta
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.utils import timezone
+
+from . import dispatch, order_states, pubsub, rider_location
+from .models import Rider
+from .streams import authenticate_token
+from .views import _accept_order, _deliver_order, _mark_order_on_the_way, ready_orders_for_rider, rider_assignments
+
+PATH = "/ws/rider/"
+SESSION_KEY = "rider_gateway:session:{session_id}"
+CONNECTION_KEY = "rider_gateway:connection:{rider_id}"
+
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_HEARTBEAT_TIMEOUT = 4408
+CLOSE_UNAVAILABLE = 4503
+CLOSE_TRY_AGAIN_LATER = 1013
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _db(func):
+    """Run ORM/cache work off the event loop, recycling stale connections like a request would."""
+    def run(*args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return sync_to_async(run, thread_sensitive=False)
+
+
+def _get_rider(raw_token):
+    user = authenticate_token(raw_token)
+    if user is None:
+        return None
+    return Rider.objects.select_related("user").filter(user=user, is_active=True).first()
+
+
+def _load_session(session_id, rider_id):
+    if not session_id:
+        return None
+    session = cache.get(SESSION_KEY.format(session_id=session_id))
+    if not session or session["rider_id"] != rider_id:
+        return None
+    return session
+
+
+def _save_session(session_id, rider_id, seq, log):
+    cache.set(
+        SESSION_KEY.format(session_id=session_id),
+        {"rider_id": rider_id, "seq": seq, "log": log},
+        timeout=_setting("RIDER_GATEWAY_SESSION_TTL_SECONDS", 300),
+    )
+
+
+def _connected(rider_id, connection_id):
+    cache.set(CONNECTION_KEY.format(rider_id=rider_id), connection_id, timeout=None)
+    dispatch.rider_online(rider_id)
+
+
+def _disconnected(rider_id, connection_id):
+    # A newer connection (a resume that beat this one's close, another device)
+    # keeps the rider online.
+    key = CONNECTION_KEY.format(rider_id=rider_id)
+    if cache.get(key) == connection_id:
+        cache.delete(key)
+        dispatch.rider_offline(rider_id)
+
+
+def _snapshot(rider):
+    return {
+        "assignments": rider_assignments(rider),
+        "offers": ready_orders_for_rider(rider),
+    }
+
+
+def _apply_fixes(rider, fixes):
+    """Record a batch of decoded fixes; the same rules as the HTTP location endpoint."""
+    orders = {}
+    for order_id, latitude, longitude, recorded_at in sorted(fixes, key=lambda fix: fix[3]):
+        if order_id is not None:
+            if order_id not in orders:
+                order = rider_location.get_tracked_order(order_id, rider_id=rider.id)
+                orders[order_id] = order and _mark_order_on_the_way(order, actor=rider.user)
+            if not orders[order_id]:
+                continue
+        rider_location.record_position(rider.id, order_id, latitude, longitude, recorded_at)
+
+
+def _parse_fix(fix):
+    if not isinstance(fix, dict):
+        return None
+    latitude, longitude = rider_location.parse_coordinates(fix.get("latitude"), fix.get("longitude"))
+    if latitude is None:
+        return None
+    order_id = fix.get("order_id")
+    if order_id is not None:
+        try:
+            order_id = int(order_id)
+        except (TypeError, ValueError):
+            return None
+    now = timezone.now()
+    recorded_at = now
+    if fix.get("recorded_at"):
+        recorded_at = rider_location.parse_timestamp(fix.get("recorded_at"))
+        if recorded_at is None or recorded_at > now + timedelta(minutes=5):
+            return None
+    return order_id, latitude, longitude, recorded_at
+
+
+class _Backpressure(Exception):
+    pass
+
+
+class RiderConnection:
+    def __init__(self, scope, receive, send):
+        self.scope = scope
+        self.receive = receive
+        self.send = send
+        self.rider = None
+        self.session_id = None
+        self.seq = 0
+        self.log = []
+        self.subscription = None
+        self.outbox = asyncio.Queue(maxsize=_setting("RIDER_GATEWAY_SEND_QUEUE_SIZE", 256))
+        self.pending_fixes = []
+        self.fixes_ready = asyncio.Event()
+        self.fix_write = None
+        self.last_seen = time.monotonic()
+        self.close_code = None
+
+    async def run(self):
+        message = await self.receive()
+        if message["type"] != "websocket.connect":
+            return
+        if not pubsub.is_shared():
+            # Offers and status events published by other processes would never arrive.
+            await self.send({"type": "websocket.accept"})
+            await self.send({"type": "websocket.close", "code": CLOSE_UNAVAILABLE})
+            return
+
+        params = {key: values[0] for key, values in parse_qs(self.scope.get("query_string", b"").decode()).items()}
+        self.rider = await _db(_get_rider)(params.get("token") or self._header_token())
+        if self.rider is None:
+            await self.send({"type": "websocket.close", "code": CLOSE_UNAUTHORIZED})
+            return
+
+        session = await _db(_load_session)(params.get("session"), self.rider.id)
+        if session:
+            self.session_id = params["session"]
+            self.seq = session["seq"]
+            self.log = session["log"]
+        else:
+            self.session_id = uuid.uuid4().hex
+
+        # Subscribe before the snapshot is read so nothing slips in between.
+        self.subscription = pubsub.subscribe(pubsub.rider_channel(self.rider.id), pubsub.RIDERS_CHANNEL)
+        await self.send({"type": "websocket.accept"})
+        connection_id = uuid.uuid4().hex
+        await _db(_connected)(self.rider.id, connection_id)
+        try:
+            await self._start(session, params.get("last_seq"))
+            await self._serve()
+        finally:
+            self.subscription.close()
+            await _db(_save_session)(self.session_id, self.rider.id, self.seq, self.log)
+            await _db(_disconnected)(self.rider.id, connection_id)
+
+    def _header_token(self):
+        for name, value in self.scope.get("headers", []):
+            if name == b"authorization":
+                parts = value.decode().split()
+                if len(parts) == 2:
+                    return parts[1]
+        return None
+
+    async def _start(self, session, last_seq):
+        self.control({
+            "type": "welcome",
+            "session": self.session_id,
+            "resumed": bool(session),
+            "seq": self.seq,
+            "heartbeat": _setting("RIDER_GATEWAY_HEARTBEAT_SECONDS", 20),
+        })
+        if session:
+            try:
+                last_seq = int(last_seq)
+            except (TypeError, ValueError):
+                last_seq = 0
+            self._trim(last_seq)
+            for message in self.log:
+                self._enqueue(message)
+
+        snapshot = await _db(_snapshot)(self.rider)
+        for order in snapshot["assignments"]:
+            self.subscription.add(pubsub.order_channel(order["id"]))
+        self.emit("snapshot", snapshot)
+
+    async def _serve(self):
+        tasks = [
+            asyncio.ensure_future(self._read()),
+            asyncio.ensure_future(self._write()),
+            asyncio.ensure_future(self._pump()),
+            asyncio.ensure_future(self._heartbeat()),
+            asyncio.ensure_future(self._write_fixes()),
+        ]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.cancelled() and isinstance(task.exception(), _Backpressure):
+                    self.close_code = CLOSE_TRY_AGAIN_LATER
+                elif not task.cancelled() and task.exception():
+                    print(f"Rider gateway error for rider {self.rider.id}: {task.exception()}")
+                    self.close_code = self.close_code or 1011
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if self.fix_write:
+                # A batch already handed to a thread; let it land before the tail.
+                await asyncio.gather(self.fix_write, return_exceptions=True)
+            if self.pending_fixes:
+                await _db(_apply_fixes)(self.rider, self.pending_fixes)
+            if self.close_code:
+                try:
+                    await self.send({"type": "websocket.close", "code": self.close_code})
+                except Exception:
+                    pass
+
+    # Outbound
+
+    def emit(self, message_type, data):
+        """Queue a sequenced message; it is kept for replay until acknowledged."""
+        self.seq += 1
+        message = {"type": message_type, "seq": self.seq, "data": data}
+        self.log.append(message)
+        replay_size = _setting("RIDER_GATEWAY_REPLAY_SIZE", 100)
+        if len(self.log) > replay_size:
+            del self.log[:-replay_size]
+        self._enqueue(message)
+
+    def control(self, message):
+        self._enqueue(message)
+
+    def _enqueue(self, message):
+        try:
+            self.outbox.put_nowait(message)
+        except asyncio.QueueFull:
+            raise _Backpressure()
+
+    def _trim(self, seq):
+        self.log = [message for message in self.log if message["seq"] > seq]
+
+    async def _write(self):
+        while True:
+            message = await self.outbox.get()
+            await self.send({"type": "websocket.send", "text": json.dumps(message, default=str)})
+
+    async def _pump(self):
+        while True:
+            message = await self.subscription.get()
+            event, data = message["event"], message["data"]
+            if event == "offer":
+                offers = await _db(ready_orders_for_rider)(self.rider, [data["order_id"]])
+                if offers:
+                    self.emit("offer", offers[0])
+            elif event == "offer_closed":
+                self.emit("offer_closed", data)
+            elif event == "status":
+                self.emit("order_status", data)
+                if data["status"] in order_states.TERMINAL_STATUSES:
+                    self.subscription.remove(pubsub.order_channel(data["order_id"]))
+
+    async def _heartbeat(self):
+        interval = _setting("RIDER_GATEWAY_HEARTBEAT_SECONDS", 20)
+        while True:
+            await asyncio.sleep(interval)
+            if time.monotonic() - self.last_seen > interval * 2.5:
+                self.close_code = CLOSE_HEARTBEAT_TIMEOUT
+                return
+            self.control({"type": "ping"})
+
+    # Inbound
+
+    async def _read(self):
+        while True:
+            message = await self.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            if message["type"] != "websocket.receive":
+                continue
+            self.last_seen = time.monotonic()
+            try:
+                frame = json.loads(message.get("text") or message.get("bytes") or b"")
+            except ValueError:
+                self.control({"type": "error", "error": "Invalid JSON"})
+                continue
+            if not isinstance(frame, dict):
+                self.control({"type": "error", "error": "Invalid frame"})
+                continue
+            await self._handle(frame)
+
+    async def _handle(self, frame):
+        frame_type = frame.get("type")
+        if frame_type == "fix":
+            self._queue_fixes([frame])
+        elif frame_type == "fixes":
+            self._queue_fixes(frame.get("fixes") or [])
+        elif frame_type == "ping":
+            self.control({"type": "pong"})
+        elif frame_type == "pong":
+            pass
+        elif frame_type == "ack":
+            try:
+                self._trim(int(frame.get("seq")))
+            except (TypeError, ValueError):
+                self.control({"type": "error", "error": "Invalid ack"})
+        elif frame_type == "accept":
+            payload, error, _ = await _db(_accept_order)(self.rider, frame.get("order_id"))
+            if payload:
+                self.subscription.add(pubsub.order_channel(payload["order_id"]))
+            self._result(frame, payload, error)
+        elif frame_type == "deliver":
+            payload, error, _ = await _db(_deliver_order)(self.rider, frame.get("order_id"), frame.get("otp"))
+            if payload:
+                self.subscription.remove(pubsub.order_channel(payload["order_id"]))
+            self._result(frame, payload, error)
+        else:
+            self.control({"type": "error", "error": "Unknown frame type"})
+
+    def _result(self, frame, payload, error):
+        result = {"ref": frame.get("ref"), "action": frame.get("type"), "success": error is None}
+        result.update(payload or {"error": error})
+        self.emit("result", result)
+
+    def _queue_fixes(self, fixes):
+        for fix in fixes:
+            parsed = _parse_fix(fix)
+            if parsed:
+                self.pending_fixes.append(parsed)
+        max_pending = _setting("RIDER_GATEWAY_MAX_PENDING_FIXES", 500)
+        if len(self.pending_fixes) > max_pending:
+            # The writer is behind; keep the newest fixes.
+            del self.pending_fixes[:-max_pending]
+        if self.pending_fixes:
+            self.fixes_ready.set()
+
+    async def _write_fixes(self):
+        while True:
+            await self.fixes_ready.wait()
+            self.fixes_ready.clear()
+            batch, self.pending_fixes = self.pending_fixes, []
+            self.fix_write = asyncio.ensure_future(_db(_apply_fixes)(self.rider, batch))
+            await asyncio.shield(self.fix_write)
+
+
+async def application(scope, receive, send):
+    """Raw ASGI app for rider WebSocket connections."""
+    await RiderConnection(scope, receive, send).run()
@@ -0,0 +1,273 @@
+"""
+Rider location store.
+
+The latest fix per rider is kept in the shared cache so GPS pings never touch
+the ``Order`` row. Fixes that move the rider far enough (or arrive after a
+long enough gap) are written straight to the append-only ``RiderLocation``
+history table; the thresholds keep that to a few rows per rider per minute,
+and nothing is held in worker memory where a killed worker would lose it.
+Everything in between only refreshes the cached position.
+"""
+import math
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Order, RiderLocation
+
+LATEST_KEY = "rider_location:latest:{rider_id}"
+ORDER_KEY = "rider_location:order:{order_id}"
+STATS_KEY = "rider_location:stats:{name}"
+
+EARTH_RADIUS_M = 6371000
+
+# Statuses during which the live position is meaningful for an order.
+LIVE_STATUSES = {
+    "ready_for_pickup",
+    "on_the_way",
+    "delivery_pending",
+    "delivery_failed",
+    "delivery_rescheduled",
+}
+
+_position_listeners = []
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def parse_coordinates(latitude, longitude):
+    """Return ``(lat, lng)`` as floats, or ``(None, None)`` if out of range."""
+    try:
+        lat = float(latitude)
+        lng = float(longitude)
+    except (TypeError, ValueError):
+        return None, None
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None, None
+    return lat, lng
+
+
+def parse_timestamp(value):
+    """Parse a client ISO-8601 timestamp into an aware datetime, or None."""
+    try:
+        parsed = parse_datetime(str(value))
+    except ValueError:
+        return None
+    if parsed is not None and timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def get_tracked_order(order_id, rider_id=None, rider_mobile=None):
+    """
+    Return a small snapshot of the order a rider is reporting for.
+
+    The snapshot is cached briefly so a steady stream of pings does not
+    re-read the order every time. Returns None when the order does not exist
+    or does not belong to the given rider.
+    """
+    try:
+        order_id = int(order_id)
+    except (TypeError, ValueError):
+        return None
+
+    key = ORDER_KEY.format(order_id=order_id)
+    snapshot = cache.get(key)
+    if snapshot is None:
+        snapshot = (
+            Order.objects.filter(id=order_id)
+            .values("id", "status", "rider_id", "rider_name", "rider_mobile", "delivery_otp")
+            .first()
+        )
+        if snapshot is None:
+            return None
+        cache.set(key, snapshot, timeout=_setting("RIDER_LOCATION_ORDER_CACHE_TTL", 30))
+
+    if rider_id is not None and snapshot["rider_id"] != rider_id:
+        return None
+    if rider_mobile is not None and snapshot["rider_mobile"] != str(rider_mobile):
+        return None
+    return snapshot
+
+
+def forget_order(order_id):
+    """Drop the cached order snapshot after the order row changes."""
+    cache.delete(ORDER_KEY.format(order_id=order_id))
+
+
+def record_position(rider_id, order_id, latitude, longitude, recorded_at=None):
+    """
+    Store the latest fix for a rider. The fix is only written to the history
+    table when the rider has moved far enough or enough time has passed since
+    the last persisted fix; otherwise it just refreshes the live position.
+    """
+    recorded_at = recorded_at or timezone.now()
+    persist = _should_persist(get_position(rider_id), order_id, latitude, longitude, recorded_at)
+    position = store_latest(rider_id, order_id, latitude, longitude, recorded_at, persisted=persist)
+
+    if persist:
+        _write_history([
+            RiderLocation(
+                rider_id=rider_id,
+                order_id=order_id,
+                latitude=round(latitude, 6),
+                longitude=round(longitude, 6),
+                recorded_at=recorded_at,
+            )
+        ])
+        _count("accepted")
+    else:
+        _count("coalesced")
+    return position
+
+
+def store_latest(rider_id, order_id, latitude, longitude, recorded_at, persisted=True):
+    """
+    Make a fix the rider's current position unless a newer one is already
+    stored (buffered offline fixes can arrive after live ones).
+    """
+    current = get_position(rider_id)
+    if current and datetime.fromisoformat(current["updated_at"]) > recorded_at:
+        return current
+
+    position = {
+        "rider_id": rider_id,
+        "order_id": order_id,
+        "latitude": latitude,
+        "longitude": longitude,
+        "updated_at": recorded_at.isoformat(),
+    }
+    if persisted:
+        position["persisted"] = [latitude, longitude, recorded_at.isoformat()]
+    elif current:
+        position["persisted"] = current.get("persisted")
+
+    cache.set(
+        LATEST_KEY.format(rider_id=rider_id),
+        position,
+        timeout=_setting("RIDER_LOCATION_TTL", 6 * 60 * 60),
+    )
+    for listener in _position_listeners:
+        try:
+            listener(position)
+        except Exception as e:
+            print(f"Rider position listener failed: {e}")
+    return position
+
+
+def add_position_listener(listener):
+    """Call ``listener(position)`` whenever a rider's live position changes."""
+    if listener not in _position_listeners:
+        _position_listeners.append(listener)
+
+
+def coalesce_fixes(fixes):
+    """
+    Thin a time-ordered list of ``(recorded_at, order_id, lat, lng)`` fixes
+    with the same movement rule used for live pings.
+    """
+    kept = []
+    last = None
+    for fix in fixes:
+        recorded_at, order_id, latitude, longitude = fix
+        if last is None or _moved_or_stale(last, order_id, latitude, longitude, recorded_at):
+            kept.append(fix)
+            last = (order_id, latitude, longitude, recorded_at)
+    _count("accepted", len(kept))
+    _count("coalesced", len(fixes) - len(kept))
+    return kept
+
+
+def get_write_stats():
+    """Accepted vs coalesced fix counters, for tuning the thresholds."""
+    accepted = cache.get(STATS_KEY.format(name="accepted"), 0)
+    coalesced = cache.get(STATS_KEY.format(name="coalesced"), 0)
+    total = accepted + coalesced
+    return {
+        "accepted": accepted,
+        "coalesced": coalesced,
+        "coalesced_ratio": round(coalesced / total, 4) if total else 0.0,
+        "min_distance_m": _setting("RIDER_LOCATION_MIN_DISTANCE_M", 25),
+        "max_interval_seconds": _setting("RIDER_LOCATION_MAX_INTERVAL_SECONDS", 30),
+    }
+
+
+def reset_write_stats():
+    cache.delete_many([STATS_KEY.format(name="accepted"), STATS_KEY.format(name="coalesced")])
+
+
+def _should_persist(current, order_id, latitude, longitude, recorded_at):
+    persisted = current.get("persisted") if current else None
+    if not persisted:
+        return True
+    last_lat, last_lng, last_at = persisted
+    last = (current["order_id"], last_lat, last_lng, datetime.fromisoformat(last_at))
+    return _moved_or_stale(last, order_id, latitude, longitude, recorded_at)
+
+
+def _moved_or_stale(last, order_id, latitude, longitude, recorded_at):
+    last_order_id, last_lat, last_lng, last_at = last
+    if order_id != last_order_id:
+        return True
+    if (recorded_at - last_at).total_seconds() >= _setting("RIDER_LOCATION_MAX_INTERVAL_SECONDS", 30):
+        return True
+    return distance_m(last_lat, last_lng, latitude, longitude) >= _setting("RIDER_LOCATION_MIN_DISTANCE_M", 25)
+
+
+def distance_m(lat1, lng1, lat2, lng2):
+    """Great-circle distance in metres (Haversine)."""
+    dlat = math.radians(lat2 - lat1)
+    dlng = math.radians(lng2 - lng1)
+    a = (
+        math.sin(dlat / 2) ** 2
+        + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlng / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def _count(name, amount=1):
+    if amount <= 0:
+        return
+    key = STATS_KEY.format(name=name)
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        cache.set(key, amount, timeout=None)
+
+
+def get_position(rider_id):
+    if not rider_id:
+        return None
+    return cache.get(LATEST_KEY.format(rider_id=rider_id))
+
+
+def get_positions(rider_ids):
+    """Fetch the latest fix for many riders in one cache round trip."""
+    keys = {LATEST_KEY.format(rider_id=rider_id): rider_id for rider_id in set(rider_ids) if rider_id}
+    if not keys:
+        return {}
+    found = cache.get_many(list(keys))
+    return {keys[key]: position for key, position in found.items()}
+
+
+def write_history(fixes):
+    """
+    Insert history rows straight away. Fixes already stored for the same
+    rider and timestamp are skipped, so replayed batches are harmless.
+    """
+    RiderLocation.objects.bulk_create(fixes, batch_size=500, ignore_conflicts=True)
+
+
+def _write_history(batch):
+    if not batch:
+        return
+    try:
+        write_history(batch)
+    except Exception as e:
+        print(f"Rider location history write failed ({len(batch)} fixes): {e}")
@@ -0,0 +1,248 @@
+"""
+Hourly and daily order rollups for the admin dashboard.
+
+``OrderRollup`` keeps, per hour and per day (in ``ROLLUP_TIME_ZONE``) and per
+current status, the number of orders placed in that bucket and the sums of
+their totals, coupon discounts and delivery charges. ``order_states`` applies
+deltas as orders are placed and move between statuses, so ``admin_stats``
+reads O(buckets) rows instead of aggregating the orders table.
+
+Deltas are applied after the order's transaction commits, as one
+``INSERT ... ON CONFLICT DO UPDATE`` per event. Every order placed in the same
+hour hits the same rollup rows, and keeping those row locks out of the order
+transactions stops them from serialising checkouts and rider claims. A
+delta lost to a crash between commit and apply (or an order deleted by hand)
+is repaired with ``python manage.py rebuild_order_rollups``; the migration
+that adds the table runs the same rebuild for the existing history.
+"""
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+from zoneinfo import ZoneInfo
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count, Sum
+from django.db.models.functions import Trunc
+
+from .models import Order, OrderRollup
+
+GRANULARITIES = ("hour", "day")
+STEPS = {"hour": timedelta(hours=1), "day": timedelta(days=1)}
+AMOUNT_FIELDS = {
+    "revenue": "total_price",
+    "discounts": "coupon_discount",
+    "delivery_charges": "delivery_charge",
+}
+
+# Longest range served at hourly granularity.
+MAX_HOURLY_DAYS = 31
+
+
+def rollup_tz():
+    return ZoneInfo(getattr(settings, "ROLLUP_TIME_ZONE", "Asia/Kolkata"))
+
+
+def bucket_start(moment, granularity):
+    local = moment.astimezone(rollup_tz())
+    if granularity == "hour":
+        return local.replace(minute=0, second=0, microsecond=0)
+    return local.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def day_start(day):
+    return datetime.combine(day, time.min, tzinfo=rollup_tz())
+
+
+def _deltas(order, status, sign):
+    rows = []
+    for granularity in GRANULARITIES:
+        rows.append((
+            granularity,
+            bucket_start(order["created_at"], granularity),
+            status,
+            sign,
+            *(sign * Decimal(order[field] or 0) for field in AMOUNT_FIELDS.values()),
+        ))
+    return rows
+
+
+def _merge(rows):
+    """Sum deltas that hit the same rollup row; one INSERT may not touch a row twice."""
+    merged = {}
+    for granularity, bucket, status, *counters in rows:
+        key = (granularity, bucket, status)
+        if key in merged:
+            counters = [a + b for a, b in zip(merged[key], counters)]
+        merged[key] = counters
+    return [(*key, *counters) for key, counters in merged.items()]
+
+
+def _apply(rows):
+    """Add each ``(granularity, bucket, status, orders, revenue, discounts, delivery_charges)`` delta."""
+    rows = _merge(rows)
+    table = connection.ops.quote_name(OrderRollup._meta.db_table)
+    columns = ["granularity", "bucket", "status", "orders", *AMOUNT_FIELDS]
+    counters = columns[3:]
+    ops = connection.ops
+    params = []
+    for granularity, bucket, status, orders, *amounts in rows:
+        params += [granularity, ops.adapt_datetimefield_value(bucket), status, orders]
+        params += [ops.adapt_decimalfield_value(amount, 14, 2) for amount in amounts]
+
+    placeholders = ", ".join(["(" + ", ".join(["%s"] * len(columns)) + ")"] * len(rows))
+    updates = ", ".join(f"{name} = {table}.{name} + EXCLUDED.{name}" for name in counters)
+    sql = (
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES {placeholders} "
+        f"ON CONFLICT (granularity, bucket, status) DO UPDATE SET {updates}"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+def _order_values(order):
+    return {"created_at": order.created_at, **{field: getattr(order, field) for field in AMOUNT_FIELDS.values()}}
+
+
+def order_placed_on_commit(order):
+    values = _order_values(order)
+    status = order.status
+    transaction.on_commit(lambda: _safely(_apply, _deltas(values, status, 1)))
+
+
+def status_changed_on_commit(order_id, from_status, to_status):
+    transaction.on_commit(lambda: _safely(_status_changed, order_id, from_status, to_status))
+
+
+def _status_changed(order_id, from_status, to_status):
+    order = Order.objects.filter(id=order_id).values("created_at", *AMOUNT_FIELDS.values()).first()
+    if order and from_status != to_status:
+        _apply(_deltas(order, from_status, -1) + _deltas(order, to_status, 1))
+
+
+def statuses_changed_on_commit(changes, to_status):
+    """``status_changed_on_commit`` for many ``(order_id, from_status)`` pairs, applied as one upsert."""
+    changes = dict(changes)
+    transaction.on_commit(lambda: _safely(_statuses_changed, changes, to_status))
+
+
+def _statuses_changed(changes, to_status):
+    rows = []
+    for order in Order.objects.filter(id__in=changes).values("id", "created_at", *AMOUNT_FIELDS.values()):
+        if changes[order["id"]] != to_status:
+            rows += _deltas(order, changes[order["id"]], -1) + _deltas(order, to_status, 1)
+    if rows:
+        _apply(rows)
+
+
+def _safely(func, *args):
+    try:
+        func(*args)
+    except Exception as e:
+        print(f"Order rollup update failed: {e}")
+
+
+def rebuild(start=None, end=None, apps=None):
+    """
+    Recompute rollups for orders created in ``[start, end)`` (day boundaries).
+    Returns rows written. Migrations pass their ``apps`` to run on the
+    historical models.
+    """
+    order_model, rollup_model = Order, OrderRollup
+    if apps is not None:
+        order_model, rollup_model = apps.get_model("foodbackend", "Order"), apps.get_model("foodbackend", "OrderRollup")
+    orders = order_model.objects.all()
+    rollups = rollup_model.objects.all()
+    if start:
+        orders = orders.filter(created_at__gte=start)
+        rollups = rollups.filter(bucket__gte=start)
+    if end:
+        orders = orders.filter(created_at__lt=end)
+        rollups = rollups.filter(bucket__lt=end)
+
+    written = 0
+    with transaction.atomic():
+        rollups.delete()
+        for granularity in GRANULARITIES:
+            rows = (
+                orders.annotate(rollup_bucket=Trunc("created_at", granularity, tzinfo=rollup_tz()))
+                .order_by()
+                .values("rollup_bucket", "status")
+                .annotate(
+                    order_count=Count("id"),
+                    **{f"sum_{name}": Sum(field) for name, field in AMOUNT_FIELDS.items()},
+                )
+            )
+            written += len(rollup_model.objects.bulk_create(
+                [
+                    rollup_model(
+                        granularity=granularity,
+                        bucket=row["rollup_bucket"],
+                        status=row["status"],
+                        orders=row["order_count"],
+                        **{name: row[f"sum_{name}"] or 0 for name in AMOUNT_FIELDS},
+                    )
+                    for row in rows.iterator()
+                ],
+                batch_size=1000,
+            ))
+    return written
+
+
+def _empty():
+    return {"orders": 0, "delivered": 0, "cancelled": 0, **{name: Decimal(0) for name in AMOUNT_FIELDS}}
+
+
+def _add(totals, row):
+    totals["orders"] += row["orders"]
+    if row["status"] == "cancelled":
+        totals["cancelled"] += row["orders"]
+    if row["status"] == "delivered":
+        # Money figures cover delivered orders, like the dashboard's revenue always has.
+        totals["delivered"] += row["orders"]
+        for name in AMOUNT_FIELDS:
+            totals[name] += row[name]
+
+
+def _payload(totals):
+    delivered = totals["delivered"]
+    return {
+        "orders": totals["orders"],
+        "delivered": delivered,
+        "cancelled": totals["cancelled"],
+        **{name: float(totals[name]) for name in AMOUNT_FIELDS},
+        "average_order_value": float(totals["revenue"] / delivered) if delivered else 0.0,
+    }
+
+
+def totals(start=None, end=None):
+    """Dashboard totals for orders created in ``[start, end)``, or all time."""
+    rows = OrderRollup.objects.filter(granularity="day")
+    if start:
+        rows = rows.filter(bucket__gte=start)
+    if end:
+        rows = rows.filter(bucket__lt=end)
+    result = _empty()
+    for row in rows.values("status").annotate(
+        total_orders=Sum("orders"), **{f"total_{name}": Sum(name) for name in AMOUNT_FIELDS}
+    ):
+        _add(result, {
+            "status": row["status"],
+            "orders": row["total_orders"],
+            **{name: row[f"total_{name}"] for name in AMOUNT_FIELDS},
+        })
+    return _payload(result)
+
+
+def series(start, end, granularity):
+    """One entry per bucket in ``[start, end)``, zero-filled, oldest first."""
+    buckets = {}
+    rows = OrderRollup.objects.filter(granularity=granularity, bucket__gte=start, bucket__lt=end)
+    for row in rows.values("bucket", "status", "orders", *AMOUNT_FIELDS):
+        _add(buckets.setdefault(row["bucket"], _empty()), row)
+
+    result = []
+    bucket, step = start, STEPS[granularity]
+    while bucket < end:
+        result.append({"bucket": bucket.isoformat(), **_payload(buckets.get(bucket, _empty()))})
+        bucket += step
+    return result
@@ -0,0 +1,189 @@
+"""
+Server-Sent Events stream for live order tracking.
+
+``GET /api/orders/<id>/stream/`` sends a ``snapshot`` event with the order's
+current status and rider position, then pushes ``status`` events as the
+order moves through the state machine and ``position`` events (throttled per
+order) while a rider is on the way. The view is async: under the ASGI
+application in ``food/asgi.py`` an idle watcher is just a parked coroutine
+and a queue, with no worker thread or database connection held open.
+
+The stream authenticates with the regular JWT, either in the
+``Authorization`` header or, for ``EventSource`` clients that cannot set
+headers, in a ``?token=`` query parameter.
+
+Streams are only served under ASGI, and only with a pub/sub backend that
+every worker shares (``postgres``, or ``local`` with a single worker). A WSGI
+worker would buffer the response and stay tied up for the whole stream, and a
+per-worker broker would miss the events handled by the other workers. In
+either case the view answers 503 with the order detail URL to poll instead.
+"""
+import json
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from . import order_states, pubsub, rider_location
+from .models import Order, Rider
+from .views import _rider_position_payload
+
+_last_position_publish = {}
+_position_lock = threading.Lock()
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _on_position(position):
+    """Publish a rider's position to its order's channel, at most every few seconds."""
+    order_id = position.get("order_id")
+    if not order_id:
+        return
+
+    interval = _setting("ORDER_STREAM_POSITION_INTERVAL_SECONDS", 3)
+    now = time.monotonic()
+    with _position_lock:
+        if now - _last_position_publish.get(order_id, 0) < interval:
+            return
+        _last_position_publish[order_id] = now
+        if len(_last_position_publish) > 10000:
+            for stale_id, published_at in list(_last_position_publish.items()):
+                if now - published_at >= interval:
+                    del _last_position_publish[stale_id]
+
+    pubsub.publish(pubsub.order_channel(order_id), {
+        "event": "position",
+        "data": {
+            "order_id": order_id,
+            "rider_latitude": position["latitude"],
+            "rider_longitude": position["longitude"],
+            "rider_location_updated_at": position["updated_at"],
+        },
+    })
+
+
+rider_location.add_position_listener(_on_position)
+
+
+def _authenticate(request):
+    raw_token = None
+    parts = request.headers.get("Authorization", "").split()
+    if len(parts) == 2 and parts[0] in jwt_settings.AUTH_HEADER_TYPES:
+        raw_token = parts[1]
+    else:
+        raw_token = request.GET.get("token")
+    return authenticate_token(raw_token)
+
+
+def authenticate_token(raw_token):
+    """User for a raw JWT access token, or None."""
+    if not raw_token:
+        return None
+
+    auth = JWTAuthentication()
+    try:
+        return auth.get_user(auth.get_validated_token(raw_token))
+    except (InvalidToken, AuthenticationFailed):
+        return None
+
+
+def _order_snapshot(order_id, user):
+    order = (
+        Order.objects.filter(id=order_id)
+        .only(
+            "id",
+            "user_id",
+            "status",
+            "rider_id",
+            "rider_name",
+            "rider_mobile",
+            "rider_latitude",
+            "rider_longitude",
+            "rider_location_updated_at",
+        )
+        .first()
+    )
+    if not order:
+        return None
+
+    allowed = order.user_id == user.id or user.is_staff
+    if not allowed and order.rider_id:
+        allowed = Rider.objects.filter(id=order.rider_id, user=user).exists()
+    if not allowed:
+        return None
+
+    return {
+        "order_id": order.id,
+        "status": order.status,
+        "rider_name": order.rider_name,
+        "rider_mobile": order.rider_mobile,
+        **_rider_position_payload(order, {order.rider_id: rider_location.get_position(order.rider_id)}),
+    }
+
+
+def _format_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+async def _event_stream(subscription, snapshot):
+    heartbeat = _setting("ORDER_STREAM_HEARTBEAT_SECONDS", 15)
+    # Bound each connection; EventSource reconnects and gets a fresh snapshot.
+    deadline = time.monotonic() + _setting("ORDER_STREAM_MAX_SECONDS", 15 * 60)
+    try:
+        yield "retry: 3000\n\n" + _format_event("snapshot", snapshot)
+        if snapshot["status"] in order_states.TERMINAL_STATUSES:
+            return
+
+        while time.monotonic() < deadline:
+            message = await subscription.get(timeout=heartbeat)
+            if message is None:
+                yield ": ping\n\n"
+                continue
+            yield _format_event(message["event"], message["data"])
+            if message["event"] == "status" and message["data"]["status"] in order_states.TERMINAL_STATUSES:
+                return
+    finally:
+        subscription.close()
+
+
+def _unavailable_reason(request):
+    if not isinstance(request, ASGIRequest):
+        return "Live updates need the ASGI (uvicorn) worker profile"
+    if not pubsub.is_shared():
+        return "Live updates need PUBSUB_BACKEND=postgres when running more than one worker"
+    return None
+
+
+async def order_stream(request, order_id):
+    if request.method != "GET":
+        return JsonResponse({"error": "Method not allowed"}, status=405)
+
+    reason = _unavailable_reason(request)
+    if reason:
+        poll_url = reverse("get_order_detail", args=[order_id])
+        return JsonResponse({"error": reason, "poll_url": poll_url}, status=503)
+
+    user = await sync_to_async(_authenticate)(request)
+    if user is None:
+        return JsonResponse({"error": "Authentication required"}, status=401)
+
+    # Subscribe before reading the snapshot so no change can slip in between.
+    subscription = pubsub.subscribe(pubsub.order_channel(order_id))
+    snapshot = await sync_to_async(_order_snapshot)(order_id, user)
+    if snapshot is None:
+        subscription.close()
+        return JsonResponse({"error": "Order not found"}, status=404)
+
+    response = StreamingHttpResponse(_event_stream(subscription, snapshot), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
@@ -1,3 +1,1503 @@
-from django.test import TestCase
+import json
+import os
+import runpy
+import threading
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+from urllib.parse import urlencode
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import AsyncClient, AsyncRequestFactory, Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from food.asgi import application as asgi_application
+
+from .models import (
+    Address,
+    Cart,
+    CartItem,
+    Category,
+    ComboItem,
+    Coupon,
+    CouponCode,
+    CustomerStats,
+    DeliveryTrail,
+    Item,
+    Order,
+    OrderItem,
+    OrderItemReview,
+    OrderReview,
+    OrderRollup,
+    NotificationOutbox,
+    OTP,
+    OrderStatusEvent,
+    PushCampaign,
+    PushTicket,
+    PushToken,
+    Rider,
+    RiderLocation,
+    RiderSyncEvent,
+    SupportMessage,
+    SupportTicket,
+    UserCouponUsage,
+)
+from . import async_views, campaigns, catalog, checks, coupon_codes, customer_stats, dispatch, item_ratings, order_states, outbox, pubsub, push, rider_gateway, rider_location, rollups, trails
+from .expo_standin import ExpoStandIn
+from .views import _accept_order, _deliver_order, _rider_position_payload, ready_orders_for_rider
+
+
+def make_order(status="ready_for_pickup"):
+    customer = User.objects.create(username="9000000000", first_name="Customer")
+    address = Address.objects.create(
+        user=customer,
+        full_address="1 Test Street",
+        city="Chennai",
+        postal_code="600001",
+        latitude=Decimal("12.970000"),
+        longitude=Decimal("80.240000"),
+    )
+    return Order.objects.create(
+        user=customer,
+        address=address,
+        subtotal=100,
+        tax=5,
+        total_price=105,
+        status=status,
+        delivery_otp="1234",
+    )
+
+
+def broadcast_offer(order):
+    """Open ``order`` to every rider, as dispatch does once no nearby rider takes it."""
+    return dispatch._save_offer({
+        "order_id": order.id, "dispatch_id": f"test-{order.id}", "pickup": [12.97, 80.24], "round": 1,
+        "riders": [], "offered": [], "broadcast": True, "expires_at": 0,
+    })
+
+
+def make_riders(count):
+    riders = []
+    for i in range(count):
+        mobile = f"8{i:09d}"
+        user = User.objects.create(username=f"rider_{mobile}", first_name=f"Rider {i}")
+        riders.append(Rider.objects.create(user=user, mobile=mobile))
+    return riders
+
+
+def count_queries(func):
+    """Run ``func`` and return ``(result, number of queries)``, ignoring savepoints."""
+    with CaptureQueriesContext(connection) as queries:
+        result = func()
+    statements = [q["sql"] for q in queries.captured_queries]
+    return result, len([sql for sql in statements if "SAVEPOINT" not in sql])
+
+
+class QueryBudgetMixin:
+    """
+    ``assertQueryBudget`` fetches a list endpoint once per entry in ``pages``
+    (by default a one-row and a ten-row page) and fails if the query count
+    differs between them, the signature of an N+1, or exceeds ``budget``.
+    """
+
+    def assertQueryBudget(self, url, budget, pages=({"page_size": 1}, {"page_size": 10}), client=None):
+        client = client or self.client
+        counts, rows = [], []
+        for params in pages:
+            response, count = count_queries(lambda: client.get(url, params))
+            self.assertEqual(response.status_code, 200, url)
+            counts.append(count)
+            rows.append(len(response.json()) if response.get("Content-Type", "").startswith("application/json") else None)
+        if rows[0] is not None:
+            self.assertLess(rows[0], rows[-1], f"{url}: pages must differ in size")
+        self.assertEqual(len(set(counts)), 1, f"{url}: query count grows with the number of rows {counts}")
+        self.assertLessEqual(counts[0], budget, f"{url}: {counts[0]} queries, budget {budget}")
+
+
+class OrderClaimTests(TestCase):
+    def test_claim_is_one_update_plus_event(self):
+        order = make_order()
+        broadcast_offer(order)
+        rider = make_riders(1)[0]
+        rider = Rider.objects.select_related("user").get(id=rider.id)
+
+        with CaptureQueriesContext(connection) as queries:
+            payload, error, status = _accept_order(rider, order.id)
+
+        self.assertEqual(status, 200)
+        statements = [q["sql"].split()[0] for q in queries.captured_queries if "SAVEPOINT" not in q["sql"]]
+        # The conditional claim, its status event and the customer's outbox row.
+        self.assertEqual(statements, ["UPDATE", "INSERT", "INSERT"])
+        self.assertEqual(order.status_events.get().from_status, "ready_for_pickup")
+        order.refresh_from_db()
+        self.assertEqual(order.rider_id, rider.id)
+        self.assertEqual(order.status, "on_the_way")
+
+    def test_second_claim_loses(self):
+        order = make_order()
+        broadcast_offer(order)
+        first, second = make_riders(2)
+
+        self.assertEqual(_accept_order(first, order.id)[2], 200)
+        self.assertEqual(_accept_order(second, order.id)[2], 404)
+        order.refresh_from_db()
+        self.assertEqual(order.rider_id, first.id)
+
+    def test_deliver_checks_otp_and_is_idempotent(self):
+        order = make_order()
+        broadcast_offer(order)
+        rider = make_riders(1)[0]
+        _accept_order(rider, order.id)
+
+        self.assertEqual(_deliver_order(rider, order.id, "0000")[2], 400)
+        self.assertEqual(_deliver_order(rider, order.id, "1234")[2], 200)
+        self.assertEqual(_deliver_order(rider, order.id, "1234")[2], 200)
+        order.refresh_from_db()
+        self.assertEqual(order.status, "delivered")
+
+
+class OrderClaimContentionTests(TransactionTestCase):
+    RIDERS = 16
+    ROUNDS = 5
+
+    def test_concurrent_claims_have_one_winner(self):
+        riders = make_riders(self.RIDERS)
+
+        for _ in range(self.ROUNDS):
+            Order.objects.all().delete()
+            User.objects.filter(username="9000000000").delete()
+            order = make_order()
+            broadcast_offer(order)
+
+            barrier = threading.Barrier(len(riders))
+            results = []
+            lock = threading.Lock()
+
+            def claim(rider):
+                try:
+                    barrier.wait()
+                    try:
+                        status = _accept_order(rider, order.id)[2]
+                    except Exception as e:
+                        # SQLite may refuse a concurrent writer outright;
+                        # that is a lost claim, never a second winner.
+                        status = repr(e)
+                    with lock:
+                        results.append((rider.id, status))
+                finally:
+                    connection.close()
+
+            threads = [threading.Thread(target=claim, args=(rider,)) for rider in riders]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            winners = [rider_id for rider_id, status in results if status == 200]
+            self.assertEqual(len(results), len(riders))
+            self.assertEqual(len(winners), 1)
+            order.refresh_from_db()
+            self.assertEqual(order.rider_id, winners[0])
+            self.assertEqual(order.status, "on_the_way")
+
+
+class RiderSyncTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.order = make_order()
+        self.rider = make_riders(1)[0]
+        self.client = APIClient()
+        self.client.force_authenticate(self.rider.user)
+
+    def sync(self, **body):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post("/api/rider/sync/", body, format="json")
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_events_run_in_order_and_replay_their_outcome(self):
+        events = [
+            {"event_id": "a1", "type": "accept", "order_id": self.order.id},
+            {"event_id": "d1", "type": "deliver", "order_id": self.order.id, "otp": "1234"},
+        ]
+        broadcast_offer(self.order)
+        first = self.sync(events=events)
+        self.assertEqual([event["success"] for event in first["events"]], [True, True])
+        event_count = OrderStatusEvent.objects.filter(order=self.order).count()
+
+        self.assertEqual(self.sync(events=events)["events"], first["events"])
+        self.assertEqual(OrderStatusEvent.objects.filter(order=self.order).count(), event_count)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, "delivered")
+
+    def test_conflicts_the_order_may_resolve_are_not_stored(self):
+        other = Rider.objects.create(user=User.objects.create(username="rider_other"), mobile="8999999999")
+        dispatch._save_offer({
+            "order_id": self.order.id, "dispatch_id": "d", "pickup": [12.97, 80.24], "round": 1,
+            "riders": [other.id], "offered": [other.id], "broadcast": False, "expires_at": 0,
+        })
+        accept = [{"event_id": "a1", "type": "accept", "order_id": self.order.id}]
+        result = self.sync(events=accept)["events"][0]
+        self.assertEqual((result["success"], result["retryable"]), (False, True))
+        self.assertFalse(RiderSyncEvent.objects.exists())
+
+        broadcast_offer(self.order)
+        self.assertTrue(self.sync(events=accept)["events"][0]["success"])
+        self.assertIsNone(dispatch.get_offer(self.order.id))
+
+    def test_fixes_apply_in_time_order_and_start_the_delivery(self):
+        Order.objects.filter(id=self.order.id).update(rider=self.rider)
+        now = timezone.now()
+        fixes = [
+            {"order_id": self.order.id, "latitude": 12.98, "longitude": 80.25, "recorded_at": now.isoformat()},
+            {"order_id": self.order.id, "latitude": 12.97, "longitude": 80.24,
+             "recorded_at": (now - timedelta(minutes=1)).isoformat()},
+        ]
+        self.assertEqual(self.sync(fixes=fixes)["fixes_accepted"], 2)
+        self.assertEqual(rider_location.get_position(self.rider.id)["latitude"], 12.98)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, "on_the_way")
+
+
+class RiderLocationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.order = make_order(status="on_the_way")
+        self.rider = make_riders(1)[0]
+
+    def test_persisted_fixes_are_written_at_once(self):
+        rider_location.record_position(self.rider.id, self.order.id, 12.97, 80.24)
+        self.assertEqual(RiderLocation.objects.filter(order=self.order).count(), 1)
+
+    def test_live_position_only_shown_for_its_order(self):
+        self.order.rider = self.rider
+        self.order.save(update_fields=["rider"])
+        other = Order.objects.create(
+            user=self.order.user, address=self.order.address, subtotal=10, tax=0, total_price=10,
+            status="on_the_way", rider=self.rider,
+        )
+        rider_location.record_position(self.rider.id, other.id, 12.98, 80.25)
+        positions = {self.rider.id: rider_location.get_position(self.rider.id)}
+        self.assertEqual(_rider_position_payload(other, positions)["rider_latitude"], 12.98)
+        self.assertIsNone(_rider_position_payload(self.order, positions)["rider_latitude"])
+
+    def test_pings_start_the_delivery_but_keep_delivery_sub_states(self):
+        Order.objects.filter(id=self.order.id).update(status="ready_for_pickup", rider=self.rider)
+        client = APIClient()
+        client.force_authenticate(self.rider.user)
+
+        def ping():
+            body = {"order_id": self.order.id, "latitude": 12.97, "longitude": 80.24}
+            with self.captureOnCommitCallbacks(execute=True):
+                response = client.post("/api/orders/update-rider-location/", body, format="json")
+            self.assertEqual(response.status_code, 200)
+            return response.json()["status"]
+
+        self.assertEqual(ping(), "on_the_way")
+        for status in ("delivery_pending", "delivery_failed", "delivery_rescheduled"):
+            Order.objects.filter(id=self.order.id).update(status=status)
+            rider_location.forget_order(self.order.id)
+            self.assertEqual(ping(), status)
+        self.assertEqual(OrderStatusEvent.objects.filter(order=self.order).count(), 1)
+
+    def test_fixes_persist_on_movement_or_age_and_always_refresh_latest(self):
+        start = timezone.now() - timedelta(minutes=5)
+
+        def record(seconds, lat, order_id=None):
+            rider_location.record_position(
+                self.rider.id, order_id or self.order.id, lat, 80.24, start + timedelta(seconds=seconds)
+            )
+
+        record(0, 12.97)
+        record(5, 12.9701)      # ~11 m, 5 s later: coalesced
+        latest = rider_location.get_position(self.rider.id)
+        self.assertEqual(latest["latitude"], 12.9701)
+        self.assertEqual(latest["persisted"][0], 12.97)
+        record(10, 12.9704)     # ~44 m from the last persisted fix
+        record(45, 12.9704)     # same spot, 35 s after it
+        record(46, 12.9704, order_id=Order.objects.create(
+            user=self.order.user, address=self.order.address, subtotal=10, tax=0, total_price=10,
+        ).id)                   # another order
+        self.assertEqual(RiderLocation.objects.filter(rider=self.rider).count(), 4)
+        stats = rider_location.get_write_stats()
+        self.assertEqual((stats["accepted"], stats["coalesced"]), (4, 1))
+
+        # A late offline fix is stored but does not replace the newer live position.
+        record(1, 12.95)
+        latest = rider_location.get_position(self.rider.id)
+        self.assertEqual(latest["updated_at"], (start + timedelta(seconds=46)).isoformat())
+
+    def test_coalesce_fixes_uses_the_same_rules(self):
+        start = timezone.now()
+        fixes = [
+            (start, self.order.id, 12.97, 80.24),
+            (start + timedelta(seconds=5), self.order.id, 12.9701, 80.24),
+            (start + timedelta(seconds=10), self.order.id, 12.9704, 80.24),
+            (start + timedelta(seconds=50), self.order.id, 12.9704, 80.24),
+        ]
+        self.assertEqual(rider_location.coalesce_fixes(fixes), [fixes[0], fixes[2], fixes[3]])
+
+    def test_per_process_cache_is_refused_for_several_workers(self):
+        self.assertEqual(checks.shared_state_problems(1), [])
+        self.assertEqual(len(checks.shared_state_problems(4)), 1)
+        with self.assertRaises(RuntimeError):
+            checks.ensure_shared_state(4)
+        with override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.db.DatabaseCache"}}):
+            self.assertEqual(checks.shared_state_problems(4), [])
+
+    def test_several_workers_default_to_the_database_cache(self):
+        with mock.patch.dict(os.environ, {"GUNICORN_WORKERS": "4"}):
+            os.environ.pop("CACHE_BACKEND", None)
+            caches = runpy.run_path(os.path.join(settings.BASE_DIR, "food", "settings.py"))["CACHES"]
+        with override_settings(CACHES=caches):
+            self.assertEqual(checks.shared_state_problems(4), [])
+        self.assertEqual(caches["default"]["LOCATION"], "dipanddash_cache")
+
+    def test_local_pubsub_is_refused_for_several_asgi_workers(self):
+        self.assertEqual(checks.shared_state_problems(1, "uvicorn"), [])
+        with override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.db.DatabaseCache"}}):
+            self.assertEqual(checks.shared_state_problems(4, "sync"), [])
+            self.assertEqual(len(checks.shared_state_problems(4, "uvicorn")), 1)
+            with override_settings(PUBSUB_BACKEND="postgres"):
+                self.assertEqual(checks.shared_state_problems(4, "uvicorn"), [])
+        with self.assertRaises(CommandError):
+            call_command("run_dispatcher", "--once")
+
+
+class DeliveryTrailTests(TestCase):
+    def test_points_round_trip_through_the_packed_encoding(self):
+        start = timezone.now().replace(microsecond=0)
+        points = [(12.970001, 80.240002, start), (12.9705, 80.2399, start + timedelta(seconds=31))]
+        decoded = trails.decode_points(trails.encode_points(points, start), start)
+        self.assertEqual(decoded, points)
+
+    def test_simplify_drops_collinear_points_and_keeps_corners(self):
+        line = [(12.97 + i * 0.001, 80.24, i) for i in range(5)]
+        self.assertEqual(trails.simplify(line), [line[0], line[-1]])
+        corner = line + [(12.974, 80.24 + i * 0.001, 5 + i) for i in range(1, 4)]
+        self.assertEqual(trails.simplify(corner), [line[0], line[-1], corner[-1]])
+
+    def test_encode_polyline_matches_the_reference_encoding(self):
+        points = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+        self.assertEqual(trails.encode_polyline(points), "_p~iF~ps|U_ulLnnqC_mqNvxq`@")
+
+    def test_close_keeps_fixes_inserted_after_the_read(self):
+        order = make_order(status="delivered")
+        rider = make_riders(1)[0]
+        start = timezone.now() - timedelta(minutes=10)
+        RiderLocation.objects.bulk_create([
+            RiderLocation(rider=rider, order=order, latitude=12.97 + i * 0.001, longitude=80.24,
+                          recorded_at=start + timedelta(seconds=30 * i))
+            for i in range(4)
+        ])
+        read = trails._raw_fixes
+
+        def read_then_insert(order_id):
+            fixes = read(order_id)
+            RiderLocation.objects.create(rider=rider, order=order, latitude=12.98, longitude=80.25,
+                                         recorded_at=start + timedelta(minutes=5))
+            return fixes
+
+        with mock.patch.object(trails, "_raw_fixes", read_then_insert):
+            trail = trails.close_trail(order.id)
+        self.assertEqual(trail.raw_point_count, 4)
+        self.assertEqual(RiderLocation.objects.filter(order=order).count(), 1)
+
+        trail = trails.close_trail(order.id)
+        self.assertEqual(trail.raw_point_count, 5)
+        self.assertEqual(trail.point_count, 3)
+        self.assertFalse(RiderLocation.objects.filter(order=order).exists())
+        self.assertEqual(DeliveryTrail.objects.get(order=order).ended_at, start + timedelta(minutes=5))
+
+
+class DispatchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        dispatch._away.clear()
+
+    def test_index_returns_nearest_recent_riders_first(self):
+        index = dispatch.RiderIndex()
+        index.update(1, 12.9710, 80.2400, ts=100)
+        index.update(2, 12.9701, 80.2400, ts=100)
+        index.update(3, 12.9900, 80.2400, ts=100)
+        index.update(4, 12.9702, 80.2400, ts=10)
+        index.update(5, 13.2000, 80.2400, ts=100)
+
+        nearest = index.nearest(12.97, 80.24, k=3, max_distance_m=5000, min_ts=50)
+        self.assertEqual([rider_id for _, rider_id in nearest], [2, 1, 3])
+        nearest = index.nearest(12.97, 80.24, k=3, max_distance_m=5000, min_ts=50, exclude=[2])
+        self.assertEqual([rider_id for _, rider_id in nearest], [1, 3])
+
+        # A rider moves cells; an older fix does not move them back.
+        index.update(3, 12.9700, 80.2400, ts=200)
+        index.update(3, 12.9900, 80.2400, ts=150)
+        self.assertEqual(index.nearest(12.97, 80.24, k=1, max_distance_m=5000)[0][1], 3)
+        index.remove(3)
+        self.assertEqual(len(index), 4)
+
+    def test_offers_are_visible_only_to_offered_riders_until_broadcast(self):
+        offer = {"offered": [1, 2], "broadcast": False}
+        self.assertTrue(dispatch.is_visible_to(offer, 1))
+        self.assertFalse(dispatch.is_visible_to(offer, 3))
+        self.assertTrue(dispatch.is_visible_to(dict(offer, broadcast=True), 3))
+        self.assertFalse(dispatch.is_visible_to(None, 1))
+
+    def test_an_order_is_offered_once_and_each_round_escalates_once(self):
+        order = make_order()
+        with mock.patch.object(dispatch, "find_riders", side_effect=[[1], [2, 3]]) as find:
+            offer = dispatch.offer_order(order.id, 12.97, 80.24)
+            self.assertEqual(dispatch.offer_order(order.id, 12.97, 80.24), offer)
+
+            # Two dispatchers both see the same expired offer.
+            stale = dict(offer, expires_at=0)
+            first = dispatch.escalate_expired({order.id: dict(stale)})[order.id]
+            second = dispatch.escalate_expired({order.id: dict(stale)})[order.id]
+        self.assertEqual(find.call_count, 2)
+        self.assertEqual((first["round"], first["offered"]), (2, [1, 2, 3]))
+        self.assertEqual(second, first)
+        self.assertEqual(dispatch.get_offer(order.id), first)
+
+    def test_ready_orders_without_an_offer_are_dispatched_not_shown_to_everyone(self):
+        order = make_order()
+        near, far = make_riders(2)
+        with mock.patch.object(dispatch, "find_riders", return_value=[near.id]):
+            self.assertEqual([data["id"] for data in ready_orders_for_rider(far)], [])
+        self.assertEqual([data["id"] for data in ready_orders_for_rider(near)], [order.id])
+        self.assertEqual(dispatch.get_offer(order.id)["offered"], [near.id])
+
+    def test_claimed_and_disconnected_riders_are_not_offered_orders(self):
+        near, far = make_riders(2)
+        now = timezone.now()
+        rider_location.store_latest(near.id, None, 12.9701, 80.24, now)
+        rider_location.store_latest(far.id, None, 12.9750, 80.24, now)
+        dispatch.refresh_index(force=True)
+
+        def find():
+            return count_queries(lambda: dispatch.find_riders(12.97, 80.24, 5))
+
+        self.assertEqual(find(), ([near.id, far.id], 0))
+
+        order = make_order()
+        broadcast_offer(order)
+        with self.captureOnCommitCallbacks(execute=True):
+            _accept_order(near, order.id)
+        self.assertEqual(find(), ([far.id], 0))
+        # A process that did not see the claim still skips the rider.
+        dispatch._away.clear()
+        dispatch.index.update(near.id, 12.9701, 80.24, now.timestamp())
+        self.assertEqual(find(), ([far.id], 0))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            _deliver_order(near, order.id, "1234")
+        self.assertEqual(find()[0], [near.id, far.id])
+
+        dispatch.rider_offline(far.id)
+        self.assertEqual(find()[0], [near.id])
+        dispatch.rider_online(far.id)
+        self.assertEqual(find()[0], [near.id, far.id])
+
+
+class OrderStreamTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.order = make_order(status="on_the_way")
+        self.url = f"/api/orders/{self.order.id}/stream/"
+        self.params = {"token": str(AccessToken.for_user(self.order.user))}
+
+    def test_wsgi_workers_send_clients_to_polling(self):
+        response = Client().get(self.url, self.params)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()["poll_url"], f"/api/orders/{self.order.id}/")
+
+    @override_settings(WEB_WORKERS=4, PUBSUB_BACKEND="local")
+    async def test_a_per_worker_broker_is_refused(self):
+        response = await AsyncClient().get(self.url, self.params)
+        self.assertEqual(response.status_code, 503)
+
+    async def test_snapshot_then_status_events_until_terminal(self):
+        response = await AsyncClient().get(self.url, self.params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+
+        chunks = aiter(response.streaming_content)
+        snapshot = (await anext(chunks)).decode()
+        self.assertIn("event: snapshot", snapshot)
+        self.assertIn('"status": "on_the_way"', snapshot)
+
+        pubsub.publish(pubsub.order_channel(self.order.id), {
+            "event": "status", "data": {"order_id": self.order.id, "status": "delivered"},
+        })
+        self.assertIn('"status": "delivered"', (await anext(chunks)).decode())
+        with self.assertRaises(StopAsyncIteration):
+            await anext(chunks)
+
+    async def test_only_the_customer_or_rider_can_watch(self):
+        stranger = await User.objects.acreate(username="9111111111")
+        response = await AsyncClient().get(self.url, {"token": str(AccessToken.for_user(stranger))})
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual((await AsyncClient().get(self.url)).status_code, 401)
+
+
+class RiderGatewayTests(TransactionTestCase):
+    """Drives the ASGI app over a WebSocket; the gateway's ORM work runs on other threads."""
+
+    def setUp(self):
+        cache.clear()
+        self.rider = make_riders(1)[0]
+        self.order = make_order()
+        broadcast_offer(self.order)
+        self.token = str(AccessToken.for_user(self.rider.user))
+
+    def tearDown(self):
+        cache.clear()
+
+    def communicator(self, path=rider_gateway.PATH, **params):
+        scope = {"type": "websocket", "path": path, "query_string": urlencode(params).encode(), "headers": []}
+        return ApplicationCommunicator(asgi_application, scope)
+
+    async def connect(self, **params):
+        communicator = self.communicator(token=self.token, **params)
+        await communicator.send_input({"type": "websocket.connect"})
+        self.assertEqual((await communicator.receive_output(5))["type"], "websocket.accept")
+        return communicator
+
+    async def receive(self, communicator):
+        return json.loads((await communicator.receive_output(5))["text"])
+
+    async def disconnect(self, communicator):
+        await communicator.send_input({"type": "websocket.disconnect", "code": 1000})
+        await communicator.wait(5)
+
+    async def test_bad_tokens_and_unknown_paths_are_refused(self):
+        for communicator, code in (
+            (self.communicator(token="nope"), rider_gateway.CLOSE_UNAUTHORIZED),
+            (self.communicator(path="/ws/other/", token=self.token), 4404),
+        ):
+            await communicator.send_input({"type": "websocket.connect"})
+            self.assertEqual(await communicator.receive_output(5), {"type": "websocket.close", "code": code})
+
+    @override_settings(WEB_WORKERS=2, PUBSUB_BACKEND="local")
+    async def test_unshared_pubsub_closes_the_socket(self):
+        communicator = await self.connect()
+        self.assertEqual(
+            await communicator.receive_output(5), {"type": "websocket.close", "code": rider_gateway.CLOSE_UNAVAILABLE}
+        )
+
+    async def test_welcome_snapshot_and_ping(self):
+        communicator = await self.connect()
+        welcome = await self.receive(communicator)
+        self.assertEqual((welcome["type"], welcome["resumed"], welcome["seq"]), ("welcome", False, 0))
+        snapshot = await self.receive(communicator)
+        self.assertEqual((snapshot["type"], snapshot["seq"]), ("snapshot", 1))
+        self.assertEqual([order["id"] for order in snapshot["data"]["offers"]], [self.order.id])
+
+        await communicator.send_input({"type": "websocket.receive", "text": json.dumps({"type": "ping"})})
+        self.assertEqual(await self.receive(communicator), {"type": "pong"})
+        await communicator.send_input({"type": "websocket.receive", "text": "{"})
+        self.assertEqual((await self.receive(communicator))["error"], "Invalid JSON")
+        offline_key = dispatch.OFFLINE_KEY.format(rider_id=self.rider.id)
+        self.assertIsNone(cache.get(offline_key))
+        await self.disconnect(communicator)
+        self.assertTrue(cache.get(offline_key))
+
+    async def test_resume_replays_unacknowledged_messages_then_a_fresh_snapshot(self):
+        communicator = await self.connect()
+        session = (await self.receive(communicator))["session"]
+        await self.receive(communicator)
+        await communicator.send_input({"type": "websocket.receive", "text": json.dumps(
+            {"type": "accept", "ref": "a1", "order_id": self.order.id}
+        )})
+        # The claim's result and the offer closing, in either order.
+        sent = sorted([await self.receive(communicator), await self.receive(communicator)], key=lambda m: m["seq"])
+        self.assertEqual([message["seq"] for message in sent], [2, 3])
+        result = next(message for message in sent if message["type"] == "result")
+        self.assertTrue(result["data"]["success"])
+        await communicator.send_input({"type": "websocket.receive", "text": json.dumps({"type": "ack", "seq": 1})})
+        await self.disconnect(communicator)
+
+        # Neither was acknowledged, so both are replayed.
+        communicator = await self.connect(session=session, last_seq=1)
+        welcome = await self.receive(communicator)
+        self.assertEqual((welcome["session"], welcome["resumed"], welcome["seq"]), (session, True, 3))
+        self.assertEqual([await self.receive(communicator), await self.receive(communicator)], sent)
+        snapshot = await self.receive(communicator)
+        self.assertEqual(snapshot["seq"], 4)
+        self.assertEqual([order["id"] for order in snapshot["data"]["assignments"]], [self.order.id])
+        await self.disconnect(communicator)
+
+        # Another rider cannot take the session over.
+        other = await sync_to_async(Rider.objects.create)(
+            user=await User.objects.acreate(username="rider_other"), mobile="8999999999"
+        )
+        self.token = str(AccessToken.for_user(other.user))
+        communicator = await self.connect(session=session, last_seq=0)
+        welcome = await self.receive(communicator)
+        self.assertNotEqual(welcome["session"], session)
+        self.assertFalse(welcome["resumed"])
+        await self.disconnect(communicator)
+
+    async def test_fixes_are_recorded_and_start_the_delivery(self):
+        await Order.objects.filter(id=self.order.id).aupdate(rider=self.rider)
+        communicator = await self.connect()
+        await self.receive(communicator)
+        await self.receive(communicator)
+        await communicator.send_input({"type": "websocket.receive", "text": json.dumps(
+            {"type": "fix", "order_id": self.order.id, "latitude": 12.97, "longitude": 80.24}
+        )})
+        await self.disconnect(communicator)
+
+        position = rider_location.get_position(self.rider.id)
+        self.assertEqual((position["order_id"], position["latitude"]), (self.order.id, 12.97))
+        order = await Order.objects.aget(id=self.order.id)
+        self.assertEqual(order.status, "on_the_way")
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+        self.order = make_order()
+        self.user = self.order.user
+        self.auth = {"headers": {"Authorization": f"Bearer {AccessToken.for_user(self.user)}"}}
+
+    async def test_authentication_and_permissions_match_the_drf_views(self):
+        response = await async_views.get_addresses(self.factory.get("/api/addresses/"))
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(json.loads(response.content)["detail"], "Authentication credentials were not provided.")
+        self.assertTrue(response["WWW-Authenticate"].startswith("Bearer"))
+
+        response = await async_views.get_addresses(self.factory.get("/api/addresses/", headers={"Authorization": "Bearer x"}))
+        self.assertEqual(response.status_code, 401)
+
+        response = await async_views.get_addresses(self.factory.get("/api/addresses/", **self.auth))
+        self.assertEqual(response.status_code, 200)
+        addresses = json.loads(response.content)["addresses"]
+        self.assertEqual([address["id"] for address in addresses], [self.order.address_id])
+
+    async def test_bodies_are_parsed_by_drf(self):
+        response = await async_views.send_otp(self.factory.get("/api/send-otp/"))
+        self.assertEqual(response.status_code, 405)
+        response = await async_views.send_otp(
+            self.factory.post("/api/send-otp/", "{", content_type="application/json")
+        )
+        self.assertEqual(response.status_code, 400)
+        response = await async_views.send_otp(self.factory.post("/api/send-otp/", {"mobile": "12"}))
+        self.assertEqual(json.loads(response.content)["error"], "Valid 10-digit mobile is required")
+
+        with mock.patch.object(async_views, "_send_fast2sms_otp", return_value=(True, None)) as send:
+            response = await async_views.send_otp(
+                self.factory.post("/api/send-otp/", {"mobile": "9123456789"}, content_type="application/json")
+            )
+        self.assertEqual(response.status_code, 200)
+        otp = await OTP.objects.aget(mobile="9123456789")
+        send.assert_called_once_with("9123456789", otp.otp)
+
+    async def test_payments_with_a_bad_signature_are_rejected(self):
+        body = {"razorpay_order_id": "o", "razorpay_payment_id": "p", "razorpay_signature": "bad"}
+        request = self.factory.post("/api/verify-payment/", body, content_type="application/json", **self.auth)
+        response = await async_views.verify_razorpay_payment(request)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.content)["error"], "Payment verification failed. Invalid signature.")
+        self.assertEqual(await Order.objects.acount(), 1)
+
+
+class OrderStatusTests(TestCase):
+    def setUp(self):
+        self.order = make_order(status="preparing")
+        self.staff = User.objects.create(username="staff", is_staff=True)
+        self.rider = make_riders(1)[0]
+
+    def post(self, user, status):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client.post("/api/orders/update-status/", {"order_id": self.order.id, "status": status}, format="json")
+
+    def test_staff_follows_transitions_and_events_are_logged(self):
+        self.assertEqual(self.post(self.staff, "ready_for_pickup").status_code, 200)
+        self.assertEqual(self.post(self.staff, "preparing").status_code, 409)
+
+        events = list(self.order.status_events.order_by("ts").values_list("from_status", "status", "source"))
+        self.assertEqual(events, [("preparing", "ready_for_pickup", "staff")])
+
+    def test_only_assigned_rider_sets_rider_statuses(self):
+        self.assertEqual(self.post(self.rider.user, "ready_for_pickup").status_code, 403)
+        self.assertEqual(self.post(self.order.user, "cancelled").status_code, 403)
+
+        Order.objects.filter(id=self.order.id).update(status="on_the_way", rider=self.rider)
+        self.assertEqual(self.post(self.rider.user, "delivery_pending").status_code, 200)
+        self.assertEqual(self.post(self.rider.user, "delivered").status_code, 403)
+
+
+class OrderPaginationTests(TestCase):
+    def setUp(self):
+        first = make_order(status="delivered")
+        self.customer = first.user
+        self.orders = [first] + [
+            Order.objects.create(
+                user=self.customer, address=first.address, subtotal=100, tax=5, total_price=105, status="delivered"
+            )
+            for _ in range(4)
+        ]
+        # Equal timestamps must still page by id without skipping or repeating rows.
+        Order.objects.filter(id__in=[o.id for o in self.orders[1:4]]).update(created_at=first.created_at)
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer)
+
+    def expected_ids(self):
+        return list(
+            Order.objects.filter(user=self.customer).order_by("-created_at", "-id").values_list("id", flat=True)
+        )
+
+    def test_cursor_walks_every_order_once(self):
+        seen, cursor = [], None
+        while True:
+            params = {"page_size": 2, **({"cursor": cursor} if cursor else {})}
+            body = self.client.get("/api/orders/", params).json()
+            seen += [order["id"] for order in body["orders"]]
+            cursor = body["next_cursor"]
+            if not cursor:
+                break
+        self.assertEqual(seen, self.expected_ids())
+
+    def test_since_returns_only_newer_orders(self):
+        body = self.client.get("/api/orders/", {"page_size": 2}).json()
+        newer = Order.objects.create(
+            user=self.customer, address=self.orders[0].address, subtotal=100, tax=5, total_price=105
+        )
+
+        body = self.client.get("/api/orders/", {"since": body["since_cursor"]}).json()
+        self.assertEqual([order["id"] for order in body["orders"]], [newer.id])
+        self.assertFalse(body["has_more"])
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get("/api/orders/", {"cursor": "not-a-cursor"})
+        self.assertEqual(response.status_code, 400)
+
+
+class AdminOrderListTests(TestCase):
+    def setUp(self):
+        first = make_order(status="pending")
+        self.rider = make_riders(1)[0]
+        for status in ["delivered", "pending", "delivered"]:
+            Order.objects.create(
+                user=first.user, address=first.address, subtotal=100, tax=5, total_price=105,
+                status=status, rider=self.rider,
+            )
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username="admin", is_staff=True))
+
+    def test_filters_and_cursor_pages(self):
+        seen, params = [], {"status": "delivered,pending", "rider": self.rider.id, "page_size": 2}
+        while True:
+            response = self.client.get("/api/admin/orders/", params)
+            seen += [order["id"] for order in response.json()]
+            if not response.has_header("X-Next-Cursor"):
+                break
+            params["cursor"] = response["X-Next-Cursor"]
+        expected = Order.objects.filter(rider=self.rider).order_by("-created_at", "-id")
+        self.assertEqual(seen, [order.id for order in expected])
+
+    def test_unknown_choice_is_rejected(self):
+        response = self.client.get("/api/admin/orders/", {"status": "lost"})
+        self.assertEqual(response.status_code, 400)
+
+
+class AdminQueryBudgetTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name="Burgers")
+        burger = Item.objects.create(category=category, name="Burger", price=100, description="")
+        fries = Item.objects.create(category=category, name="Fries", price=50, description="")
+        combo = Item.objects.create(category=category, name="Meal", price=0, description="", is_combo=True)
+        ComboItem.objects.create(combo=combo, item=burger)
+        ComboItem.objects.create(combo=combo, item=fries, quantity=2)
+        coupon = Coupon.objects.create(code="SAVE10", discount_type="percentage", discount_value=10)
+
+        order = make_order(status="delivered")
+        customer, address = order.user, order.address
+        for i in range(12):
+            if i:
+                order = Order.objects.create(
+                    user=customer, address=address, subtotal=100, tax=5, total_price=105, status="delivered",
+                    coupon=coupon,
+                )
+            first = OrderItem.objects.create(order=order, item=burger, quantity=1, price_at_order=100, tax_at_order=5)
+            OrderItem.objects.create(order=order, item=combo, quantity=1, price_at_order=200, tax_at_order=10)
+            review = OrderReview.objects.create(order=order, user=customer, delivery_rating=5, overall_rating=5)
+            OrderItemReview.objects.create(review=review, order_item=first, item_name="Burger", rating=5)
+            UserCouponUsage.objects.create(user=customer, coupon=coupon, order=order, discount_amount=10)
+            ticket = SupportTicket.objects.create(
+                user=customer, category="other", subject="Help", description="", order=order
+            )
+            SupportMessage.objects.create(ticket=ticket, sender_type="customer", message="Hi")
+
+            shopper = User.objects.create(username=f"70000000{i:02d}")
+            cart = Cart.objects.create(user=shopper)
+            CartItem.objects.create(cart=cart, item=burger)
+            CartItem.objects.create(cart=cart, item=combo)
+
+        cls.staff = User.objects.create(username="admin", is_staff=True, is_superuser=True)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+
+    def test_admin_api_lists(self):
+        for url, budget in [
+            ("/api/admin/orders/", 1),
+            ("/api/admin/order-items/", 1),
+            ("/api/admin/reviews/", 2),
+            ("/api/admin/item-reviews/", 1),
+            ("/api/admin/coupon-usage/", 1),
+            ("/api/admin/support-tickets/", 2),
+            ("/api/admin/support-messages/", 1),
+            ("/api/admin/users/", 1),
+            ("/api/admin/items/", 1),
+        ]:
+            with self.subTest(url=url):
+                self.assertQueryBudget(url, budget)
+
+    def test_django_admin_changelists(self):
+        client = Client()
+        client.force_login(self.staff)
+        for model in [Cart, CartItem, OrderItem, SupportTicket]:
+            url = f"/dj-admin/foodbackend/{model._meta.model_name}/"
+            first = model.objects.order_by("pk").first()
+            with self.subTest(url=url):
+                self.assertQueryBudget(url, 12, pages=({"id__exact": first.pk}, {}), client=client)
+
+
+class OrderRollupTests(TestCase):
+    def rollup_rows(self):
+        return sorted(
+            OrderRollup.objects.exclude(orders=0).values_list(
+                "granularity", "bucket", "status", "orders", "revenue", "discounts", "delivery_charges"
+            )
+        )
+
+    def test_incremental_rollups_match_rebuild(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            order = make_order(status="pending")
+            order_states.record_created(order)
+            other = Order.objects.create(
+                user=order.user, address=order.address, subtotal=200, tax=10, total_price=210,
+                coupon_discount=20, delivery_charge=15, status="pending",
+            )
+            order_states.record_created(other)
+        for from_status, to_status in [("pending", "confirmed"), ("confirmed", "preparing"),
+                                       ("preparing", "ready_for_pickup"), ("ready_for_pickup", "delivered")]:
+            with self.captureOnCommitCallbacks(execute=True):
+                order_states.transition(other.id, from_status, to_status)
+        with self.captureOnCommitCallbacks(execute=True):
+            order_states.transition(order.id, "pending", "cancelled")
+
+        incremental = self.rollup_rows()
+        rollups.rebuild()
+        self.assertEqual(incremental, self.rollup_rows())
+        # The migration's backfill runs the same rebuild on the historical models.
+        rollups.rebuild(apps=django_apps)
+        self.assertEqual(incremental, self.rollup_rows())
+
+        client = APIClient()
+        client.force_authenticate(User.objects.create(username="admin", is_staff=True))
+        body = client.get("/api/admin/stats/", {"granularity": "hour"}).json()
+        self.assertEqual(body["totals"]["orders"], 2)
+        self.assertEqual(body["totals"]["cancelled"], 1)
+        self.assertEqual(body["totals"]["revenue"], 210.0)
+        self.assertEqual(body["totals"]["average_order_value"], 210.0)
+        self.assertEqual(len(body["series"]), 48)
+        self.assertEqual(sum(bucket["orders"] for bucket in body["series"]), 2)
+
+
+class CustomerStatsTests(TestCase):
+    def stats_rows(self):
+        return sorted(CustomerStats.objects.values_list(
+            "user_id", "order_count", "delivered_count", "lifetime_spend", "last_order_at",
+            "favorite_category_id", "rating_count", "rating_sum", "average_rating",
+        ))
+
+    def test_incremental_stats_match_rebuild(self):
+        snacks = Category.objects.create(name="Snacks")
+        drinks = Category.objects.create(name="Drinks")
+        fries = Item.objects.create(name="Fries", category=snacks, price=50)
+        cola = Item.objects.create(name="Cola", category=drinks, price=40)
+        with self.captureOnCommitCallbacks(execute=True):
+            order = make_order(status="pending")
+            order_states.record_created(order)
+            other = Order.objects.create(
+                user=order.user, address=order.address, subtotal=200, tax=10, total_price=210, status="pending",
+            )
+            order_states.record_created(other)
+        OrderItem.objects.create(order=other, item=fries, quantity=1, price_at_order=50, tax_at_order=0)
+        OrderItem.objects.create(order=other, item=cola, quantity=3, price_at_order=40, tax_at_order=0)
+        for from_status, to_status in [("pending", "confirmed"), ("confirmed", "preparing"),
+                                       ("preparing", "ready_for_pickup"), ("ready_for_pickup", "delivered")]:
+            with self.captureOnCommitCallbacks(execute=True):
+                order_states.transition(other.id, from_status, to_status)
+
+        client = APIClient()
+        client.force_authenticate(order.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post(f"/api/orders/{other.id}/review/", {"delivery_rating": 4, "overall_rating": 5}, format="json")
+        self.assertEqual(response.status_code, 200)
+
+        stats = CustomerStats.objects.get(user=order.user)
+        self.assertEqual((stats.order_count, stats.delivered_count), (2, 1))
+        self.assertEqual(stats.lifetime_spend, Decimal("210.00"))
+        self.assertEqual(stats.favorite_category_id, drinks.id)
+        self.assertEqual(stats.average_rating, Decimal("5.00"))
+        ok, message = Coupon(code="NEW", for_first_time_users_only=True).can_be_used_by_user(order.user)
+        self.assertFalse(ok)
+
+        incremental = self.stats_rows()
+        self.assertEqual(customer_stats.rebuild(), 1)
+        self.assertEqual(incremental, self.stats_rows())
+
+        newcomer = User.objects.create(username="9000000001")
+        admin = APIClient()
+        admin.force_authenticate(User.objects.create(username="admin", is_staff=True))
+        users = admin.get("/api/admin/users/", {"ordering": "-customer_stats__lifetime_spend"}).json()
+        self.assertEqual([user["id"] for user in users], [order.user.id])
+        self.assertEqual(users[0]["stats"]["order_count"], 2)
+        users = admin.get("/api/admin/users/", {"lifetime_spend_max": "100"}).json()
+        self.assertEqual(users, [])
+        users = admin.get("/api/admin/users/", {"role": "customer"}).json()
+        self.assertEqual([user["id"] for user in users], [newcomer.id, order.user.id])
+        self.assertIsNone(users[0]["stats"])
+
+    def test_review_before_backfill_keeps_customer_a_repeat_customer(self):
+        # An order placed before CustomerStats existed has no stats row.
+        order = make_order(status="delivered")
+        client = APIClient()
+        client.force_authenticate(order.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            client.post(f"/api/orders/{order.id}/review/", {"delivery_rating": 4, "overall_rating": 5}, format="json")
+        self.assertFalse(CustomerStats.objects.exists())
+        ok, message = Coupon(code="NEW", for_first_time_users_only=True).can_be_used_by_user(order.user)
+        self.assertFalse(ok)
+
+        self.assertEqual(customer_stats.rebuild(apps=django_apps), 1)
+        stats = CustomerStats.objects.get(user=order.user)
+        self.assertEqual((stats.order_count, stats.average_rating), (1, Decimal("5.00")))
+
+
+class ItemRatingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def rating_rows(self):
+        return sorted(Item.objects.values_list(
+            "id", "rating_count", "rating_sum", "average_rating", "recent_rating_count", "recent_average_rating",
+        ))
+
+    def test_review_updates_item_ratings_served_from_menu(self):
+        category = Category.objects.create(name="Snacks")
+        fries = Item.objects.create(name="Fries", category=category, price=50)
+        vada = Item.objects.create(name="Vada", category=category, price=30)
+        order = make_order(status="delivered")
+        fries_line = OrderItem.objects.create(order=order, item=fries, quantity=1, price_at_order=50, tax_at_order=0)
+        vada_line = OrderItem.objects.create(order=order, item=vada, quantity=2, price_at_order=30, tax_at_order=0)
+        other = Order.objects.create(
+            user=order.user, address=order.address, subtotal=50, tax=0, total_price=50, status="delivered",
+        )
+        other_line = OrderItem.objects.create(order=other, item=fries, quantity=1, price_at_order=50, tax_at_order=0)
+
+        client = APIClient()
+        client.force_authenticate(order.user)
+        client.get("/api/home/")
+
+        def review(order_id, ratings):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = client.post(f"/api/orders/{order_id}/review/", {
+                    "delivery_rating": 5,
+                    "item_ratings": [{"order_item_id": line.id, "rating": rating} for line, rating in ratings],
+                }, format="json")
+            self.assertEqual(response.status_code, 200)
+
+        review(order.id, [(fries_line, 5), (vada_line, 3)])
+        cache.delete(item_ratings.BUMP_KEY)
+        review(other.id, [(other_line, 4)])
+        cache.delete(item_ratings.BUMP_KEY)
+        # Re-rating replaces the order's earlier item ratings.
+        review(order.id, [(fries_line, 2)])
+
+        fries.refresh_from_db()
+        vada.refresh_from_db()
+        self.assertEqual((fries.rating_count, fries.rating_sum, fries.average_rating), (2, 6, Decimal("3.00")))
+        self.assertEqual((fries.recent_rating_count, fries.recent_average_rating), (2, Decimal("3.00")))
+        self.assertEqual((vada.rating_count, vada.average_rating, vada.recent_average_rating), (0, None, None))
+        self.assertEqual(OrderItemReview.objects.get(order_item=fries_line).item_id, fries.id)
+
+        incremental = self.rating_rows()
+        item_ratings.rebuild()
+        self.assertEqual(incremental, self.rating_rows())
+
+        client.get("/api/home/")
+        body, queries = count_queries(lambda: client.get("/api/home/").json())
+        self.assertEqual(queries, 0)
+        ratings = {item["id"]: item["rating"] for item in body["items"]}
+        self.assertEqual(ratings[fries.id], {"count": 2, "average": 3.0, "recent_count": 2, "recent_average": 3.0})
+        self.assertIsNone(ratings[vada.id]["average"])
+
+
+class AdminExportTests(TestCase):
+    def setUp(self):
+        self.order = make_order(status="delivered")
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username="admin", is_staff=True))
+
+    def test_streams_csv_and_ndjson(self):
+        response = self.client.get("/api/admin/exports/orders.csv")
+        self.assertEqual(response["Content-Type"], "text/csv")
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertTrue(lines[0].startswith("id,created_at,status"))
+        self.assertEqual(len(lines), 2)
+
+        response = self.client.get("/api/admin/exports/orders.ndjson", {"date_from": "2000-01-01"})
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([(row["id"], row["status"]) for row in rows], [(self.order.id, "delivered")])
+        response = self.client.get("/api/admin/exports/orders.ndjson", {"date_to": "2000-01-01"})
+        self.assertEqual(b"".join(response.streaming_content), b"")
+
+    def test_coupon_usage_is_superuser_only(self):
+        self.assertEqual(self.client.get("/api/admin/exports/coupon-usage.csv").status_code, 403)
+        self.assertEqual(self.client.get("/api/admin/exports/payments.csv").status_code, 404)
+
+    def test_both_admin_mounts_serve_the_same_routes(self):
+        for path in ("exports/orders.csv", "menu/import/", "push-campaigns/", "stats/rider-locations/"):
+            self.assertEqual(resolve(f"/admin/{path}").func, resolve(f"/api/admin/{path}").func, path)
+
+
+class MenuImportTests(TestCase):
+    def setUp(self):
+        self.mains = Category.objects.create(name="Mains")
+        self.dosa = Item.objects.create(category=self.mains, name="Dosa", price=60, description="Plain")
+        self.vada = Item.objects.create(category=self.mains, name="Vada", price=30, description="Medu")
+        self.combo = Item.objects.create(category=self.mains, name="Tiffin", price=0, description="Combo", is_combo=True)
+        ComboItem.objects.create(combo=self.combo, item=self.dosa, quantity=1)
+        ComboItem.objects.create(combo=self.combo, item=self.vada, quantity=1)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username="admin", is_staff=True))
+        self.payload = {
+            "categories": [{"name": "Drinks", "gst_rate": "12"}],
+            "items": [
+                {"name": "dosa", "price": "65.00"},
+                {"name": "Vada", "price": "30"},
+                {"name": "Coffee", "category": "Drinks", "price": "25", "description": "Filter"},
+            ],
+            "combos": [
+                {"combo": "Tiffin", "item": "Dosa", "quantity": 2},
+                {"combo": "Tiffin", "item": "Coffee"},
+            ],
+        }
+
+    def test_dry_run_reports_without_writing(self):
+        version = catalog.version()
+        response = self.client.post("/api/admin/menu/import/?dry_run=1", self.payload, format="json")
+        report = response.json()
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(report["applied"])
+        self.assertEqual(report["items"]["created"], ["Coffee"])
+        self.assertEqual(report["items"]["updated"], [{"name": "Dosa", "changes": {"price": ["60.00", "65.00"]}}])
+        self.assertEqual(report["items"]["unchanged"], 1)
+        self.assertEqual(report["combos"]["deleted"], ["Tiffin: Vada"])
+        self.assertFalse(Item.objects.filter(name="Coffee").exists())
+        self.assertEqual(catalog.version(), version)
+
+    def test_apply_writes_in_bulk_and_bumps_once(self):
+        version = catalog.version()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post("/api/admin/menu/import/", self.payload, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()["applied"])
+        self.assertLess(len(queries), 20)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(catalog.version(), version + 1)
+
+        self.dosa.refresh_from_db()
+        self.assertEqual(self.dosa.price, Decimal("65.00"))
+        coffee = Item.objects.get(name="Coffee")
+        self.assertEqual(coffee.category.name, "Drinks")
+        self.assertEqual(
+            sorted(self.combo.combo_links.values_list("item__name", "quantity")),
+            [("Coffee", 1), ("Dosa", 2)],
+        )
+
+    def test_invalid_rows_reject_the_whole_import(self):
+        self.payload["items"].append({"name": "Idli", "category": "Snacks", "price": "abc", "description": "x"})
+        response = self.client.post("/api/admin/menu/import/", self.payload, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(response.json()["errors"]), 1)
+        self.assertFalse(Category.objects.filter(name="Drinks").exists())
+
+
+class BulkOrderStatusTests(TestCase):
+    def setUp(self):
+        first = make_order(status="confirmed")
+        self.orders = [first] + [
+            Order.objects.create(
+                user=first.user, address=first.address, subtotal=100, tax=5, total_price=105, status=status,
+            )
+            for status in ["confirmed", "confirmed", "delivered"]
+        ]
+        rollups.rebuild()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username="kitchen", is_staff=True))
+
+    def rollup_rows(self):
+        return sorted(OrderRollup.objects.exclude(orders=0).values_list("granularity", "status", "orders"))
+
+    def test_moves_valid_orders_in_one_update(self):
+        ids = [order.id for order in self.orders] + [999999]
+        with self.captureOnCommitCallbacks(execute=True):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(
+                    "/api/admin/orders/bulk-status/", {"order_ids": ids, "status": "preparing"}, format="json"
+                )
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body["updated"], [order.id for order in self.orders[:3]])
+        self.assertEqual([entry["order_id"] for entry in body["skipped"]], [self.orders[3].id, 999999])
+        updates = [q for q in queries.captured_queries if q["sql"].startswith('UPDATE "foodbackend_order"')]
+        self.assertEqual(len(updates), 1)
+
+        self.assertEqual(Order.objects.filter(status="preparing").count(), 3)
+        self.assertEqual(
+            OrderStatusEvent.objects.filter(from_status="confirmed", status="preparing", source="staff").count(), 3
+        )
+        incremental = self.rollup_rows()
+        rollups.rebuild()
+        self.assertEqual(incremental, self.rollup_rows())
+
+    def test_single_update_closes_the_delivery_like_the_bulk_move(self):
+        order, rider = self.orders[0], make_riders(1)[0]
+        Order.objects.filter(id=order.id).update(status="on_the_way", rider=rider)
+        rider_location.record_position(rider.id, order.id, 12.97, 80.24)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(f"/api/admin/orders/{order.id}/", {"status": "delivered"}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(DeliveryTrail.objects.get(order=order).raw_point_count, 1)
+        self.assertFalse(RiderLocation.objects.filter(order=order).exists())
+
+
+class PushEngineTests(TestCase):
+    def setUp(self):
+        user = User.objects.create(username="9000000001")
+        PushToken.objects.bulk_create([
+            PushToken(user=user, push_token=f"ExponentPushToken[{i}]", device_type="android") for i in range(250)
+        ])
+        PushToken.objects.filter(push_token="ExponentPushToken[7]").update(is_active=False)
+        self.expo = ExpoStandIn(
+            rejected={"ExponentPushToken[0]", "ExponentPushToken[1]"},
+            unregistered={"ExponentPushToken[2]", "ExponentPushToken[3]", "ExponentPushToken[4]"},
+        ).start()
+        self.addCleanup(self.expo.stop)
+
+    def test_broadcast_batches_and_prunes_dead_tokens(self):
+        with override_settings(EXPO_API_URL=self.expo.url, PUSH_TOKEN_CHUNK_SIZE=60, PUSH_RECEIPT_DELAY=0):
+            stats = push.broadcast(PushToken.objects.all(), "Hi", "There")
+            self.assertEqual(stats, {"sent": 247, "failed": 0, "deactivated": 2})
+            sends = [body for path, body in self.expo.requests if path == "send"]
+            self.assertEqual(sorted(len(body) for body in sends), [49, 100, 100])
+            self.assertEqual(len({m["to"] for m in self.expo.sent_messages()}), 249)
+
+            receipts = push.process_receipts()
+        self.assertEqual(receipts["checked"], 247)
+        self.assertEqual(receipts["deactivated"], 3)
+        self.assertFalse(PushTicket.objects.exists())
+        self.assertEqual(PushToken.objects.filter(is_active=False).count(), 6)
+
+    def test_sends_are_retried_only_when_expo_cannot_have_accepted_them(self):
+        messages = push.expo_messages(["ExponentPushToken[100]"], "Hi", "There")
+        with override_settings(EXPO_API_URL=self.expo.url, PUSH_RETRY_BACKOFF=0):
+            self.expo.send_errors = [429]
+            self.assertEqual(push.send_messages(messages)["sent"], 1)
+            self.assertEqual(len(self.expo.requests), 2)
+
+            self.expo.send_errors = [502]
+            stats = push.send_messages(messages, collect_failures=True)
+        self.assertEqual((stats["failed"], stats["failures"]), (1, []))
+        self.assertEqual(len(self.expo.requests), 3)
+
+
+class NotificationOutboxTests(TestCase):
+    def setUp(self):
+        self.order = make_order(status="pending")
+        PushToken.objects.create(user=self.order.user, push_token="ExponentPushToken[a]", device_type="ios")
+        self.expo = ExpoStandIn().start()
+        self.addCleanup(self.expo.stop)
+
+    def test_coalesces_changes_into_one_push(self):
+        for from_status, to_status in [("pending", "confirmed"), ("confirmed", "preparing")]:
+            order_states.transition(self.order.id, from_status, to_status)
+        self.assertEqual(NotificationOutbox.objects.get().status, "preparing")
+
+        NotificationOutbox.objects.update(available_at=timezone.now())
+        with override_settings(EXPO_API_URL=self.expo.url):
+            self.assertEqual(outbox.drain()["sent"], 1)
+        self.assertEqual(
+            [message["data"] for message in self.expo.sent_messages()],
+            [{"order_id": self.order.id, "status": "preparing", "type": "order_update"}],
+        )
+        self.assertFalse(NotificationOutbox.objects.exists())
+
+    def test_failed_send_is_retried_later(self):
+        order_states.transition(self.order.id, "pending", "confirmed")
+        NotificationOutbox.objects.update(available_at=timezone.now())
+        self.expo.stop()
+        with override_settings(EXPO_API_URL=self.expo.url, PUSH_MAX_ATTEMPTS=1):
+            self.assertEqual(outbox.drain(), {"sent": 0, "retried": 1, "dropped": 0})
+        row = NotificationOutbox.objects.get()
+        self.assertEqual(row.attempts, 1)
+        self.assertGreater(row.available_at, timezone.now())
+
+    def test_retries_go_only_to_the_devices_that_missed_the_push(self):
+        PushToken.objects.create(user=self.order.user, push_token="ExponentPushToken[b]", device_type="android")
+        self.expo.throttled = {"ExponentPushToken[b]"}
+        order_states.transition(self.order.id, "pending", "confirmed")
+        NotificationOutbox.objects.update(available_at=timezone.now())
+        with override_settings(EXPO_API_URL=self.expo.url):
+            self.assertEqual(outbox.drain()["retried"], 1)
+            self.assertEqual(NotificationOutbox.objects.get().pending_tokens, ["ExponentPushToken[b]"])
+
+            self.expo.throttled = set()
+            NotificationOutbox.objects.update(available_at=timezone.now())
+            self.assertEqual(outbox.drain()["sent"], 1)
+        self.assertEqual(
+            sorted(message["to"] for message in self.expo.sent_messages()),
+            ["ExponentPushToken[a]", "ExponentPushToken[b]", "ExponentPushToken[b]"],
+        )
+        self.assertFalse(NotificationOutbox.objects.exists())
+
+        # A newer status is owed to every device again.
+        order_states.transition(self.order.id, "confirmed", "preparing")
+        self.assertIsNone(NotificationOutbox.objects.get().pending_tokens)
+
+
+class PushCampaignTests(TestCase):
+    def setUp(self):
+        self.lapsed = make_order(status="delivered")
+        Order.objects.filter(id=self.lapsed.id).update(created_at=timezone.now() - timedelta(days=60))
+        self.newcomer = User.objects.create(username="9000000002")
+        PushToken.objects.bulk_create(
+            [PushToken(user=self.lapsed.user, push_token="ExponentPushToken[lapsed]", device_type="ios")]
+            + [
+                PushToken(user=self.newcomer, push_token=f"ExponentPushToken[new-{i}]", device_type="android")
+                for i in range(5)
+            ]
+        )
+        self.expo = ExpoStandIn().start()
+        self.addCleanup(self.expo.stop)
+
+    def devices(self, segment):
+        return set(campaigns.audience(segment).values_list("push_token", flat=True))
+
+    def test_segments(self):
+        self.assertEqual(self.devices({"type": "lapsed", "days": 30}), {"ExponentPushToken[lapsed]"})
+        self.assertEqual(self.devices({"type": "lapsed", "days": 90}), set())
+        self.assertEqual(len(self.devices({"type": "first_time"})), 5)
+        near = {"type": "near_outlet", "km": 1, "lat": 12.975, "lng": 80.24}
+        self.assertEqual(self.devices(near), {"ExponentPushToken[lapsed]"})
+        self.assertEqual(self.devices({**near, "lat": 13.0}), set())
+        self.assertEqual(len(self.devices({"any": [near, {"type": "first_time"}]})), 6)
+        self.assertEqual(self.devices({"not": {"type": "device_type", "device_type": "android"}}), {
+            "ExponentPushToken[lapsed]"
+        })
+        with self.assertRaises(ValueError):
+            campaigns.compile_segment({"type": "birthday"})
+
+    def test_dispatch_resumes_from_cursor(self):
+        campaign = PushCampaign.objects.create(
+            name="Welcome", title="Hungry?", body="Your first order is on us", segment={"type": "first_time"}
+        )
+        campaign, error = campaigns.start(campaign)
+        self.assertIsNone(error)
+        self.assertEqual(campaign.total_recipients, 5)
+
+        with override_settings(EXPO_API_URL=self.expo.url, CAMPAIGN_CHUNK_SIZE=2):
+            campaign, lease_until = campaigns.claim_next()
+            self.assertEqual(campaigns.claim_next(), (None, None))
+            self.assertEqual(campaigns.dispatch(campaign, lease_until, max_chunks=1), "running")
+            campaigns.set_status(campaign, ["running"], "paused")
+            self.assertEqual(campaigns.claim_next(), (None, None))
+
+            campaigns.set_status(campaign, ["paused"], "running")
+            campaign, lease_until = campaigns.claim_next()
+            self.assertEqual(campaigns.dispatch(campaign, lease_until), "completed")
+
+        campaign.refresh_from_db()
+        self.assertEqual((campaign.sent_count, campaign.failed_count), (5, 0))
+        self.assertIsNone(campaign.lease_until)
+        sent = [message["to"] for message in self.expo.sent_messages()]
+        self.assertEqual(sorted(sent), sorted(f"ExponentPushToken[new-{i}]" for i in range(5)))
+        self.assertEqual(self.expo.sent_messages()[0]["data"], {"type": "campaign", "campaign_id": campaign.id})
+
+
+class CouponRulesTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.customer = User.objects.create(username="9000000003")
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer)
+        mains = Category.objects.create(name="Mains")
+        dosa = Item.objects.create(category=mains, name="Dosa", price=60, description="Plain")
+        for i in range(10):
+            Coupon.objects.create(code=f"SAVE{i}", discount_type="percentage", discount_value=10)
+        Coupon.objects.create(code="FREEDOSA", discount_type="free_item", free_item=dosa)
+        Coupon.objects.create(code="PICKONE", discount_type="free_item", free_item_category=mains)
+        Coupon.objects.create(code="NEWDIP", discount_type="fixed", discount_value=50, for_first_time_users_only=True)
+        Coupon.objects.create(code="FIRST5", discount_type="fixed", discount_value=20, max_uses=5, used_count=5)
+        Coupon.objects.create(code="LATER", discount_type="fixed", discount_value=20,
+                              valid_from=timezone.now() + timedelta(days=1))
+
+    def codes(self):
+        return {coupon["code"] for coupon in self.client.get("/api/coupons/").json()["coupons"]}
+
+    def test_listing_evaluates_compiled_rules_in_constant_queries(self):
+        self.assertEqual(self.codes(), {f"SAVE{i}" for i in range(10)} | {"FREEDOSA", "PICKONE", "NEWDIP"})
+        coupons_payload = self.client.get("/api/coupons/").json()["coupons"]
+        self.assertEqual(
+            next(c for c in coupons_payload if c["code"] == "FREEDOSA")["free_item"],
+            {"id": Item.objects.get().id, "name": "Dosa", "price": 60.0},
+        )
+        # Customer stats (none yet, so the order count), coupon usage and the capped coupons' usage.
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get("/api/coupons/")
+        self.assertEqual(len(queries), 4)
+
+        Order.objects.create(user=self.customer, subtotal=100, tax=5, total_price=105, status="delivered")
+        self.assertNotIn("NEWDIP", self.codes())
+
+    def test_listing_and_checkout_read_the_same_customer_facts(self):
+        once = Coupon.objects.create(code="ONCE", discount_type="fixed", discount_value=10, max_uses_per_user=1)
+        # The usage row is the record of the redemption, whatever the order row says.
+        order = Order.objects.create(user=self.customer, subtotal=100, tax=5, total_price=95)
+        UserCouponUsage.objects.create(user=self.customer, coupon=once, order=order, discount_amount=10)
+        CustomerStats.objects.create(user=self.customer, order_count=1)
+        newdip = Coupon.objects.get(code="NEWDIP")
+
+        listed = self.codes()
+        for coupon in (once, newdip):
+            self.assertNotIn(coupon.code, listed)
+            self.assertFalse(coupon.can_be_used_by_user(self.customer)[0], coupon.code)
+
+    def test_best_offers_ranks_coupons_for_the_cart(self):
+        Coupon.objects.create(code="HALF", discount_type="percentage", discount_value=50, max_discount_amount=40)
+        Coupon.objects.create(code="BIG", discount_type="fixed", discount_value=100, min_order_amount=500)
+        cart = Cart.objects.create(user=self.customer)
+        CartItem.objects.create(cart=cart, item=Item.objects.get(name="Dosa"), quantity=2)
+
+        with CaptureQueriesContext(connection) as queries:
+            result = self.client.get("/api/coupons/best/").json()
+        self.assertLessEqual(len(queries), 9)
+        self.assertEqual(result["cart_subtotal"], 120.0)
+        ranked = [(offer["code"], offer["discount_amount"]) for offer in result["coupons"]]
+        self.assertEqual(ranked[:4], [("FREEDOSA", 60.0), ("PICKONE", 60.0), ("NEWDIP", 50.0), ("HALF", 40.0)])
+        self.assertEqual(ranked[4:], [(f"SAVE{i}", 12.0) for i in range(10)])
+        self.assertEqual(result["best"]["code"], "FREEDOSA")
+        self.assertTrue(result["coupons"][1]["free_item_selection_required"])
+        self.assertEqual(result["coupons"][1]["selected_item"]["name"], "Dosa")
+        self.assertEqual([(c["code"], c["amount_needed"]) for c in result["almost_eligible"]], [("BIG", 380.0)])
+
+    def test_admin_writes_recompile_the_rules(self):
+        self.codes()
+        admin = APIClient()
+        admin.force_authenticate(User.objects.create(username="admin", is_staff=True, is_superuser=True))
+        coupon = Coupon.objects.get(code="SAVE0")
+        with self.captureOnCommitCallbacks(execute=True):
+            response = admin.patch(f"/api/admin/coupons/{coupon.id}/", {"is_active": False}, format="json")
+        self.assertEqual(response.status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = admin.post(
+                "/api/admin/coupons/", {"code": "FRESH", "discount_type": "fixed", "discount_value": "15"}, format="json"
+            )
+        self.assertEqual(response.status_code, 201)
+        codes = self.codes()
+        self.assertNotIn("SAVE0", codes)
+        self.assertIn("FRESH", codes)
+
+
+class CouponCodeTests(TestCase):
+    def setUp(self):
+        self.customer = User.objects.create(username="9000000004")
+        self.client = APIClient()
+        self.client.force_authenticate(self.customer)
+        self.admin = APIClient()
+        self.admin.force_authenticate(User.objects.create(username="admin", is_staff=True, is_superuser=True))
+        self.coupon = Coupon.objects.create(code="DIWALI", discount_type="fixed", discount_value=50, unique_codes=True)
+        dosa = Item.objects.create(category=Category.objects.create(name="Mains"), name="Dosa", price=60,
+                                   description="Plain")
+        CartItem.objects.create(cart=Cart.objects.create(user=self.customer), item=dosa, quantity=2)
+
+    def checkout(self, **data):
+        return self.client.post("/api/checkout/", {"delivery_method": "pickup", **data}, format="json")
+
+    def test_generated_codes_are_unique_and_decode(self):
+        response = self.admin.post(f"/api/admin/coupons/{self.coupon.id}/codes/", {"count": 300}, format="json")
+        self.assertEqual(response.json(), {"count": 300, "first_serial": 1, "last_serial": 300})
+        self.admin.post(f"/api/admin/coupons/{self.coupon.id}/codes/", {"count": 5}, format="json")
+
+        response = self.admin.get(f"/api/admin/coupons/{self.coupon.id}/codes/?first_serial=301")
+        rows = b"".join(response.streaming_content).decode().splitlines()[1:]
+        self.assertEqual([row.split(",")[1] for row in rows], ["301", "302", "303", "304", "305"])
+
+        codes = [coupon_codes.encode(self.coupon.id, serial) for serial in range(1, 306)]
+        self.assertEqual(len(set(codes)), 305)
+        self.assertEqual(coupon_codes.decode(codes[41].lower().replace("-", " ")), (self.coupon.id, 42))
+        typo = codes[0][:-1] + ("0" if codes[0][-1] != "0" else "1")
+        self.assertIsNone(coupon_codes.decode(typo))
+
+    def test_checkout_redeems_a_code_once(self):
+        coupon_codes.generate(self.coupon, 2)
+        code = coupon_codes.encode(self.coupon.id, 1)
+        self.assertEqual(self.checkout(coupon_id=self.coupon.id).status_code, 400)
+        self.assertEqual(self.client.post("/api/coupons/validate/", {"code": code, "cart_subtotal": 120},
+                                          format="json").json()["coupon"]["coupon_code"], code)
+
+        response = self.checkout(coupon_code=code)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()["coupon_discount"], 50.0)
+        redeemed = CouponCode.objects.get(serial=1)
+        self.assertEqual(redeemed.redeemed_by, self.customer)
+        self.assertEqual(UserCouponUsage.objects.get().coupon_code, redeemed)
+        self.coupon.refresh_from_db()
+        self.assertEqual(self.coupon.used_count, 0)
+
+        CartItem.objects.create(cart=self.customer.cart, item=Item.objects.get(), quantity=1)
+        self.assertEqual(self.checkout(coupon_code=code).json()["error"], "This code has already been used")
+
+    def test_per_user_limit(self):
+        cache.clear()
+        shared = Coupon.objects.create(code="ONCE", discount_type="fixed", discount_value=10, max_uses_per_user=1)
+        self.assertEqual(self.checkout(coupon_id=shared.id).status_code, 201)
+        self.assertNotIn("ONCE", [c["code"] for c in self.client.get("/api/coupons/").json()["coupons"]])
+
+        CartItem.objects.create(cart=self.customer.cart, item=Item.objects.get(), quantity=1)
+        self.assertEqual(self.checkout(coupon_id=shared.id).json()["error"], "You have already used this coupon")
+
+    def test_failed_checkout_does_not_spend_the_coupon(self):
+        coupon_codes.generate(self.coupon, 1)
+        shared = Coupon.objects.create(code="CAPPED", discount_type="fixed", discount_value=10, max_uses=1)
+        with mock.patch.object(order_states, "record_created", side_effect=RuntimeError("db down")):
+            with self.assertRaises(RuntimeError):
+                self.checkout(coupon_code=coupon_codes.encode(self.coupon.id, 1))
+            with self.assertRaises(RuntimeError):
+                self.checkout(coupon_id=shared.id)
+
+        self.assertIsNone(CouponCode.objects.get().redeemed_at)
+        shared.refresh_from_db()
+        self.assertEqual(shared.used_count, 0)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(self.checkout(coupon_id=shared.id).status_code, 201)
@@ -0,0 +1,212 @@
+"""
+Compact delivery trails.
+
+Raw fixes sit in ``RiderLocation`` while a delivery is in flight. When it
+closes, the fixes are simplified with Douglas-Peucker and packed into a single
+``DeliveryTrail`` row:
+
+    points: zlib(array('i', [dt, dlat, dlng, dt, dlat, dlng, ...]))
+
+where latitude/longitude are integer microdegrees and dt is whole seconds, all
+delta-encoded against the previous point (the first triple is absolute, with
+dt counted from ``started_at``). The raw rows that were folded in are deleted
+afterwards; fixes that arrive later are simplified on their own and merged
+into the stored trail.
+"""
+import math
+import sys
+import zlib
+from array import array
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import DeliveryTrail, Order, RiderLocation
+from .rider_location import EARTH_RADIUS_M, distance_m
+
+MICRODEGREES = 1_000_000
+
+
+def encode_points(points, started_at):
+    """Pack ``[(lat, lng, recorded_at), ...]`` into a compressed delta blob."""
+    values = array("i")
+    prev_t, prev_lat, prev_lng = 0, 0, 0
+    for lat, lng, recorded_at in points:
+        t = int(round((recorded_at - started_at).total_seconds()))
+        ilat = int(round(lat * MICRODEGREES))
+        ilng = int(round(lng * MICRODEGREES))
+        values.extend((t - prev_t, ilat - prev_lat, ilng - prev_lng))
+        prev_t, prev_lat, prev_lng = t, ilat, ilng
+
+    if sys.byteorder == "big":
+        values.byteswap()
+    return zlib.compress(values.tobytes(), 9)
+
+
+def decode_points(blob, started_at):
+    """Inverse of :func:`encode_points`."""
+    values = array("i")
+    values.frombytes(zlib.decompress(bytes(blob)))
+    if sys.byteorder == "big":
+        values.byteswap()
+
+    points = []
+    t, ilat, ilng = 0, 0, 0
+    for i in range(0, len(values), 3):
+        t += values[i]
+        ilat += values[i + 1]
+        ilng += values[i + 2]
+        points.append((ilat / MICRODEGREES, ilng / MICRODEGREES, started_at + timedelta(seconds=t)))
+    return points
+
+
+def simplify(points, tolerance_m=None):
+    """Douglas-Peucker over ``[(lat, lng, ...), ...]``, tolerance in metres."""
+    if tolerance_m is None:
+        tolerance_m = getattr(settings, "TRAIL_SIMPLIFY_TOLERANCE_M", 10)
+    if len(points) < 3:
+        return list(points)
+
+    # Project onto a local plane in metres; fine at delivery-radius scale.
+    ref_lat = math.radians(points[0][0])
+    scale = math.pi / 180 * EARTH_RADIUS_M
+    xy = [(p[1] * scale * math.cos(ref_lat), p[0] * scale) for p in points]
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        max_dist, index = 0.0, None
+        for i in range(start + 1, end):
+            dist = _segment_distance(xy[i], xy[start], xy[end])
+            if dist > max_dist:
+                max_dist, index = dist, i
+        if index is not None and max_dist > tolerance_m:
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+
+    return [p for p, kept in zip(points, keep) if kept]
+
+
+def _segment_distance(p, a, b):
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    if dx == 0 and dy == 0:
+        return math.hypot(p[0] - a[0], p[1] - a[1])
+    t = max(0.0, min(1.0, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / (dx * dx + dy * dy)))
+    return math.hypot(p[0] - (a[0] + t * dx), p[1] - (a[1] + t * dy))
+
+
+def encode_polyline(points):
+    """Google encoded polyline (precision 5) for ``[(lat, lng, ...), ...]``."""
+    chunks = []
+    prev_lat, prev_lng = 0, 0
+    for point in points:
+        lat = int(round(point[0] * 1e5))
+        lng = int(round(point[1] * 1e5))
+        for delta in (lat - prev_lat, lng - prev_lng):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                chunks.append(chr((0x20 | (value & 0x1F)) + 63))
+                value >>= 5
+            chunks.append(chr(value + 63))
+        prev_lat, prev_lng = lat, lng
+    return "".join(chunks)
+
+
+def path_length_m(points):
+    return sum(
+        distance_m(a[0], a[1], b[0], b[1])
+        for a, b in zip(points, points[1:])
+    )
+
+
+def _raw_fixes(order_id):
+    """``(ids, points)`` of an order's raw fixes, oldest first."""
+    rows = list(
+        RiderLocation.objects.filter(order_id=order_id)
+        .order_by("recorded_at")
+        .values_list("id", "latitude", "longitude", "recorded_at")
+    )
+    return [row[0] for row in rows], [(float(lat), float(lng), recorded_at) for _, lat, lng, recorded_at in rows]
+
+
+def _merge(trail_points, raw):
+    """
+    Add raw fixes to points already simplified. Only the new fixes are
+    simplified, so merging again never compounds the simplification error.
+    """
+    return sorted(trail_points + simplify(raw), key=lambda p: p[2])
+
+
+def close_trail(order_id):
+    """
+    Fold an order's raw fixes into its DeliveryTrail and delete them.
+
+    Safe to call more than once: fixes that arrive late (for example a
+    ``rider_sync`` upload) are merged into the existing trail.
+    """
+    with transaction.atomic():
+        trail = DeliveryTrail.objects.select_for_update().filter(order_id=order_id).first()
+        ids, raw = _raw_fixes(order_id)
+        if not raw:
+            return trail
+
+        raw_count = len(raw)
+        if trail and trail.points:
+            points = _merge(decode_points(trail.points, trail.started_at), raw)
+            raw_count += trail.raw_point_count
+        else:
+            points = simplify(raw)
+        started_at = points[0][2]
+        values = {
+            "rider_id": Order.objects.filter(id=order_id).values_list("rider_id", flat=True).first(),
+            "points": encode_points(points, started_at),
+            "point_count": len(points),
+            "raw_point_count": raw_count,
+            "distance_m": int(path_length_m(points)),
+            "started_at": started_at,
+            "ended_at": points[-1][2],
+        }
+        trail, _ = DeliveryTrail.objects.update_or_create(order_id=order_id, defaults=values)
+        # Only the fixes folded in above: rows inserted since the read stay
+        # for the next call.
+        for start in range(0, len(ids), 500):
+            RiderLocation.objects.filter(id__in=ids[start:start + 500]).delete()
+    return trail
+
+
+def trail_payload(order):
+    """Replay payload for an order: stored trail if closed, else built from raw fixes."""
+    trail = DeliveryTrail.objects.filter(order=order).first()
+    _, raw = _raw_fixes(order.id)
+    if trail and trail.points:
+        points = _merge(decode_points(trail.points, trail.started_at), raw)
+    else:
+        points = simplify(raw)
+
+    if not points:
+        return {
+            "order_id": order.id,
+            "polyline": "",
+            "point_count": 0,
+            "offsets": [],
+            "distance_m": 0,
+            "started_at": None,
+            "ended_at": None,
+            "is_closed": False,
+        }
+
+    started_at = points[0][2]
+    return {
+        "order_id": order.id,
+        "polyline": encode_polyline(points),
+        "point_count": len(points),
+        "offsets": [int(round((p[2] - started_at).total_seconds())) for p in points],
+        "distance_m": int(path_length_m(points)),
+        "started_at": started_at.isoformat(),
+        "ended_at": points[-1][2].isoformat(),
+        "is_closed": bool(trail),
+    }
@@ -1,29 +1,6 @@
+from django.conf import settings
 from django.urls import path, include
-from rest_framework.routers import DefaultRouter
 
-from .admin_api import (
-    admin_csrf,
-    admin_login,
-    admin_logout,
-    admin_me,
-    admin_change_password,
-    admin_stats,
-    AdminAddressViewSet,
-    AdminAppVersionViewSet,
-    AdminCategoryViewSet,
-    AdminCouponViewSet,
-    AdminItemViewSet,
-    AdminOrderItemReviewViewSet,
-    AdminOrderItemViewSet,
-    AdminOrderViewSet,
-    AdminOrderReviewViewSet,
-    AdminPushTokenViewSet,
-    AdminUserCouponUsageViewSet,
-    AdminUserViewSet,
-    AdminSupportTicketViewSet,
-    AdminSupportMessageViewSet,
-    AdminStaffViewSet,
-)
 from .views import (
     send_otp,
     verify_otp,
@@ -33,6 +10,7 @@ from .views import (
     get_rider_orders,
     get_ready_for_pickup_orders,
     accept_order_for_pickup,
+    rider_sync,
     home_data,
     get_combos,
     get_cart,
@@ -49,6 +27,7 @@ from .views import (
     mark_order_delivered,
     get_orders,
     get_order_detail,
+    get_order_trail,
     get_active_order,
     order_review,
     register_push_token,
@@ -57,39 +36,27 @@ from .views import (
     create_razorpay_order,
     verify_razorpay_payment,
     available_coupons,
+    best_coupons,
     validate_coupon,
     apply_coupon,
     create_support_ticket,
     get_support_tickets,
     support_chat,
 )
+from .streams import order_stream
 
-admin_router = DefaultRouter()
-admin_router.register(r"categories", AdminCategoryViewSet, basename="admin-categories")
-admin_router.register(r"items", AdminItemViewSet, basename="admin-items")
-admin_router.register(r"orders", AdminOrderViewSet, basename="admin-orders")
-admin_router.register(r"order-items", AdminOrderItemViewSet, basename="admin-order-items")
-admin_router.register(r"reviews", AdminOrderReviewViewSet, basename="admin-reviews")
-admin_router.register(r"item-reviews", AdminOrderItemReviewViewSet, basename="admin-item-reviews")
-admin_router.register(r"coupons", AdminCouponViewSet, basename="admin-coupons")
-admin_router.register(r"coupon-usage", AdminUserCouponUsageViewSet, basename="admin-coupon-usage")
-admin_router.register(r"push-tokens", AdminPushTokenViewSet, basename="admin-push-tokens")
-admin_router.register(r"app-versions", AdminAppVersionViewSet, basename="admin-app-versions")
-admin_router.register(r"users", AdminUserViewSet, basename="admin-users")
-admin_router.register(r"addresses", AdminAddressViewSet, basename="admin-addresses")
-admin_router.register(r"support-tickets", AdminSupportTicketViewSet, basename="admin-support-tickets")
-admin_router.register(r"support-messages", AdminSupportMessageViewSet, basename="admin-support-messages")
-admin_router.register(r"staff", AdminStaffViewSet, basename="admin-staff")
+if getattr(settings, "ASYNC_IO_VIEWS", False):
+    # ASGI profile: async versions of the endpoints that wait on third parties.
+    from .async_views import (  # noqa: F811
+        create_razorpay_order,
+        get_addresses,
+        send_otp,
+        verify_razorpay_payment,
+    )
 
 urlpatterns = [
     # Admin API (session-based)
-    path("admin/csrf/", admin_csrf, name="admin_csrf"),
-    path("admin/login/", admin_login, name="admin_login"),
-    path("admin/logout/", admin_logout, name="admin_logout"),
-    path("admin/me/", admin_me, name="admin_me"),
-    path("admin/change-password/", admin_change_password, name="admin_change_password"),
-    path("admin/stats/", admin_stats, name="admin_stats"),
-    path("admin/", include(admin_router.urls)),
+    path("admin/", include("foodbackend.admin_urls")),
 
     # Authentication
     path("send-otp/", send_otp, name="send_otp"),
@@ -104,6 +71,7 @@ urlpatterns = [
     path("rider/orders/", get_rider_orders, name="get_rider_orders"),
     path("rider/orders/ready/", get_ready_for_pickup_orders, name="get_ready_for_pickup_orders"),
     path("rider/orders/accept/", accept_order_for_pickup, name="accept_order_for_pickup"),
+    path("rider/sync/", rider_sync, name="rider_sync"),
     
     # Home & Items
     path("home/", home_data, name="home_data"),
@@ -129,6 +97,8 @@ urlpatterns = [
     path("orders/", get_orders, name="get_orders"),
     path("orders/<int:order_id>/", get_order_detail, name="get_order_detail"),
     path("orders/<int:order_id>/review/", order_review, name="order_review"),
+    path("orders/<int:order_id>/trail/", get_order_trail, name="get_order_trail"),
+    path("orders/<int:order_id>/stream/", order_stream, name="order_stream"),
     path("orders/active/", get_active_order, name="get_active_order"),
     path("register-push-token/", register_push_token, name="register_push_token"),
     path("unregister-push-token/", unregister_push_token, name="unregister_push_token"),
@@ -140,6 +110,7 @@ urlpatterns = [
     
     # Coupons
     path("coupons/", available_coupons, name="available_coupons"),
+    path("coupons/best/", best_coupons, name="best_coupons"),
     path("coupons/validate/", validate_coupon, name="validate_coupon"),
     path("coupons/apply/", apply_coupon, name="apply_coupon"),
     
@@ -6,8 +6,9 @@ from django.conf import settings
 from django.core.cache import cache
 from rest_framework_simplejwt.tokens import RefreshToken
 from decimal import Decimal
+from datetime import datetime, timedelta, timezone as dt_timezone
 from django.utils import timezone
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.db.models import Count, Prefetch
 import random
 import requests
@@ -31,6 +32,8 @@ from .models import (
     OrderItem,
     OrderReview,
     OrderItemReview,
+    RiderLocation,
+    RiderSyncEvent,
     Coupon,
     UserCouponUsage,
     PushToken,
@@ -38,6 +41,7 @@ from .models import (
     SupportTicket,
     SupportMessage,
 )
+from . import catalog, coupon_codes, coupons, customer_stats, dispatch, item_ratings, order_states, pagination, push, rider_location, trails
 
 PLATFORM_FEE = Decimal("5.00")
 
@@ -56,14 +60,41 @@ def _generate_login_otp():
     return str(random.randint(1000, 9999))
 
 
+FAST2SMS_URL = "https://www.fast2sms.com/dev/bulkV2"
+
+
 def _send_fast2sms_otp(mobile, otp):
+    params, error = _fast2sms_params(mobile, otp)
+    if params is None:
+        return error is None, error
+
+    try:
+        response = requests.get(
+            FAST2SMS_URL,
+            params=params,
+            timeout=10,
+        )
+        return _fast2sms_result(
+            response.status_code,
+            response.text or "",
+            response.json() if response.content else {},
+        )
+    except Exception as e:
+        return False, f"Fast2SMS error: {str(e)}"
+
+
+def _fast2sms_params(mobile, otp):
+    """
+    Query parameters for a Fast2SMS OTP request, as (params, error). Both are
+    None in development mode, where the OTP is only printed.
+    """
     # Development Mode: Skip SMS and print OTP to console
     dev_mode = getattr(settings, "OTP_DEV_MODE", False)
     if dev_mode:
         print(f"\n{'='*50}")
         print(f"📱 OTP for {mobile}: {otp}")
         print(f"{'='*50}\n")
-        return True, None
+        return None, None
     
     api_key = getattr(settings, "FAST2SMS_API_KEY", "")
     sender_id = getattr(settings, "FAST2SMS_SENDER_ID", "")
@@ -76,7 +107,7 @@ def _send_fast2sms_otp(mobile, otp):
     )
 
     if not api_key or not sender_id:
-        return False, "Fast2SMS is not configured"
+        return None, "Fast2SMS is not configured"
 
     params = {
         "route": route,
@@ -87,7 +118,7 @@ def _send_fast2sms_otp(mobile, otp):
 
     if str(route).lower() == "dlt":
         if not template_id:
-            return False, "Fast2SMS DLT template id is missing"
+            return None, "Fast2SMS DLT template id is missing"
         # For DLT route, send template_id as the 'message' parameter
         params["message"] = template_id
         params["variables_values"] = str(otp)
@@ -105,27 +136,21 @@ def _send_fast2sms_otp(mobile, otp):
     print(f"   Route: {route}")
     print(f"   Params: {params}\n")
 
-    try:
-        response = requests.get(
-            "https://www.fast2sms.com/dev/bulkV2",
-            params=params,
-            timeout=10,
-        )
-        raw_text = response.text or ""
-        data = response.json() if response.content else {}
+    return params, None
 
-        if response.status_code != 200:
-            print(f"Fast2SMS HTTP {response.status_code}: {raw_text}")
-            return False, data.get("message") or f"Fast2SMS error: {response.status_code}"
 
-        if data.get("return") is True or str(data.get("status")).lower() in {"success", "ok"}:
-            return True, None
+def _fast2sms_result(status_code, raw_text, data):
+    """Interpret a Fast2SMS response as (sent, error)."""
+    if status_code != 200:
+        print(f"Fast2SMS HTTP {status_code}: {raw_text}")
+        return False, data.get("message") or f"Fast2SMS error: {status_code}"
 
-        if raw_text:
-            print(f"Fast2SMS response: {raw_text}")
-        return False, data.get("message") or "Fast2SMS request failed"
-    except Exception as e:
-        return False, f"Fast2SMS error: {str(e)}"
+    if data.get("return") is True or str(data.get("status")).lower() in {"success", "ok"}:
+        return True, None
+
+    if raw_text:
+        print(f"Fast2SMS response: {raw_text}")
+    return False, data.get("message") or "Fast2SMS request failed"
 
 
 def _get_restaurant_coords():
@@ -146,17 +171,20 @@ def _geocode_address(full_address):
     try:
         url = f"https://maps.googleapis.com/maps/api/geocode/json?address={full_address}&key={google_api_key}"
         response = requests.get(url, timeout=5)
-        data = response.json()
-
-        if data.get("status") == "OK" and data.get("results"):
-            location = data["results"][0]["geometry"]["location"]
-            return Decimal(str(location["lat"])), Decimal(str(location["lng"]))
+        return _geocode_result(response.json())
     except Exception as e:
         print(f"Geocoding error: {e}")
 
     return None, None
 
 
+def _geocode_result(data):
+    if data.get("status") == "OK" and data.get("results"):
+        location = data["results"][0]["geometry"]["location"]
+        return Decimal(str(location["lat"])), Decimal(str(location["lng"]))
+    return None, None
+
+
 def _calculate_distance(lat1, lon1, lat2, lon2):
     """
     Calculate distance between two coordinates using Haversine formula.
@@ -374,31 +402,187 @@ def get_rider_orders(request):
     except Rider.DoesNotExist:
         return Response({"error": "Rider profile not found"}, status=404)
 
-    orders = (
+    page, error = pagination.paginate(
         Order.objects.filter(rider=rider)
         .select_related("user", "address")
-        .annotate(items_count=Count("items"))
-        .order_by("-created_at")
+        .annotate(items_count=Count("items")),
+        request,
     )
+    if error:
+        return Response({"error": error}, status=400)
 
     return Response({
-        "orders": [_serialize_order_for_rider(order) for order in orders]
+        "orders": [_serialize_order_for_rider(order) for order in page["items"]],
+        **pagination.page_fields(page),
     })
 
 
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def get_ready_for_pickup_orders(request):
-    orders = (
-        Order.objects.filter(status="ready_for_pickup", rider__isnull=True)
+    """Ready orders offered to this rider, plus any that have been broadcast to all riders."""
+    rider = getattr(request.user, 'rider_profile', None)
+    return Response({"orders": ready_orders_for_rider(rider)})
+
+
+def ready_orders_for_rider(rider, order_ids=None):
+    """Serialized ready orders visible to the rider under the current dispatch offers."""
+    orders = Order.objects.filter(status="ready_for_pickup", rider__isnull=True)
+    if order_ids is not None:
+        orders = orders.filter(id__in=order_ids)
+    orders = list(
+        orders.select_related("user", "address")
+        .annotate(items_count=Count("items"))
+        .order_by("created_at")
+    )
+    order_ids = [order.id for order in orders]
+    offers = dispatch.escalate_expired(dispatch.ensure_offers(order_ids, dispatch.get_offers(order_ids)))
+
+    payload = []
+    for order in orders:
+        offer = offers.get(order.id)
+        if not dispatch.is_visible_to(offer, rider.id if rider else None):
+            continue
+        data = _serialize_order_for_rider(order)
+        data["offer_expires_at"] = (
+            datetime.fromtimestamp(offer["expires_at"], tz=dt_timezone.utc).isoformat()
+            if offer and not offer["broadcast"]
+            else None
+        )
+        payload.append(data)
+    return payload
+
+
+def rider_assignments(rider, since=None):
+    """Serialized active orders assigned to the rider, optionally only those changed since a time."""
+    assignments = (
+        Order.objects.filter(rider=rider, status__in=RIDER_ACTIVE_STATUSES)
         .select_related("user", "address")
         .annotate(items_count=Count("items"))
         .order_by("created_at")
     )
+    if since:
+        assignments = assignments.filter(updated_at__gt=since)
+    return [_serialize_order_for_rider(order) for order in assignments]
 
-    return Response({
-        "orders": [_serialize_order_for_rider(order) for order in orders]
-    })
+
+def start_order_dispatch(order):
+    """Offer a delivery order that just became ready to the nearest idle riders."""
+    if order.delivery_otp is None:
+        # Self-pickup orders never need a rider.
+        return
+    restaurant_lat, restaurant_lng = _get_restaurant_coords()
+    try:
+        dispatch.offer_order(order.id, restaurant_lat, restaurant_lng)
+    except Exception as e:
+        print(f"Dispatch failed for order {order.id}: {e}")
+
+
+def after_status_change(order):
+    """Follow-up work for an order whose status was just changed by staff or its rider."""
+    rider_location.forget_order(order.id)
+    if order.status in ["delivered", "cancelled"] and order.rider_id:
+        transaction.on_commit(lambda: _close_delivery_trail(order.id))
+        transaction.on_commit(lambda: dispatch.release_rider(order.rider_id))
+    if order.status == "ready_for_pickup":
+        transaction.on_commit(lambda: start_order_dispatch(order))
+
+
+def _close_offer(order_id):
+    rider_location.forget_order(order_id)
+    dispatch.clear_offer(order_id)
+
+
+def _accept_order(rider, order_id):
+    """
+    Claim a ready order for the rider with a single conditional UPDATE; the
+    affected-row count decides who won. Returns (payload, error, http_status).
+    """
+    if not dispatch.is_visible_to(dispatch.get_offer(order_id), rider.id):
+        return None, "Order is currently offered to other riders", 409
+
+    try:
+        claimed = order_states.transition(
+            order_id,
+            'ready_for_pickup',
+            'on_the_way',
+            source='rider',
+            actor=rider.user,
+            filters={"rider__isnull": True},
+            rider=rider,
+            rider_name=rider.user.first_name,
+            rider_mobile=rider.mobile,
+        )
+    except (TypeError, ValueError):
+        claimed = False
+    if not claimed:
+        return None, "Order not available for pickup", 404
+
+    order_id = int(order_id)
+    transaction.on_commit(lambda: _close_offer(order_id))
+    transaction.on_commit(lambda: dispatch.rider_busy(rider.id))
+
+    return {
+        "message": "Order assigned to rider",
+        "order_id": order_id,
+        "status": 'on_the_way',
+        "rider_id": rider.id,
+    }, None, 200
+
+
+def _deliver_order(rider, order_id, otp):
+    """
+    Close a delivery. The order is read once to check the OTP and then moved
+    with a conditional UPDATE guarded by rider and its current status.
+    Returns (payload, error, http_status).
+    """
+    try:
+        order = Order.objects.filter(id=order_id, rider=rider).only("id", "status", "delivery_otp").first()
+    except (TypeError, ValueError):
+        order = None
+    if not order:
+        return None, "Order not found", 404
+    if str(order.delivery_otp) != str(otp):
+        return None, "Invalid OTP", 400
+    if order.status == 'cancelled':
+        return None, "Order was cancelled", 409
+
+    delivered = False
+    if order.status != 'delivered':
+        if not order_states.can_transition(order.status, 'delivered'):
+            return None, f"Order cannot be delivered while {order.status}", 409
+
+        # Keep the last known position on the order once live tracking ends.
+        updates = {}
+        position = rider_location.get_position(rider.id)
+        if position:
+            updates["rider_latitude"] = round(Decimal(str(position["latitude"])), 6)
+            updates["rider_longitude"] = round(Decimal(str(position["longitude"])), 6)
+            updates["rider_location_updated_at"] = datetime.fromisoformat(position["updated_at"])
+
+        delivered = order_states.transition(
+            order.id,
+            order.status,
+            'delivered',
+            source='rider',
+            actor=rider.user,
+            filters={"rider": rider},
+            **updates,
+        )
+        if not delivered:
+            return None, "Order status changed, please refresh and retry", 409
+    # Already delivered: report success so retries stay idempotent.
+
+    rider_location.forget_order(order.id)
+    if delivered:
+        transaction.on_commit(lambda: _close_delivery_trail(order.id))
+        transaction.on_commit(lambda: dispatch.release_rider(rider.id))
+
+    return {
+        "message": "Order delivered",
+        "order_id": order.id,
+        "status": 'delivered',
+    }, None, 200
 
 
 @api_view(["POST"])
@@ -411,11 +595,6 @@ def accept_order_for_pickup(request):
     if not order_id:
         return Response({"error": "order_id is required"}, status=400)
 
-    try:
-        order = Order.objects.get(id=order_id, status='ready_for_pickup', rider__isnull=True)
-    except Order.DoesNotExist:
-        return Response({"error": "Order not available for pickup"}, status=404)
-
     rider = getattr(request.user, 'rider_profile', None)
     if rider is None:
         if not mobile:
@@ -432,18 +611,10 @@ def accept_order_for_pickup(request):
             defaults={"user": user},
         )
 
-    order.rider = rider
-    order.status = 'on_the_way'
-    order.rider_name = rider.user.first_name if rider.user else order.rider_name
-    order.rider_mobile = rider.mobile
-    order.save(update_fields=['rider', 'status', 'rider_name', 'rider_mobile', 'updated_at'])
-
-    return Response({
-        "message": "Order assigned to rider",
-        "order_id": order.id,
-        "status": order.status,
-        "rider_id": rider.id,
-    })
+    payload, error, status = _accept_order(rider, order_id)
+    if error:
+        return Response({"error": error}, status=status)
+    return Response(payload)
 
 
 @api_view(["POST"])
@@ -463,22 +634,10 @@ def mark_order_delivered(request):
     except Rider.DoesNotExist:
         return Response({"error": "Rider profile not found"}, status=404)
 
-    try:
-        order = Order.objects.get(id=order_id, rider=rider)
-    except Order.DoesNotExist:
-        return Response({"error": "Order not found"}, status=404)
-
-    if str(order.delivery_otp) != str(otp):
-        return Response({"error": "Invalid OTP"}, status=400)
-
-    order.status = 'delivered'
-    order.save(update_fields=['status', 'updated_at'])
-
-    return Response({
-        "message": "Order delivered",
-        "order_id": order.id,
-        "status": order.status,
-    })
+    payload, error, status = _deliver_order(rider, order_id, otp)
+    if error:
+        return Response({"error": error}, status=status)
+    return Response(payload)
 
 
 @api_view(["POST"])
@@ -495,12 +654,36 @@ def update_order_status(request):
         return Response({"error": "Invalid status"}, status=400)
 
     try:
-        order = Order.objects.get(id=order_id)
-    except Order.DoesNotExist:
+        order = Order.objects.only("id", "status", "rider_id", "delivery_otp").get(id=order_id)
+    except (Order.DoesNotExist, ValueError):
         return Response({"error": "Order not found"}, status=404)
 
+    # Staff may make any allowed transition; the assigned rider only the
+    # in-delivery ones.
+    if request.user.is_staff:
+        source = "staff"
+    else:
+        rider = getattr(request.user, 'rider_profile', None)
+        if rider is None or order.rider_id != rider.id or status not in order_states.RIDER_STATUSES:
+            return Response({"error": "Not allowed to set this status"}, status=403)
+        source = "rider"
+
+    if order.status == status:
+        return Response({
+            "message": "Order status updated",
+            "order_id": order.id,
+            "status": order.status,
+        })
+
+    try:
+        updated = order_states.transition(order.id, order.status, status, source=source, actor=request.user)
+    except order_states.InvalidTransition as e:
+        return Response({"error": str(e)}, status=409)
+    if not updated:
+        return Response({"error": "Order status changed, please refresh and retry"}, status=409)
+
     order.status = status
-    order.save(update_fields=["status", "updated_at"])
+    after_status_change(order)
 
     return Response({
         "message": "Order status updated",
@@ -521,49 +704,43 @@ def update_rider_location(request):
     if not order_id or latitude is None or longitude is None:
         return Response({"error": "order_id, latitude and longitude are required"}, status=400)
 
+    latitude, longitude = rider_location.parse_coordinates(latitude, longitude)
+    if latitude is None:
+        return Response({"error": "Invalid latitude or longitude"}, status=400)
+
     try:
         rider = request.user.rider_profile
     except Rider.DoesNotExist:
         return Response({"error": "Rider profile not found"}, status=404)
 
-    try:
-        order = Order.objects.get(id=order_id, rider=rider)
-    except Order.DoesNotExist:
+    order = rider_location.get_tracked_order(order_id, rider_id=rider.id)
+    if order is None:
         return Response({"error": "Order not found"}, status=404)
 
-    order.rider_latitude = latitude
-    order.rider_longitude = longitude
-    order.rider_location_updated_at = timezone.now()
-    if rider_name:
-        order.rider_name = rider_name
-    if rider_mobile:
-        order.rider_mobile = rider_mobile
-
-    if order.status not in ["delivered", "cancelled"]:
-        order.status = "on_the_way"
-
-    order.save(update_fields=[
-        "rider_latitude",
-        "rider_longitude",
-        "rider_location_updated_at",
-        "rider_name",
-        "rider_mobile",
-        "status",
-        "updated_at",
-    ])
+    # Rider details rarely change; only touch the order row when they do.
+    details = {}
+    if rider_name and rider_name != order["rider_name"]:
+        details["rider_name"] = rider_name
+    if rider_mobile and rider_mobile != order["rider_mobile"]:
+        details["rider_mobile"] = rider_mobile
+    if details:
+        Order.objects.filter(id=order["id"]).update(**details)
+        rider_location.forget_order(order["id"])
+        order = {**order, **details}
+
+    order = _mark_order_on_the_way(order, actor=request.user)
+    position = rider_location.record_position(rider.id, order["id"], latitude, longitude)
 
     return Response({
         "message": "Rider location updated",
-        "order_id": order.id,
-        "status": order.status,
-        "delivery_otp": order.delivery_otp,
-        "rider_name": order.rider_name,
-        "rider_mobile": order.rider_mobile,
-        "rider_latitude": float(order.rider_latitude) if order.rider_latitude else None,
-        "rider_longitude": float(order.rider_longitude) if order.rider_longitude else None,
-        "rider_location_updated_at": order.rider_location_updated_at.isoformat()
-        if order.rider_location_updated_at
-        else None,
+        "order_id": order["id"],
+        "status": order["status"],
+        "delivery_otp": order["delivery_otp"],
+        "rider_name": order["rider_name"],
+        "rider_mobile": order["rider_mobile"],
+        "rider_latitude": position["latitude"],
+        "rider_longitude": position["longitude"],
+        "rider_location_updated_at": position["updated_at"],
     })
 
 
@@ -583,43 +760,282 @@ def update_rider_location_simple(request):
             "error": "order_id, rider_mobile, latitude and longitude are required"
         }, status=400)
 
-    try:
-        order = Order.objects.get(id=order_id, rider_mobile=rider_mobile)
-    except Order.DoesNotExist:
+    latitude, longitude = rider_location.parse_coordinates(latitude, longitude)
+    if latitude is None:
+        return Response({"error": "Invalid latitude or longitude"}, status=400)
+
+    order = rider_location.get_tracked_order(order_id, rider_mobile=rider_mobile)
+    if order is None or order["rider_id"] is None:
         return Response({
             "error": "Order not found or rider mobile does not match"
         }, status=404)
 
-    # Update rider location
-    order.rider_latitude = latitude
-    order.rider_longitude = longitude
-    order.rider_location_updated_at = timezone.now()
-    
-    if order.status not in ["delivered", "cancelled"]:
-        order.status = "on_the_way"
-
-    order.save(update_fields=[
-        "rider_latitude",
-        "rider_longitude",
-        "rider_location_updated_at",
-        "status",
-        "updated_at",
-    ])
+    order = _mark_order_on_the_way(order)
+    position = rider_location.record_position(order["rider_id"], order["id"], latitude, longitude)
 
     return Response({
         "success": True,
         "message": "Rider location updated successfully",
-        "order_id": order.id,
-        "status": order.status,
-        "rider_latitude": float(order.rider_latitude),
-        "rider_longitude": float(order.rider_longitude),
-        "rider_location_updated_at": order.rider_location_updated_at.isoformat(),
+        "order_id": order["id"],
+        "status": order["status"],
+        "rider_latitude": position["latitude"],
+        "rider_longitude": position["longitude"],
+        "rider_location_updated_at": position["updated_at"],
     })
 
 
+def _mark_order_on_the_way(order, actor=None):
+    """
+    A location ping on an assigned order that is still ready for pickup means
+    the rider has set off. Other statuses are left alone: the delivery
+    sub-states are set by the rider explicitly, and a ping must not undo them.
+    """
+    if order["status"] != "ready_for_pickup":
+        return order
+
+    moved = order_states.transition(order["id"], order["status"], "on_the_way", source="rider", actor=actor)
+    rider_location.forget_order(order["id"])
+    if not moved:
+        return rider_location.get_tracked_order(order["id"]) or order
+    return {**order, "status": "on_the_way"}
+
+
+RIDER_SYNC_MAX_FIXES = 500
+RIDER_SYNC_MAX_EVENTS = 50
+
+RIDER_ACTIVE_STATUSES = [
+    'on_the_way',
+    'delivery_pending',
+    'delivery_failed',
+    'delivery_rescheduled',
+]
+
+
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def rider_sync(request):
+    """
+    Apply a rider app's offline buffer in a single round trip.
+
+    Body:
+        fixes: [{order_id, latitude, longitude, recorded_at}]
+        events: [{event_id, type: "accept" | "deliver", order_id, otp}]
+        last_sync: server_time from the previous sync (optional)
+
+    Events run in the order given. Final outcomes are stored per event_id and
+    replayed for retries; a conflict the order may still resolve (an offer
+    held for other riders, an order not yet deliverable) is reported with
+    "retryable": true and not stored, so the same event can succeed later.
+    Fixes are applied in recorded_at order: they go into the history table
+    and move a claimed order on its way, the same as live pings, and only the
+    newest becomes the live position. The response carries the rider's
+    assignments changed since last_sync.
+    """
+    try:
+        rider = request.user.rider_profile
+    except Rider.DoesNotExist:
+        return Response({"error": "Rider profile not found"}, status=404)
+
+    fixes = request.data.get("fixes") or []
+    events = request.data.get("events") or []
+    if not isinstance(fixes, list) or not isinstance(events, list):
+        return Response({"error": "fixes and events must be lists"}, status=400)
+    if len(fixes) > RIDER_SYNC_MAX_FIXES or len(events) > RIDER_SYNC_MAX_EVENTS:
+        return Response({
+            "error": f"At most {RIDER_SYNC_MAX_FIXES} fixes and {RIDER_SYNC_MAX_EVENTS} events per sync"
+        }, status=400)
+
+    last_sync = None
+    if request.data.get("last_sync"):
+        last_sync = rider_location.parse_timestamp(request.data.get("last_sync"))
+        if last_sync is None:
+            return Response({"error": "Invalid last_sync"}, status=400)
+
+    server_time = timezone.now()
+    with transaction.atomic():
+        event_results = _apply_rider_sync_events(rider, events)
+        fixes_accepted = _apply_rider_sync_fixes(rider, fixes, server_time)
+
+    return Response({
+        "events": event_results,
+        "fixes_accepted": fixes_accepted,
+        "fixes_rejected": len(fixes) - fixes_accepted,
+        "assignments": rider_assignments(rider, since=last_sync),
+        "server_time": server_time.isoformat(),
+    })
+
+
+def _apply_rider_sync_events(rider, events):
+    event_ids = [str(event.get("event_id") or "").strip() for event in events if isinstance(event, dict)]
+    seen = dict(
+        RiderSyncEvent.objects.filter(rider=rider, event_id__in=event_ids)
+        .values_list("event_id", "result")
+    )
+
+    results = []
+    for event in events:
+        if not isinstance(event, dict):
+            results.append({"success": False, "error": "Invalid event"})
+            continue
+
+        event_id = str(event.get("event_id") or "").strip()
+        event_type = event.get("type")
+        if not event_id or len(event_id) > 64:
+            results.append({"event_id": event_id, "success": False, "error": "event_id is required"})
+            continue
+        if event_id in seen:
+            results.append(seen[event_id])
+            continue
+        if event_type not in {"accept", "deliver"}:
+            results.append({"event_id": event_id, "success": False, "error": "Unknown event type"})
+            continue
+
+        if event_type == "accept":
+            payload, error, http_status = _accept_order(rider, event.get("order_id"))
+        else:
+            payload, error, http_status = _deliver_order(rider, event.get("order_id"), event.get("otp"))
+
+        result = {"event_id": event_id, "type": event_type, "success": error is None}
+        result.update(payload or {"error": error})
+        if not _is_final_sync_outcome(rider, event.get("order_id"), http_status):
+            result["retryable"] = True
+            results.append(result)
+            continue
+
+        try:
+            with transaction.atomic():
+                RiderSyncEvent.objects.create(
+                    rider=rider,
+                    event_id=event_id,
+                    event_type=event_type,
+                    order_id=payload["order_id"] if payload else None,
+                    result=result,
+                    recorded_at=rider_location.parse_timestamp(event.get("recorded_at")),
+                )
+        except IntegrityError:
+            # A concurrent sync already recorded this event; report its outcome.
+            result = RiderSyncEvent.objects.get(rider=rider, event_id=event_id).result
+
+        seen[event_id] = result
+        results.append(result)
+
+    return results
+
+
+def _is_final_sync_outcome(rider, order_id, http_status):
+    """
+    Whether a sync event's outcome may be stored for replays: successes and
+    rejected input always, conflicts only once the order can no longer
+    change the answer (gone, closed, or taken by another rider).
+    """
+    if http_status in (200, 400):
+        return True
+    try:
+        order = Order.objects.filter(id=order_id).values("status", "rider_id").first()
+    except (TypeError, ValueError):
+        return True
+    return (
+        order is None
+        or order["status"] in order_states.TERMINAL_STATUSES
+        or order["rider_id"] not in (None, rider.id)
+    )
+
+
+def _apply_rider_sync_fixes(rider, fixes, server_time):
+    """Bulk insert buffered fixes and promote the newest one. Returns the accepted count."""
+    max_skew = timedelta(minutes=5)
+    parsed = []
+    for fix in fixes:
+        if not isinstance(fix, dict):
+            continue
+        latitude, longitude = rider_location.parse_coordinates(fix.get("latitude"), fix.get("longitude"))
+        recorded_at = rider_location.parse_timestamp(fix.get("recorded_at"))
+        try:
+            order_id = int(fix.get("order_id"))
+        except (TypeError, ValueError):
+            continue
+        if latitude is None or recorded_at is None or recorded_at > server_time + max_skew:
+            continue
+        parsed.append((recorded_at, order_id, latitude, longitude))
+
+    owned = {
+        order["id"]: order
+        for order in Order.objects.filter(id__in={order_id for _, order_id, _, _ in parsed}, rider=rider)
+        .values("id", "status")
+    }
+    parsed = sorted(fix for fix in parsed if fix[1] in owned)
+    if not parsed:
+        return 0
+
+    for order_id in {order_id for _, order_id, _, _ in parsed}:
+        _mark_order_on_the_way(owned[order_id], actor=rider.user)
+
+    kept = rider_location.coalesce_fixes(parsed)
+    rider_location.write_history([
+        RiderLocation(
+            rider=rider,
+            order_id=order_id,
+            latitude=round(latitude, 6),
+            longitude=round(longitude, 6),
+            recorded_at=recorded_at,
+        )
+        for recorded_at, order_id, latitude, longitude in kept
+    ])
+
+    recorded_at, order_id, latitude, longitude = parsed[-1]
+    rider_location.store_latest(
+        rider.id, order_id, latitude, longitude, recorded_at, persisted=kept[-1] is parsed[-1]
+    )
+    return len(parsed)
+
+
+def _close_delivery_trail(order_id):
+    try:
+        trails.close_trail(order_id)
+    except Exception as e:
+        print(f"Could not close delivery trail for order {order_id}: {e}")
+
+
+def _rider_position_payload(order, positions):
+    """
+    Rider position for an order, read from the location store while the order
+    is live and from the snapshot kept on the order once it has closed.
+    """
+    position = positions.get(order.rider_id) if order.status in rider_location.LIVE_STATUSES else None
+    # A rider's latest fix may have been reported for another of their orders.
+    if position and str(position.get("order_id")) != str(order.id):
+        position = None
+    if position:
+        return {
+            "rider_latitude": position["latitude"],
+            "rider_longitude": position["longitude"],
+            "rider_location_updated_at": position["updated_at"],
+        }
+    return {
+        "rider_latitude": float(order.rider_latitude) if order.rider_latitude else None,
+        "rider_longitude": float(order.rider_longitude) if order.rider_longitude else None,
+        "rider_location_updated_at": order.rider_location_updated_at.isoformat()
+        if order.rider_location_updated_at
+        else None,
+    }
+
+
+RATING_FIELDS = ("rating_count", "average_rating", "recent_rating_count", "recent_average_rating")
+
+
+def _rating_payload(item):
+    """An item's rating aggregates (see item_ratings.py), as stored on the item."""
+    return {
+        "count": item.rating_count,
+        "average": float(item.average_rating) if item.average_rating is not None else None,
+        "recent_count": item.recent_rating_count,
+        "recent_average": float(item.recent_average_rating) if item.recent_average_rating is not None else None,
+    }
+
+
 @api_view(["GET"])
 def home_data(request):
-    cache_key = "api:home_data:v2"
+    cache_key = catalog.cache_key("api:home_data:v3")
     cached = cache.get(cache_key)
     if cached is not None:
         return Response(cached)
@@ -651,6 +1067,7 @@ def home_data(request):
             "is_combo",
             "gst_rate",
             "image",
+            *RATING_FIELDS,
             "category__id",
             "category__name",
             "category__gst_rate",
@@ -691,6 +1108,7 @@ def home_data(request):
                 "category_name": i.category.name,
                 "gst_rate": float(i.gst_rate if i.gst_rate is not None else i.category.gst_rate),
                 "image": f"{media_base}{i.image.name}" if i.image else None,
+                "rating": _rating_payload(i),
                 "combo_items": [
                     {
                         "item_id": ci.item.id,
@@ -710,7 +1128,7 @@ def home_data(request):
 
 @api_view(["GET"])
 def get_combos(request):
-    cache_key = "api:combos:v1"
+    cache_key = catalog.cache_key("api:combos:v2")
     cached = cache.get(cache_key)
     if cached is not None:
         return Response(cached)
@@ -737,6 +1155,7 @@ def get_combos(request):
             "description",
             "gst_rate",
             "image",
+            *RATING_FIELDS,
             "category__id",
             "category__name",
             "category__gst_rate",
@@ -754,6 +1173,7 @@ def get_combos(request):
                 "category_name": combo.category.name,
                 "gst_rate": float(combo.gst_rate if combo.gst_rate is not None else combo.category.gst_rate),
                 "image": f"{media_base}{combo.image.name}" if combo.image else None,
+                "rating": _rating_payload(combo),
                 "combo_items": [
                     {
                         "item_id": ci.item.id,
@@ -771,14 +1191,11 @@ def get_combos(request):
     return Response(payload)
 
 
-@api_view(["GET"])
-@permission_classes([IsAuthenticated])
-def get_cart(request):
-    try:
-        cart = request.user.cart
-    except Cart.DoesNotExist:
-        cart = Cart.objects.create(user=request.user)
-
+def _cart_lines(cart):
+    """
+    ``(cart_item, effective_price, subtotal, gst_rate, tax)`` for every item
+    in the cart, priced from one query plus one for combo components.
+    """
     combo_links_prefetch = Prefetch(
         "item__combo_links",
         queryset=ComboItem.objects.select_related("item").only(
@@ -790,14 +1207,8 @@ def get_cart(request):
         ),
         to_attr="prefetched_combo_links",
     )
-    cart_items = list(
-        cart.items.select_related("item__category").prefetch_related(combo_links_prefetch)
-    )
-
-    items_payload = []
-    subtotal = Decimal("0.00")
-    total_tax = Decimal("0.00")
-    for ci in cart_items:
+    lines = []
+    for ci in cart.items.select_related("item__category").prefetch_related(combo_links_prefetch):
         item = ci.item
         combo_links = getattr(item, "prefetched_combo_links", [])
         effective_price = (
@@ -808,6 +1219,26 @@ def get_cart(request):
         item_subtotal = effective_price * ci.quantity
         gst_rate = item.gst_rate if item.gst_rate is not None else item.category.gst_rate
         item_tax = item_subtotal * (gst_rate / Decimal("100"))
+        lines.append((ci, effective_price, item_subtotal, gst_rate, item_tax))
+    return lines
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def get_cart(request):
+    try:
+        cart = request.user.cart
+    except Cart.DoesNotExist:
+        cart = Cart.objects.create(user=request.user)
+
+    cart_items = _cart_lines(cart)
+
+    items_payload = []
+    subtotal = Decimal("0.00")
+    total_tax = Decimal("0.00")
+    for ci, effective_price, item_subtotal, gst_rate, item_tax in cart_items:
+        item = ci.item
+        combo_links = getattr(item, "prefetched_combo_links", [])
         item_total = item_subtotal + item_tax
 
         subtotal += item_subtotal
@@ -937,57 +1368,59 @@ def get_addresses(request):
 
     address_list = []
     for addr in addresses:
-        # Calculate distance for each address
-        distance = None
-        delivery_available = False
-        delivery_charge = Decimal("0.00")
-        
-        # Get or geocode coordinates
-        addr_lat = addr.latitude
-        addr_lng = addr.longitude
-        
-        if not addr_lat or not addr_lng:
+        if not addr.latitude or not addr.longitude:
             # Try to geocode the address
             addr_lat, addr_lng = _geocode_address(addr.full_address)
             if addr_lat and addr_lng:
                 # Save the geocoded coordinates
                 addr.latitude = addr_lat
-                addr.longitude = addr_lng
-                addr.save(update_fields=["latitude", "longitude"])
-        
-        if addr_lat and addr_lng:
-            try:
-                distance = _calculate_distance(
-                    restaurant_lat, restaurant_lng,
-                    float(addr_lat), float(addr_lng)
-                )
-                if distance:
-                    delivery_available = distance <= 5  # Within 5 km radius
-                    delivery_charge = _calculate_delivery_charge(distance)
-            except Exception as e:
-                print(f"Distance calculation error: {e}")
-                distance = None
-        
-        address_list.append({
-            "id": addr.id,
-            "type": addr.address_type,
-            "full_address": addr.full_address,
-            "city": addr.city,
-            "postal_code": addr.postal_code,
-            "latitude": float(addr_lat) if addr_lat else None,
-            "longitude": float(addr_lng) if addr_lng else None,
-            "is_default": addr.is_default,
-            "display": f"{addr.address_type.capitalize()} | {addr.city}",
-            "distance_km": round(distance, 2) if distance else None,
-            "delivery_available": delivery_available,
-            "delivery_charge": float(delivery_charge),
-        })
+                addr.longitude = addr_lng
+                addr.save(update_fields=["latitude", "longitude"])
+
+        address_list.append(_address_payload(addr, restaurant_lat, restaurant_lng))
 
     return Response({
         "addresses": address_list
     })
 
 
+def _address_payload(addr, restaurant_lat, restaurant_lng):
+    """Address with its distance and delivery charge from the restaurant."""
+    distance = None
+    delivery_available = False
+    delivery_charge = Decimal("0.00")
+
+    addr_lat = addr.latitude
+    addr_lng = addr.longitude
+    if addr_lat and addr_lng:
+        try:
+            distance = _calculate_distance(
+                restaurant_lat, restaurant_lng,
+                float(addr_lat), float(addr_lng)
+            )
+            if distance:
+                delivery_available = distance <= 5  # Within 5 km radius
+                delivery_charge = _calculate_delivery_charge(distance)
+        except Exception as e:
+            print(f"Distance calculation error: {e}")
+            distance = None
+
+    return {
+        "id": addr.id,
+        "type": addr.address_type,
+        "full_address": addr.full_address,
+        "city": addr.city,
+        "postal_code": addr.postal_code,
+        "latitude": float(addr_lat) if addr_lat else None,
+        "longitude": float(addr_lng) if addr_lng else None,
+        "is_default": addr.is_default,
+        "display": f"{addr.address_type.capitalize()} | {addr.city}",
+        "distance_km": round(distance, 2) if distance else None,
+        "delivery_available": delivery_available,
+        "delivery_charge": float(delivery_charge),
+    }
+
+
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
 def create_address(request):
@@ -1043,6 +1476,7 @@ def checkout(request):
     address_id = request.data.get("address_id")
     delivery_method = request.data.get("delivery_method", "delivery")
     coupon_id = request.data.get("coupon_id")
+    personal_code = request.data.get("coupon_code")
     selected_item_id = request.data.get("selected_item_id")
 
     try:
@@ -1101,11 +1535,20 @@ def checkout(request):
     
     # Handle coupon discount
     coupon = None
+    coupon_code = None
     coupon_discount = Decimal("0.00")
     
-    if coupon_id:
+    if coupon_id or personal_code:
         try:
-            coupon = Coupon.objects.get(id=coupon_id)
+            if personal_code:
+                coupon_code, code_error = coupon_codes.lookup(personal_code)
+                if code_error:
+                    return Response({"error": code_error}, status=400)
+                coupon = coupon_code.coupon
+            else:
+                coupon = Coupon.objects.get(id=coupon_id)
+                if coupon.unique_codes:
+                    return Response({"error": "This offer needs a personal coupon code"}, status=400)
             
             # Validate coupon
             is_valid, message = coupon.is_valid()
@@ -1144,10 +1587,6 @@ def checkout(request):
                     except Item.DoesNotExist:
                         return Response({"error": "Invalid free item selection"}, status=400)
             
-            # Increment coupon usage
-            coupon.used_count += 1
-            coupon.save(update_fields=['used_count'])
-            
         except Coupon.DoesNotExist:
             return Response({"error": "Invalid coupon"}, status=404)
     
@@ -1160,61 +1599,82 @@ def checkout(request):
     # Capture all cart items before creating order
     cart_items_list = list(cart.items.all().select_related('item__category'))
 
-    order = Order.objects.create(
-        user=request.user,
-        address=address,
-        subtotal=subtotal,
-        tax=total_tax,
-        platform_fee=PLATFORM_FEE,
-        delivery_charge=delivery_charge,
-        coupon=coupon,
-        coupon_discount=coupon_discount,
-        total_price=total_price,
-        status='pickup_pending' if delivery_method == "pickup" else 'confirmed',
-        delivery_otp=_generate_delivery_otp() if delivery_method == "delivery" else None,
-    )
+    # The coupon is only spent if the order is created with it.
+    with transaction.atomic():
+        if coupon:
+            # Lock the customer so parallel checkouts see each other's coupon use.
+            User.objects.select_for_update().filter(pk=request.user.pk).values_list("pk").get()
+            can_use, eligibility_msg = coupon.can_be_used_by_user(request.user)
+            if not can_use:
+                return Response({"error": eligibility_msg}, status=400)
 
-    # Add all cart items to the order
-    for cart_item in cart_items_list:
-        OrderItem.objects.create(
-            order=order,
-            item=cart_item.item,
-            quantity=cart_item.quantity,
-            price_at_order=cart_item.item.get_effective_price(),
-            tax_at_order=cart_item.get_tax(),
+            # Claim the personal code, or count the use on the shared coupon
+            if coupon_code:
+                if not coupon_codes.redeem(coupon_code, request.user):
+                    return Response({"error": "This code has already been used"}, status=400)
+            elif not Coupon.objects.filter(
+                models.Q(max_uses__isnull=True) | models.Q(used_count__lt=models.F('max_uses')),
+                pk=coupon.pk,
+            ).update(used_count=models.F('used_count') + 1):
+                return Response({"error": "Coupon error: Coupon usage limit reached"}, status=400)
+
+        order = Order.objects.create(
+            user=request.user,
+            address=address,
+            subtotal=subtotal,
+            tax=total_tax,
+            platform_fee=PLATFORM_FEE,
+            delivery_charge=delivery_charge,
+            coupon=coupon,
+            coupon_discount=coupon_discount,
+            total_price=total_price,
+            status='pickup_pending' if delivery_method == "pickup" else 'confirmed',
+            delivery_otp=_generate_delivery_otp() if delivery_method == "delivery" else None,
         )
-    
-    # Add free item from coupon to order (so admin can see and pack it)
-    if coupon and coupon.discount_type == 'free_item':
-        free_item = None
-        if coupon.free_item:
-            free_item = coupon.free_item
-        elif coupon.free_item_category and selected_item_id:
-            try:
-                free_item = Item.objects.get(id=selected_item_id)
-            except Item.DoesNotExist:
-                pass
-        
-        if free_item:
-            # Add the free item to the order with price 0
+        order_states.record_created(order, actor=request.user)
+
+        # Add all cart items to the order
+        for cart_item in cart_items_list:
             OrderItem.objects.create(
                 order=order,
-                item=free_item,
-                quantity=1,
-                price_at_order=Decimal('0.00'),  # Free item, no charge
-                tax_at_order=Decimal('0.00'),  # No tax on free item
+                item=cart_item.item,
+                quantity=cart_item.quantity,
+                price_at_order=cart_item.item.get_effective_price(),
+                tax_at_order=cart_item.get_tax(),
             )
-    
-    # Record coupon usage
-    if coupon:
-        UserCouponUsage.objects.create(
-            user=request.user,
-            coupon=coupon,
-            order=order,
-            discount_amount=coupon_discount
-        )
 
-    cart.items.all().delete()
+        # Add free item from coupon to order (so admin can see and pack it)
+        if coupon and coupon.discount_type == 'free_item':
+            free_item = None
+            if coupon.free_item:
+                free_item = coupon.free_item
+            elif coupon.free_item_category and selected_item_id:
+                try:
+                    free_item = Item.objects.get(id=selected_item_id)
+                except Item.DoesNotExist:
+                    pass
+
+            if free_item:
+                # Add the free item to the order with price 0
+                OrderItem.objects.create(
+                    order=order,
+                    item=free_item,
+                    quantity=1,
+                    price_at_order=Decimal('0.00'),  # Free item, no charge
+                    tax_at_order=Decimal('0.00'),  # No tax on free item
+                )
+
+        # Record coupon usage
+        if coupon:
+            UserCouponUsage.objects.create(
+                user=request.user,
+                coupon=coupon,
+                coupon_code=coupon_code,
+                order=order,
+                discount_amount=coupon_discount
+            )
+
+        cart.items.all().delete()
 
     return Response({
         "order_id": order.id,
@@ -1233,11 +1693,17 @@ def checkout(request):
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
 def get_orders(request):
-    orders = (
+    page, error = pagination.paginate(
         request.user.orders.select_related("address")
         .prefetch_related("items__item", "review")
-        .annotate(items_count=Count("items"))
-        .order_by("-created_at")
+        .annotate(items_count=Count("items")),
+        request,
+    )
+    if error:
+        return Response({"error": error}, status=400)
+    orders = page["items"]
+    positions = rider_location.get_positions(
+        order.rider_id for order in orders if order.status in rider_location.LIVE_STATUSES
     )
 
     return Response({
@@ -1253,11 +1719,7 @@ def get_orders(request):
                 "delivery_otp": order.delivery_otp,
                 "rider_name": order.rider_name,
                 "rider_mobile": order.rider_mobile,
-                "rider_latitude": float(order.rider_latitude) if order.rider_latitude else None,
-                "rider_longitude": float(order.rider_longitude) if order.rider_longitude else None,
-                "rider_location_updated_at": order.rider_location_updated_at.isoformat()
-                if order.rider_location_updated_at
-                else None,
+                **_rider_position_payload(order, positions),
                 "created_at": order.created_at.isoformat(),
                 "items_count": order.items_count,
                 "delivery_address": order.address.full_address if order.address else "N/A",
@@ -1271,7 +1733,8 @@ def get_orders(request):
                 ],
             }
             for order in orders
-        ]
+        ],
+        **pagination.page_fields(page),
     })
 
 
@@ -1320,11 +1783,7 @@ def get_order_detail(request, order_id):
         "delivery_otp": order.delivery_otp,
         "rider_name": order.rider_name,
         "rider_mobile": order.rider_mobile,
-        "rider_latitude": float(order.rider_latitude) if order.rider_latitude else None,
-        "rider_longitude": float(order.rider_longitude) if order.rider_longitude else None,
-        "rider_location_updated_at": order.rider_location_updated_at.isoformat()
-        if order.rider_location_updated_at
-        else None,
+        **_rider_position_payload(order, {order.rider_id: rider_location.get_position(order.rider_id)}),
         "restaurant_latitude": restaurant_lat,
         "restaurant_longitude": restaurant_lng,
         "delivery_latitude": delivery_lat,
@@ -1352,6 +1811,16 @@ def get_order_detail(request, order_id):
     })
 
 
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def get_order_trail(request, order_id):
+    """Replay the rider's route for one of the customer's orders as an encoded polyline."""
+    order = Order.objects.filter(id=order_id, user=request.user).first()
+    if not order:
+        return Response({"error": "Order not found"}, status=404)
+    return Response(trails.trail_payload(order))
+
+
 def _serialize_order_review(review):
     return {
         "id": review.id,
@@ -1397,7 +1866,7 @@ def order_review(request, order_id):
     delivery_rating = request.data.get("delivery_rating")
     overall_rating = request.data.get("overall_rating")
     comment = request.data.get("comment", "")
-    item_ratings = request.data.get("item_ratings", [])
+    submitted_ratings = request.data.get("item_ratings", [])
 
     try:
         delivery_rating = int(delivery_rating)
@@ -1415,48 +1884,54 @@ def order_review(request, order_id):
         if overall_rating is not None and (overall_rating < 1 or overall_rating > 5):
             return Response({"error": "overall_rating must be between 1 and 5"}, status=400)
 
-    review, _ = OrderReview.objects.update_or_create(
-        order=order,
-        defaults={
-            "user": request.user,
-            "delivery_rating": delivery_rating,
-            "overall_rating": overall_rating,
-            "comment": comment,
-        },
-    )
-
-    review.item_reviews.all().delete()
-    valid_ratings = []
-
-    for item_rating in item_ratings:
-        order_item_id = item_rating.get("order_item_id")
-        rating_value = item_rating.get("rating")
+    ratings = []
+    for item_rating in submitted_ratings:
         try:
-            rating_value = int(rating_value)
-        except (TypeError, ValueError):
-            continue
-        if rating_value < 1 or rating_value > 5:
+            order_item_id = int(item_rating.get("order_item_id"))
+            rating_value = int(item_rating.get("rating"))
+        except (AttributeError, TypeError, ValueError):
             continue
+        if 1 <= rating_value <= 5:
+            ratings.append((order_item_id, rating_value))
+    order_items = order.items.select_related("item").only("id", "item", "item__name").in_bulk(
+        {order_item_id for order_item_id, _ in ratings}
+    )
+    ratings = [(order_items[order_item_id], rating_value) for order_item_id, rating_value in ratings
+               if order_item_id in order_items]
 
-        try:
-            order_item = OrderItem.objects.get(id=order_item_id, order=order)
-        except OrderItem.DoesNotExist:
-            continue
+    with transaction.atomic():
+        review, _ = OrderReview.objects.update_or_create(
+            order=order,
+            defaults={
+                "user": request.user,
+                "delivery_rating": delivery_rating,
+                "overall_rating": overall_rating,
+                "comment": comment,
+            },
+        )
 
-        item_name = order_item.item.name if order_item.item else "Deleted Item"
-        OrderItemReview.objects.create(
-            review=review,
-            order_item=order_item,
-            item_name=item_name,
-            rating=rating_value,
+        previous = review.item_reviews.all()
+        removed = item_ratings.ratings_of(previous)
+        previous.delete()
+        OrderItemReview.objects.bulk_create([
+            OrderItemReview(
+                review=review,
+                order_item=order_item,
+                item_id=order_item.item_id,
+                item_name=order_item.item.name if order_item.item else "Deleted Item",
+                rating=rating_value,
+            )
+            for order_item, rating_value in ratings
+        ])
+        item_ratings.apply_on_commit(
+            [(order_item.item_id, rating_value) for order_item, rating_value in ratings], removed
         )
-        valid_ratings.append(rating_value)
 
-    if overall_rating is None and valid_ratings:
-        average_rating = round(sum(valid_ratings) / len(valid_ratings))
-        review.overall_rating = average_rating
-        review.save(update_fields=["overall_rating", "updated_at"])
+        if overall_rating is None and ratings:
+            review.overall_rating = round(sum(rating_value for _, rating_value in ratings) / len(ratings))
+            review.save(update_fields=["overall_rating", "updated_at"])
 
+    customer_stats.reviews_changed_on_commit(request.user.id)
     return Response({"review": _serialize_order_review(review)})
 
 @api_view(["GET"])
@@ -1482,6 +1957,8 @@ def get_active_order(request):
     if not order:
         return Response({"active_order": None})
 
+    position = _rider_position_payload(order, {order.rider_id: rider_location.get_position(order.rider_id)})
+
     return Response({
         "active_order": {
             "id": order.id,
@@ -1493,8 +1970,8 @@ def get_active_order(request):
             "delivery_otp": order.delivery_otp,
             "delivery_address": order.address.full_address if order.address else None,
             "items_count": order.items_count,
-            "rider_latitude": float(order.rider_latitude) if order.rider_latitude else None,
-            "rider_longitude": float(order.rider_longitude) if order.rider_longitude else None,
+            "rider_latitude": position["rider_latitude"],
+            "rider_longitude": position["rider_longitude"],
         }
     })
 
@@ -1561,80 +2038,12 @@ def verify_razorpay_payment(request):
         client.utility.verify_payment_signature(params_dict)
         
         # Signature is valid, process the order
-        try:
-            cart = request.user.cart
-        except Cart.DoesNotExist:
-            return Response({"error": "Cart not found"}, status=404)
-
-        if not cart.items.exists():
-            return Response({"error": "Cart is empty"}, status=400)
-
-        address = None
-        delivery_charge = Decimal("0.00")
-
-        if delivery_method == "delivery":
-            try:
-                address = Address.objects.get(id=address_id, user=request.user)
-            except Address.DoesNotExist:
-                return Response({"error": "Address not found"}, status=404)
-
-            # Calculate delivery charge
-            restaurant_lat, restaurant_lng = _get_restaurant_coords()
-            delivery_lat = address.latitude
-            delivery_lng = address.longitude
-            
-            if not delivery_lat or not delivery_lng:
-                delivery_lat, delivery_lng = _geocode_address(address.full_address)
-                if delivery_lat and delivery_lng:
-                    address.latitude = delivery_lat
-                    address.longitude = delivery_lng
-                    address.save(update_fields=["latitude", "longitude"])
-            
-            if delivery_lat and delivery_lng:
-                distance = _calculate_distance(restaurant_lat, restaurant_lng, delivery_lat, delivery_lng)
-                if distance and distance > 5:
-                    return Response(
-                        {"error": f"Delivery only available within 5 km radius. Your location is {distance:.1f} km away."},
-                        status=400
-                    )
-                delivery_charge = _calculate_delivery_charge(distance) if distance else Decimal("0.00")
-
-        subtotal = cart.get_subtotal()
-        total_tax = cart.get_total_tax()
-        total_price = subtotal + total_tax + PLATFORM_FEE + delivery_charge
-
-        # Create order
-        order = Order.objects.create(
-            user=request.user,
-            address=address,
-            subtotal=subtotal,
-            tax=total_tax,
-            platform_fee=PLATFORM_FEE,
-            delivery_charge=delivery_charge,
-            total_price=total_price,
-            status='pickup_pending' if delivery_method == "pickup" else 'confirmed',
-            delivery_otp=_generate_delivery_otp() if delivery_method == "delivery" else None,
+        payload, error, status = _create_paid_order(
+            request.user, address_id, delivery_method, razorpay_payment_id
         )
-
-        # Create order items
-        for cart_item in cart.items.all():
-            OrderItem.objects.create(
-                order=order,
-                item=cart_item.item,
-                quantity=cart_item.quantity,
-                price_at_order=cart_item.item.get_effective_price(),
-                tax_at_order=cart_item.get_tax(),
-            )
-
-        # Clear cart
-        cart.items.all().delete()
-
-        return Response({
-            "success": True,
-            "order_id": order.id,
-            "razorpay_payment_id": razorpay_payment_id,
-            "message": "Payment successful and order placed",
-        }, status=201)
+        if error:
+            return Response({"error": error}, status=status)
+        return Response(payload, status=201)
         
     except razorpay.errors.SignatureVerificationError:
         return Response({
@@ -1645,6 +2054,85 @@ def verify_razorpay_payment(request):
             "error": f"Payment verification error: {str(e)}"
         }, status=500)
 
+
+def _create_paid_order(user, address_id, delivery_method, razorpay_payment_id):
+    """
+    Turn the user's cart into an order once its payment is verified.
+    Returns (payload, error, http_status).
+    """
+    try:
+        cart = user.cart
+    except Cart.DoesNotExist:
+        return None, "Cart not found", 404
+
+    if not cart.items.exists():
+        return None, "Cart is empty", 400
+
+    address = None
+    delivery_charge = Decimal("0.00")
+
+    if delivery_method == "delivery":
+        try:
+            address = Address.objects.get(id=address_id, user=user)
+        except Address.DoesNotExist:
+            return None, "Address not found", 404
+
+        # Calculate delivery charge
+        restaurant_lat, restaurant_lng = _get_restaurant_coords()
+        delivery_lat = address.latitude
+        delivery_lng = address.longitude
+        
+        if not delivery_lat or not delivery_lng:
+            delivery_lat, delivery_lng = _geocode_address(address.full_address)
+            if delivery_lat and delivery_lng:
+                address.latitude = delivery_lat
+                address.longitude = delivery_lng
+                address.save(update_fields=["latitude", "longitude"])
+        
+        if delivery_lat and delivery_lng:
+            distance = _calculate_distance(restaurant_lat, restaurant_lng, delivery_lat, delivery_lng)
+            if distance and distance > 5:
+                return None, f"Delivery only available within 5 km radius. Your location is {distance:.1f} km away.", 400
+            delivery_charge = _calculate_delivery_charge(distance) if distance else Decimal("0.00")
+
+    subtotal = cart.get_subtotal()
+    total_tax = cart.get_total_tax()
+    total_price = subtotal + total_tax + PLATFORM_FEE + delivery_charge
+
+    # Create order
+    order = Order.objects.create(
+        user=user,
+        address=address,
+        subtotal=subtotal,
+        tax=total_tax,
+        platform_fee=PLATFORM_FEE,
+        delivery_charge=delivery_charge,
+        total_price=total_price,
+        status='pickup_pending' if delivery_method == "pickup" else 'confirmed',
+        delivery_otp=_generate_delivery_otp() if delivery_method == "delivery" else None,
+    )
+    order_states.record_created(order, actor=user)
+
+    # Create order items
+    for cart_item in cart.items.all():
+        OrderItem.objects.create(
+            order=order,
+            item=cart_item.item,
+            quantity=cart_item.quantity,
+            price_at_order=cart_item.item.get_effective_price(),
+            tax_at_order=cart_item.get_tax(),
+        )
+
+    # Clear cart
+    cart.items.all().delete()
+
+    return {
+        "success": True,
+        "order_id": order.id,
+        "razorpay_payment_id": razorpay_payment_id,
+        "message": "Payment successful and order placed",
+    }, None, 201
+
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
 def register_push_token(request):
@@ -1729,118 +2217,27 @@ def send_expo_push_notification(push_tokens, title, body, data=None):
     if not push_tokens:
         return
 
-    messages = []
-    for token in push_tokens:
-        messages.append({
-            "to": token,
-            "sound": "default",
-            "title": title,
-            "body": body,
-            "data": data or {},
-            "priority": "high",
-            "channelId": "order-updates",
-        })
-
-    try:
-        response = requests.post(
-            'https://exp.host/--/api/v2/push/send',
-            headers={
-                'Accept': 'application/json',
-                'Content-Type': 'application/json',
-            },
-            json=messages,
-            timeout=10
-        )
-        
-        if response.status_code == 200:
-            print(f"✓ Sent {len(messages)} notifications")
-        else:
-            print(f"✗ Failed to send notifications: {response.text}")
-            
-    except Exception as e:
-        print(f"✗ Error sending notifications: {str(e)}")
-
-
-def notify_order_status_change(order_id, new_status):
-    """Send notification when order status changes"""
-    try:
-        order = Order.objects.get(id=order_id)
-        user = order.user
-        
-        # Get all active push tokens for user
-        push_tokens = list(
-            PushToken.objects.filter(user=user, is_active=True)
-            .values_list('push_token', flat=True)
-        )
-
-        if not push_tokens:
-            return
-
-        # Status messages
-        status_messages = {
-            'confirmed': {
-                'title': '✅ Order Confirmed',
-                'body': f'Order #{order_id} has been confirmed and is being prepared.'
-            },
-            'preparing': {
-                'title': '👨‍🍳 Order is Being Prepared',
-                'body': f'Your delicious food is being prepared! Order #{order_id}'
-            },
-            'ready_for_pickup': {
-                'title': '📦 Order Ready for Pickup',
-                'body': f'Order #{order_id} is ready! Waiting for delivery partner.'
-            },
-            'on_the_way': {
-                'title': '🚴 Delivery Partner on the Way',
-                'body': f'Your order #{order_id} is on the way to you!'
-            },
-            'delivered': {
-                'title': '🎉 Order Delivered',
-                'body': f'Order #{order_id} has been delivered. Enjoy your meal!'
-            },
-            'cancelled': {
-                'title': '❌ Order Cancelled',
-                'body': f'Order #{order_id} has been cancelled.'
-            },
-        }
-
-        message = status_messages.get(new_status, {
-            'title': 'Order Update',
-            'body': f'Order #{order_id} status: {new_status}'
-        })
-
-        send_expo_push_notification(
-            push_tokens,
-            message['title'],
-            message['body'],
-            {'order_id': order_id, 'status': new_status, 'type': 'order_update'}
-        )
-
-    except Order.DoesNotExist:
-        print(f"Order {order_id} not found")
-    except Exception as e:
-        print(f"Error sending order notification: {str(e)}")
+    push.send_messages(push.expo_messages(push_tokens, title, body, data))
 
 
 def notify_app_update(version, platform='all'):
-    """Send notification about new app version"""
+    """
+    Send notification about new app version to every active device, streamed
+    through the push engine. Run it off the request path (see the
+    send_app_update_push command).
+    """
     try:
         app_version = AppVersion.objects.get(version=version, platform=platform)
         
         # Get all active push tokens (filter by platform if needed)
-        query = PushToken.objects.filter(is_active=True)
+        query = PushToken.objects.all()
         if platform != 'all':
             query = query.filter(device_type=platform)
-        
-        push_tokens = list(query.values_list('push_token', flat=True))
-
-        if not push_tokens:
-            return
 
         features_text = ', '.join(app_version.features[:3])
         
-        send_expo_push_notification(
-            push_tokens,
+        return push.broadcast(
+            query,
             '🎁 New App Update Available',
             f'Version {version} is now available! {features_text}',
             {
@@ -1861,58 +2258,41 @@ def notify_app_update(version, platform='all'):
 def available_coupons(request):
     """Get all available coupons for the current user"""
     try:
-        user = request.user
-        now = timezone.now()
-        
-        # Get active coupons that are currently valid
-        coupons = Coupon.objects.filter(
-            is_active=True,
-            valid_from__lte=now
-        ).filter(
-            models.Q(valid_until__isnull=True) | models.Q(valid_until__gte=now)
-        )
-        
-        coupon_list = []
-        for coupon in coupons:
-            # Check if coupon is still valid and user is eligible
-            is_valid, message = coupon.is_valid()
-            can_use, eligibility_msg = coupon.can_be_used_by_user(user)
-            
-            if is_valid and can_use:
-                coupon_data = {
-                    'id': coupon.id,
-                    'code': coupon.code,
-                    'description': coupon.description,
-                    'discount_type': coupon.discount_type,
-                    'discount_value': float(coupon.discount_value) if coupon.discount_value else None,
-                    'min_order_amount': float(coupon.min_order_amount),
-                    'max_discount_amount': float(coupon.max_discount_amount) if coupon.max_discount_amount else None,
-                    'for_first_time_users_only': coupon.for_first_time_users_only,
-                    'valid_until': coupon.valid_until.isoformat() if coupon.valid_until else None,
-                }
-                
-                # Add free item/category info if applicable
-                if coupon.discount_type == 'free_item':
-                    if coupon.free_item:
-                        coupon_data['free_item'] = {
-                            'id': coupon.free_item.id,
-                            'name': coupon.free_item.name,
-                            'price': float(coupon.free_item.price)
-                        }
-                    elif coupon.free_item_category:
-                        coupon_data['free_item_category'] = {
-                            'id': coupon.free_item_category.id,
-                            'name': coupon.free_item_category.name
-                        }
-                
-                coupon_list.append(coupon_data)
-        
+        coupon_list = [rule['payload'] for rule in coupons.available_for(request.user)]
         return Response({'coupons': coupon_list})
     
     except Exception as e:
         return Response({'error': str(e)}, status=500)
 
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def best_coupons(request):
+    """Every coupon the user can apply to their current cart, ranked by the discount it gives"""
+    try:
+        try:
+            cart = request.user.cart
+        except Cart.DoesNotExist:
+            return Response({'error': 'Cart not found'}, status=404)
+
+        lines = _cart_lines(cart)
+        if not lines:
+            return Response({'error': 'Cart is empty'}, status=400)
+
+        subtotal = sum((line[2] for line in lines), Decimal('0.00'))
+
+        offers, out_of_reach = coupons.best_offers(request.user, subtotal)
+        return Response({
+            'cart_subtotal': float(subtotal),
+            'best': offers[0] if offers else None,
+            'coupons': offers,
+            'almost_eligible': out_of_reach,
+        })
+
+    except Exception as e:
+        return Response({'error': str(e)}, status=500)
+
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def validate_coupon(request):
@@ -1925,10 +2305,16 @@ def validate_coupon(request):
         if not code:
             return Response({'error': 'Coupon code is required'}, status=400)
         
+        coupon_code = None
         try:
             coupon = Coupon.objects.get(code=code)
         except Coupon.DoesNotExist:
-            return Response({'error': 'Invalid coupon code'}, status=404)
+            coupon_code, code_error = coupon_codes.lookup(code)
+            if code_error:
+                return Response({'error': code_error}, status=404)
+            coupon = coupon_code.coupon
+        if coupon.unique_codes and coupon_code is None:
+            return Response({'error': 'This offer needs a personal coupon code'}, status=400)
         
         # Check if coupon is valid
         is_valid, message = coupon.is_valid()
@@ -1989,6 +2375,7 @@ def validate_coupon(request):
             'coupon': {
                 'id': coupon.id,
                 'code': coupon.code,
+                'coupon_code': coupon_codes.encode(coupon.id, coupon_code.serial) if coupon_code else None,
                 'description': coupon.description,
                 'discount_type': coupon.discount_type,
                 'discount_amount': float(discount_amount),
@@ -2133,7 +2520,7 @@ def create_support_ticket(request):
 @permission_classes([IsAuthenticated])
 def get_support_tickets(request):
     """Get all support tickets for current user"""
-    tickets = (
+    page, error = pagination.paginate(
         SupportTicket.objects.filter(user=request.user)
         .annotate(
             unread_count=Count(
@@ -2147,11 +2534,14 @@ def get_support_tickets(request):
                 queryset=SupportMessage.objects.only("id", "ticket_id", "message").order_by("-created_at"),
                 to_attr="prefetched_messages",
             )
-        )
+        ),
+        request,
     )
+    if error:
+        return Response({'error': error}, status=400)
     
     data = []
-    for ticket in tickets:
+    for ticket in page["items"]:
         prefetched_messages = getattr(ticket, "prefetched_messages", [])
         last_message = prefetched_messages[0] if prefetched_messages else None
         data.append({
@@ -2167,7 +2557,7 @@ def get_support_tickets(request):
             'unread_count': ticket.unread_count,
         })
     
-    return Response(data)
+    return pagination.set_page_headers(Response(data), page)
 
 
 @api_view(['GET', 'POST'])
@@ -2180,8 +2570,11 @@ def support_chat(request, ticket_id):
         return Response({'error': 'Ticket not found'}, status=404)
     
     if request.method == 'GET':
-        # Return all messages
-        messages = ticket.messages.all()
+        # Newest page of messages, returned oldest first like the full thread was.
+        page, error = pagination.paginate(ticket.messages.all(), request)
+        if error:
+            return Response({'error': error}, status=400)
+        messages = page["items"] if page["since"] else page["items"][::-1]
         data = {
             'ticket': {
                 'id': ticket.id,
@@ -2200,7 +2593,8 @@ def support_chat(request, ticket_id):
                     'created_at': msg.created_at.isoformat(),
                 }
                 for msg in messages
-            ]
+            ],
+            **pagination.page_fields(page),
         }
         return Response(data)
     
@@ -5,18 +5,49 @@ import os
 bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
 backlog = 2048
 
-# Reasonable worker default for small instances.
-workers = max(2, multiprocessing.cpu_count() * 2 + 1)
-worker_class = "sync"
+# Worker profile, chosen with GUNICORN_WORKER_CLASS:
+#   sync    - one request per worker process (default).
+#   gthread - GUNICORN_THREADS requests per worker, threads block on I/O.
+#   uvicorn - ASGI workers running food.asgi; I/O-bound endpoints switch to
+#             async views (ASYNC_IO_VIEWS) and the SSE/WebSocket endpoints work.
+worker_profile = os.getenv("GUNICORN_WORKER_CLASS", "sync").lower()
+
+# Reasonable worker default for small instances. Exported with the profile so
+# Django can check that the cache (and, for ASGI workers, pub/sub) backends
+# are shared between the workers.
+workers = int(os.getenv("GUNICORN_WORKERS", max(2, multiprocessing.cpu_count() * 2 + 1)))
+os.environ["GUNICORN_WORKERS"] = str(workers)
+os.environ["GUNICORN_WORKER_CLASS"] = worker_profile
 worker_connections = 1000
 timeout = 60
 keepalive = 2
 
+# Ensure Gunicorn knows which app to load when started with only -c.
+if worker_profile == "uvicorn":
+    worker_class = "uvicorn_worker.UvicornWorker"
+    wsgi_app = "food.asgi:application"
+    os.environ.setdefault("ASYNC_IO_VIEWS", "True")
+elif worker_profile == "gthread":
+    worker_class = "gthread"
+    threads = int(os.getenv("GUNICORN_THREADS", "8"))
+    wsgi_app = "food.wsgi:application"
+else:
+    worker_class = "sync"
+    wsgi_app = "food.wsgi:application"
+
 # Container logging should go to stdout/stderr.
 accesslog = "-"
 errorlog = "-"
 loglevel = "info"
 access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"'
 
-# Ensure Gunicorn knows which app to load when started with only -c.
-wsgi_app = "food.wsgi:application"
+
+def on_starting(server):
+    # Fail before forking when the workers would not share their state.
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "food.settings")
+    import django
+
+    django.setup()
+    from foodbackend.checks import ensure_shared_state
+
+    ensure_shared_state(workers)